@@ -1,7 +1,13 @@
+import os
 import sys
+import json
 import argparse
 
-from bbldpl_manager.bbldpl_manager import BbldplManager
+from bbldpl_manager.config import validate_config
+from bbldpl_manager.index import (EXPORT_FORMATS, AddressIndex, export_addresses,
+        index_filename)
+from bbldpl_manager.storage import open_storage
+from bbldpl_manager.topology import TOPOLOGIES, TopologyError, generate_config
 
 def main():
     parser = argparse.ArgumentParser()
@@ -13,23 +19,314 @@ def main():
         help="Path to storage file",
         default="storage.json"
     )
+    parser.add_argument("--storage-backend",
+        help="Format of the storage file: a JSON object rewritten atomically "
+            "or an append-only log of JSON lines",
+        choices=["json", "log"],
+        default="json"
+    )
     parser.add_argument("--image",
         help="Name of the Docker image to be used",
     )
+    parser.add_argument("--parallelism",
+        help="Number of nodes deployed or destroyed concurrently",
+        type=int,
+        default=1
+    )
+    parser.add_argument("--backend",
+        help="Transport used for wallet operations: btcctl executed inside "
+            "the containers or direct JSON-RPC",
+        choices=["exec", "rpc"],
+        default="exec"
+    )
+    parser.add_argument("--addresses-per-account",
+        help="Number of addresses generated for each account on deploy",
+        type=int,
+        default=1
+    )
+    parser.add_argument("--stop-timeout",
+        help="Seconds a container is given to stop on destroy before it is killed",
+        type=int
+    )
+    parser.add_argument("--force",
+        help="Kill and remove containers on destroy without stopping them first",
+        action="store_true"
+    )
+    parser.add_argument("--trace",
+        help="Record the duration of every stage and Docker call and write "
+            "them to this file (Chrome trace format, or JSON lines if the "
+            "file name ends with .jsonl)"
+    )
+    parser.add_argument("--async",
+        help="Drive the Docker Engine API from a single asyncio event loop "
+            "instead of a pool of threads (deploy, destroy and plan only)",
+        dest="use_async",
+        action="store_true"
+    )
+    parser.add_argument("--snapshot-cache",
+        help="Directory of the snapshot cache: provisioned nodes are committed "
+            "to images and later deployments of the same node start from them"
+    )
+    parser.add_argument("--snapshot-budget",
+        help="Disk space in MB the snapshots may use before the least "
+            "recently used ones are evicted",
+        type=int,
+        default=10240
+    )
+    parser.add_argument("--allow-overcommit",
+        help="Deploy nodes whose CPUs, memory or CPU quota do not fit on their "
+            "host with a warning instead of failing",
+        action="store_true"
+    )
+    parser.add_argument("--nodes",
+        help="Number of nodes of the configuration written by generate",
+        type=int
+    )
+    parser.add_argument("--topology",
+        help="Shape of the network written by generate",
+        choices=sorted(TOPOLOGIES)
+    )
+    parser.add_argument("--degree",
+        help="Number of connections per node of the generated topology",
+        type=int,
+        default=4
+    )
+    parser.add_argument("--seed",
+        help="Seed of the random topologies, for reproducible configurations",
+        type=int
+    )
+    parser.add_argument("--blocks",
+        help="Number of blocks generated by bench for each miner set",
+        type=int,
+        default=10
+    )
+    parser.add_argument("--transactions",
+        help="Number of transactions sent by bench for each miner set",
+        type=int,
+        default=100
+    )
+    parser.add_argument("--miners",
+        help="Comma separated numbers of mining nodes bench runs the workload "
+            "with, e.g. 1,4,16 (default: every node)"
+    )
+    parser.add_argument("--sample-interval",
+        help="Seconds between two samples of the block height and mempool "
+            "size of every node during bench",
+        type=float,
+        default=0.5
+    )
+    parser.add_argument("--report",
+        help="Path of the JSON report written by bench",
+        default="bench.json"
+    )
+    parser.add_argument("--scrape-interval",
+        help="Seconds between two polls of the nodes by monitor",
+        type=float,
+        default=15
+    )
+    parser.add_argument("--metrics-address",
+        help="Address the metrics endpoint of monitor listens on",
+        default="127.0.0.1"
+    )
+    parser.add_argument("--metrics-port",
+        help="Port the metrics endpoint of monitor listens on",
+        type=int,
+        default=9332
+    )
+    parser.add_argument("--lines",
+        help="Number of last lines of every node printed by logs",
+        type=int,
+        default=10
+    )
+    parser.add_argument("--follow",
+        help="Keep printing the lines the daemons write after the last ones "
+            "until interrupted",
+        action="store_true"
+    )
+    parser.add_argument("--grep",
+        help="Regular expression the lines printed by logs must match"
+    )
+    parser.add_argument("--follow-logs",
+        help="Print the output of the daemons of every node while deploy or "
+            "reconcile runs",
+        action="store_true"
+    )
+    parser.add_argument("--check-interval",
+        help="Seconds between two checks of the daemons by supervise",
+        type=float,
+        default=10
+    )
+    parser.add_argument("--max-backoff",
+        help="Longest delay in seconds supervise waits before restarting a "
+            "crash looping daemon",
+        type=float,
+        default=300
+    )
+    parser.add_argument("--address",
+        help="Address whose node and account query prints, can be repeated",
+        action="append"
+    )
+    parser.add_argument("--node-name",
+        help="Node whose addresses query exports"
+    )
+    parser.add_argument("--account",
+        help="Account whose addresses query exports"
+    )
+    parser.add_argument("--export-format",
+        help="Format of the addresses exported by query",
+        choices=EXPORT_FORMATS,
+        default="csv"
+    )
+    parser.add_argument("--output",
+        help="File query exports the addresses to, instead of the standard output"
+    )
+    parser.add_argument("--reindex",
+        help="Build the address index of query from the storage file, "
+            "replacing the existing one",
+        action="store_true"
+    )
     parser.add_argument("command",
         help="Command to be executed.",
-        choices=["deploy", "destroy"]
+        choices=["deploy", "destroy", "plan", "reconcile", "generate", "validate",
+            "bench", "monitor", "logs", "supervise", "query"]
     )
     args = parser.parse_args()
 
-    manager = BbldplManager(args.image, args.config, args.storage)
+    if args.command == "generate":
+        generate(args)
+        return
+    if args.command == "validate":
+        validate(args)
+        return
+    if args.command == "query":
+        query(args)
+        return
+
+    if args.use_async and args.backend == "rpc":
+        parser.error("--backend rpc cannot be used with --async")
+
+    # The managers import docker, which commands above do not need
+    if args.use_async:
+        from bbldpl_manager.async_manager import AsyncBbldplManager as manager_class
+    else:
+        from bbldpl_manager.bbldpl_manager import BbldplManager as manager_class
+    manager = manager_class(args.image, args.config, args.storage,
+            parallelism=args.parallelism, backend=args.backend,
+            addresses_per_account=args.addresses_per_account,
+            storage_backend=args.storage_backend,
+            trace=args.trace is not None,
+            snapshot_cache=args.snapshot_cache,
+            snapshot_budget=args.snapshot_budget * 1024 ** 2,
+            allow_overcommit=args.allow_overcommit)
+    try:
+        run_command(manager, args)
+    finally:
+        if args.trace:
+            manager.export_trace(args.trace)
+
+def generate(args):
+    if args.nodes is None or args.topology is None:
+        print("Error: generate requires --nodes and --topology")
+        sys.exit(1)
+    try:
+        config = generate_config(args.nodes, args.topology, degree=args.degree,
+                seed=args.seed)
+    except TopologyError as e:
+        print("Error: {}".format(e))
+        sys.exit(1)
+    with open(args.config, "w") as f:
+        json.dump(config, f, indent=4)
+    print("Wrote {} nodes and {} connections to {}".format(len(config["nodes"]),
+            len(config["connections"]["internal"]), args.config))
+
+def validate(args):
+    try:
+        with open(args.config, "r") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print("Error: cannot read {}: {}".format(args.config, e))
+        sys.exit(1)
+    errors = validate_config(config)
+    if errors:
+        print("{} is invalid:".format(args.config))
+        for error in errors:
+            print("\t{}".format(error))
+        sys.exit(1)
+    print("{} is valid: {} nodes, {} connections".format(args.config,
+            len(config["nodes"]), len(config["connections"]["internal"])))
+
+def query(args):
+    filename = index_filename(os.path.abspath(args.storage))
+    if args.reindex:
+        if not os.path.exists(args.storage):
+            print("Error: {} does not exist".format(args.storage))
+            sys.exit(1)
+        index = AddressIndex(filename)
+        index.rebuild({})
+        # Loading the storage indexes it
+        open_storage(args.storage, args.storage_backend, index=index)
+    elif not os.path.exists(filename):
+        # Building the index would load the whole storage file, which is
+        # what the index is there to avoid
+        print("Error: {} has no address index, run deploy or reconcile to "
+                "create it, or query --reindex to build it from the storage "
+                "file".format(args.storage))
+        sys.exit(1)
+    else:
+        index = AddressIndex(filename)
+
+    try:
+        if args.address:
+            missing = False
+            for address in args.address:
+                owner = index.owner(address)
+                if owner:
+                    print("{}: {}/{}".format(address, *owner))
+                else:
+                    print("{}: not found".format(address))
+                    missing = True
+            if missing:
+                sys.exit(1)
+            return
+
+        rows = index.addresses(node_name=args.node_name, account=args.account)
+        if args.output:
+            with open(args.output, "w", newline="") as f:
+                written = export_addresses(rows, f, args.export_format)
+            print("Wrote {} addresses to {}".format(written, args.output))
+        else:
+            export_addresses(rows, sys.stdout, args.export_format)
+    finally:
+        index.close()
+
+def run_command(manager, args):
     if args.command == "deploy":
         try:
-            manager.deploy()
+            manager.deploy(follow_logs=args.follow_logs)
+        finally:
+            manager.flush_storage()
+    elif args.command == "reconcile":
+        try:
+            manager.reconcile(follow_logs=args.follow_logs)
         finally:
             manager.flush_storage()
     elif args.command == "destroy":
-        manager.destroy()
+        manager.destroy(stop_timeout=args.stop_timeout, force=args.force)
+    elif args.command == "plan":
+        manager.plan()
+    elif args.command == "bench":
+        miner_counts = [int(count) for count in args.miners.split(",")] \
+                if args.miners else None
+        manager.bench(args.report, blocks=args.blocks,
+                transactions=args.transactions, miner_counts=miner_counts,
+                interval=args.sample_interval)
+    elif args.command == "monitor":
+        manager.monitor(interval=args.scrape_interval,
+                address=args.metrics_address, port=args.metrics_port)
+    elif args.command == "logs":
+        manager.logs(lines=args.lines, follow=args.follow, pattern=args.grep)
+    elif args.command == "supervise":
+        manager.supervise(interval=args.check_interval, max_backoff=args.max_backoff)
     else:
         print("Error: Invalid command")
         sys.exit(1)
@@ -0,0 +1,436 @@
+import asyncio
+import os
+import threading
+import time
+
+from bbldpl_manager.container import (WALLET_CREATED, WALLET_PROMPTS, WALLET_SECRETS,
+        bbld_command, btcwallet_command, btcctl_command, command_name,
+        count_outbound_peers, logged_command, parse_btcctl_output,
+        ContainerManager, ContainerAccountDoesNotExistError,
+        ContainerCommandExecutionError, ContainerDaemonNotReadyError,
+        ContainerNameDoesNotExistError, ContainerNameExistsError,
+        ContaineWalletGenerationError, NetworkNotFoundException, published_ports)
+from bbldpl_manager.docker_async import (AsyncDockerClient, AsyncDockerAPIError,
+        AsyncDockerNotFound)
+from bbldpl_manager.expect import AsyncExpectSession, ExpectError
+from bbldpl_manager.trace import Tracer
+
+class AsyncContainerManager:
+    """
+    asyncio counterpart of ContainerManager. It has the same methods, as
+    coroutines, and talks to the Docker Engine API directly through an
+    AsyncDockerClient, so any number of nodes can be driven from a single
+    thread. Concurrent Docker API requests are bounded by `max_concurrency`.
+    Wallet operations run btcctl inside the containers.
+    """
+    CONTAINER_PLATFORM = "linux/amd64"
+    PROBE_MIN_DELAY = 0.25
+    PROBE_MAX_DELAY = 5
+    PROBE_TIMEOUT = 300
+    WALLET_PROMPT_TIMEOUT = 60
+    WALLET_CREATE_TIMEOUT = 300
+
+    def __init__(self, storage_config, storage=None, tracer=None,
+            docker_url=None, max_concurrency=None, host=None):
+        """
+        `host` is the name the Docker host is recorded under in the storage
+        of each node, as ContainerManager records it.
+        """
+        self.storage_config = storage_config
+        self.host = host or ContainerManager.DEFAULT_HOST
+        self.storage = storage
+        # The storage is flushed from another thread, see AsyncBbldplManager
+        self.storage_lock = storage.lock if storage else threading.RLock()
+        self.tracer = tracer or Tracer(enabled=False)
+        self.client = AsyncDockerClient(docker_url or os.environ.get("DOCKER_HOST"),
+                max_concurrency=max_concurrency)
+        self.probe_latencies = {}
+        self.wallet_transcripts = {}
+
+    async def container_exists(self, node_name):
+        return await self._get_container_id(node_name) != None
+
+    async def create_container(self, image_name, node_name, net_name, ip_mapping):
+        if await self._get_container_id(node_name):
+            raise ContainerNameExistsError()
+
+        port_bindings = {port: [{"HostPort": str(hostport)}]
+                for port, hostport in ip_mapping.items()}
+        with self.tracer.span("docker.containers.run"):
+            container_id = await self.client.create_container(image_name,
+                    node_name, platform=self.CONTAINER_PLATFORM, Tty=True,
+                    ExposedPorts={port: {} for port in ip_mapping},
+                    HostConfig={
+                        "PortBindings": port_bindings,
+                        "NetworkMode": net_name
+                    })
+            await self.client.start_container(container_id)
+        with self.storage_lock:
+            self.storage_config[node_name] = self._create_empty_storage_object()
+            self.storage_config[node_name]["containerID"] = container_id
+            self.storage_config[node_name]["host"] = self.host
+        self._flush(node_name)
+
+    async def destroy_container(self, node_name, stop_timeout=None, force=False):
+        container_id = await self._get_container_id(node_name)
+        if not container_id:
+            raise ContainerNameDoesNotExistError()
+
+        removed = True
+        try:
+            if not force:
+                with self.tracer.span("docker.container.stop"):
+                    await self.client.stop_container(container_id, stop_timeout)
+            with self.tracer.span("docker.container.remove", force=force):
+                await self.client.remove_container(container_id, force=force)
+        except AsyncDockerNotFound:
+            removed = False
+
+        self.forget_container(node_name)
+        return removed
+
+    def forget_container(self, node_name):
+        if not node_name in self.storage_config:
+            return
+        with self.storage_lock:
+            del self.storage_config[node_name]
+        self._flush(node_name)
+
+    async def exec(self, node_name, cmd, detach=False):
+        """
+        Runs `cmd` in the container of `node_name` and returns
+        `(exit_code, output)`.
+        """
+        container_id = await self._get_container_id(node_name)
+        if not container_id:
+            raise ContainerNameDoesNotExistError()
+        return await self._exec(container_id, cmd, detach=detach)
+
+    async def start_bbld_daemon(self, node_name, user, passw, rpcport, port,
+            mining_address=None, connections=[], simnet=False):
+        await self._start_daemon(node_name, "bbld", bbld_command(user, passw,
+                rpcport, port, mining_address=mining_address,
+                connections=connections, simnet=simnet))
+
+    async def kill_bbld_daemon(self, node_name):
+        exit_code, pid_of_bbld = await self.exec(node_name, ["pidof", "-x", "bbld"])
+        if exit_code == 0:
+            await self.exec(node_name, ["/bin/bash", "-c",
+                    "kill " + pid_of_bbld.decode('utf-8').strip()])
+
+        # bbld shuts down gracefully, wait until it has released its ports
+        async def exited():
+            return not await self.daemon_running(node_name, "bbld")
+        await self._wait_for(node_name, "bbld-exit", exited)
+
+    async def wait_for_bbld_ready(self, node_name, user, passw, simnet=False,
+            timeout=None):
+        async def ready():
+            return await self._call_succeeds(node_name, user, passw, "getinfo",
+                    wallet=False, simnet=simnet)
+        return await self._wait_for(node_name, "bbld", ready, timeout=timeout)
+
+    async def wait_for_btcwallet_ready(self, node_name, user, passw, simnet=False,
+            timeout=None):
+        async def ready():
+            return await self._call_succeeds(node_name, user, passw, "getinfo",
+                    simnet=simnet)
+        return await self._wait_for(node_name, "btcwallet", ready, timeout=timeout)
+
+    async def wait_for_peers(self, node_name, user, passw, peers, simnet=False,
+            timeout=None):
+        async def connected():
+            try:
+                peer_info = await self._btcctl(node_name, user, passw,
+                        "getpeerinfo", wallet=False, simnet=simnet)
+            except ContainerCommandExecutionError:
+                return False
+            return count_outbound_peers(peer_info) >= peers
+        return await self._wait_for(node_name, "peers", connected, timeout=timeout)
+
+    def get_probe_latencies(self):
+        return self.probe_latencies
+
+    def get_wallet_transcript(self, node_name):
+        """
+        Returns the output of the last wallet creation of a node, with the
+        answers given to it and the passphrases and seed masked.
+        """
+        return self.wallet_transcripts.get(node_name)
+
+    async def start_btcwallet_daemon(self, node_name, user, passw, simnet=False):
+        await self._start_daemon(node_name, "btcwallet",
+                btcwallet_command(user, passw, simnet=simnet))
+
+    async def generate_wallet(self, node_name, user, passw, walletpass, simnet=False):
+        container_id = await self._get_container_id(node_name)
+        if not container_id:
+            raise ContainerNameDoesNotExistError()
+
+        cmd = btcwallet_command(user, passw, create=True, simnet=simnet)
+        with self.tracer.span("docker.exec", command="btcwallet --create"):
+            reader, writer = await self.client.exec_interactive(container_id, cmd)
+        session = AsyncExpectSession(reader, writer, timeout=self.WALLET_PROMPT_TIMEOUT,
+                masks=WALLET_SECRETS)
+        try:
+            seed = None
+            for prompt, answer in WALLET_PROMPTS:
+                match = await session.expect(prompt)
+                seed = match.groupdict().get("seed", seed)
+                await session.sendline(answer or walletpass, secret=answer is None)
+            await session.expect(WALLET_CREATED, timeout=self.WALLET_CREATE_TIMEOUT)
+        except ExpectError as e:
+            raise ContaineWalletGenerationError("{}: {}\n{}".format(node_name,
+                    e, e.transcript))
+        finally:
+            self.wallet_transcripts[node_name] = session.format_transcript()
+            session.close()
+
+        with self.storage_lock:
+            self.storage_config[node_name]["wallet"]["seed"] = seed.decode("ascii")
+        self._flush(node_name)
+
+    async def unlock_wallet(self, node_name, user, passw, walletpass,
+            timeout, simnet=False):
+        await self._btcctl(node_name, user, passw, "walletpassphrase",
+                walletpass, int(timeout), simnet=simnet)
+
+    async def list_accounts(self, node_name, user, passw, simnet=False):
+        return await self._btcctl(node_name, user, passw, "listaccounts",
+                simnet=simnet)
+
+    async def account_exists(self, node_name, user, passw, account, simnet=False):
+        return account in await self.list_accounts(node_name, user, passw, simnet)
+
+    async def add_account(self, node_name, user, passw, account, simnet=False):
+        if await self.account_exists(node_name, user, passw, account, simnet):
+            return
+
+        await self._btcctl(node_name, user, passw, "createnewaccount", account,
+                simnet=simnet)
+        with self.storage_lock:
+            self.storage_config[node_name]["accounts"][account] = {"addresses": []}
+        self._flush(node_name)
+
+    async def generate_address(self, node_name, user, passw, account, simnet=False):
+        if not await self.account_exists(node_name, user, passw, account, simnet):
+            raise ContainerAccountDoesNotExistError(
+                    "Account {} does not exist".format(account))
+
+        address = await self._btcctl(node_name, user, passw, "getnewaddress",
+                account, simnet=simnet)
+        with self.storage_lock:
+            self.storage_config[node_name]["accounts"].setdefault(account,
+                    {"addresses": []})["addresses"].append(address)
+        self._flush(node_name)
+        return address
+
+    async def provision_accounts(self, node_name, user, passw, accounts,
+            addresses_per_account=1, simnet=False, concurrency=1):
+        """
+        Same as ContainerManager.provision_accounts. The missing accounts and
+        the new addresses are requested concurrently, with at most
+        `concurrency` btcctl commands running in the container at a time.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def btcctl(method, account):
+            async with semaphore:
+                return await self._btcctl(node_name, user, passw, method,
+                        account, simnet=simnet)
+
+        existing = await self.list_accounts(node_name, user, passw, simnet)
+        missing = [account for account in dict.fromkeys(accounts)
+                if account not in existing]
+        await asyncio.gather(*[btcctl("createnewaccount", account)
+                for account in missing])
+
+        node_accounts = self.storage_config[node_name]["accounts"]
+        with self.storage_lock:
+            for account in accounts:
+                node_accounts.setdefault(account, {"addresses": []})
+
+        requested = [account for account in dict.fromkeys(accounts)
+                for _ in range(addresses_per_account)]
+        addresses = await asyncio.gather(*[btcctl("getnewaddress", account)
+                for account in requested])
+
+        generated = {account: [] for account in accounts}
+        with self.storage_lock:
+            for account, address in zip(requested, addresses):
+                generated[account].append(address)
+                node_accounts[account]["addresses"].append(address)
+        self._flush(node_name)
+        return generated
+
+    async def get_addresses(self, node_name, user, passw, account, simnet=False):
+        if not await self.account_exists(node_name, user, passw, account, simnet):
+            raise ContainerAccountDoesNotExistError(
+                    "Account {} does not exist".format(account))
+
+        return await self._btcctl(node_name, user, passw, "getaddressesbyaccount",
+                account, simnet=simnet)
+
+    async def get_first_address(self, node_name, user, passw, account, simnet=False):
+        addresses = await self.get_addresses(node_name, user, passw, account, simnet)
+        if len(addresses):
+            return addresses[0]
+
+    async def daemon_running(self, node_name, daemon):
+        exit_code, _ = await self.exec(node_name, ["pidof", "-x", daemon])
+        return exit_code == 0
+
+    async def get_published_ports(self):
+        with self.tracer.span("docker.containers.list"):
+            containers = await self.client.list_containers(all=False)
+        return published_ports(containers)
+
+    async def network_exists(self):
+        if not "network" in self.storage_config:
+            return False
+        try:
+            with self.tracer.span("docker.networks.get"):
+                await self.client.inspect_network(self.storage_config["network"])
+        except AsyncDockerNotFound:
+            return False
+        return True
+
+    async def create_network(self, network_name):
+        with self.tracer.span("docker.networks.create"):
+            network_id = await self.client.create_network(network_name)
+        with self.storage_lock:
+            self.storage_config["network"] = network_id
+        self._flush("network")
+
+    async def destroy_network(self):
+        if not "network" in self.storage_config:
+            return
+        network_id = self.storage_config["network"]
+        try:
+            with self.tracer.span("docker.networks.remove"):
+                await self.client.remove_network(network_id)
+        except AsyncDockerNotFound:
+            raise NetworkNotFoundException("Network {} does not exist".format(network_id))
+        finally:
+            with self.storage_lock:
+                del self.storage_config["network"]
+            self._flush("network")
+
+    async def start_mining(self, node_name, user, passw, simnet=False):
+        await self._btcctl(node_name, user, passw, "setgenerate", True,
+                simnet=simnet)
+
+    async def stop_mining(self, node_name, user, passw, simnet=False):
+        await self._btcctl(node_name, user, passw, "setgenerate", False,
+                simnet=simnet)
+
+    def get_storage(self):
+        return self.storage_config
+
+    async def close(self):
+        await self.client.close()
+
+    ############# Internal methods ############
+
+    def _flush(self, key):
+        if self.storage:
+            self.storage.flush(key)
+
+    def _create_empty_storage_object(self):
+        return {
+            "containerID": "",
+            "accounts": {},
+            "wallet": {"seed": ""},
+            "stages": []
+        }
+
+    async def _get_container_id(self, node_name):
+        if not node_name in self.storage_config:
+            return None
+        container_id = self.storage_config[node_name]["containerID"]
+        try:
+            with self.tracer.span("docker.containers.get"):
+                await self.client.inspect_container(container_id)
+        except AsyncDockerNotFound:
+            return None
+        return container_id
+
+    async def _exec(self, container_id, cmd, detach=False):
+        try:
+            with self.tracer.span("docker.exec", command=command_name(cmd)):
+                return await self.client.exec_run(container_id, cmd, detach=detach)
+        except AsyncDockerAPIError as e:
+            raise ContainerCommandExecutionError(e)
+
+    async def _start_daemon(self, node_name, daemon, cmd):
+        """
+        Starts `daemon` with `cmd` in the background and records both with
+        the ID of the exec running it, as ContainerManager does.
+        """
+        container_id = await self._get_container_id(node_name)
+        if not container_id:
+            raise ContainerNameDoesNotExistError()
+        try:
+            with self.tracer.span("docker.exec", command=daemon):
+                exec_id = await self.client.exec_detached(container_id,
+                        logged_command(daemon, cmd))
+        except AsyncDockerAPIError as e:
+            raise ContainerCommandExecutionError(e)
+
+        with self.storage_lock:
+            self.storage_config[node_name].setdefault("daemons", {})[daemon] = {
+                "command": cmd,
+                "exec": exec_id
+            }
+        self._flush(node_name)
+
+    async def _btcctl(self, node_name, user, passw, method, *params,
+            wallet=True, simnet=False):
+        exit_code, output = await self.exec(node_name, btcctl_command(user, passw,
+                method, params, wallet=wallet, simnet=simnet))
+        output = output.decode('utf-8').strip()
+        if exit_code != 0:
+            raise ContainerCommandExecutionError(
+                    "{}: {} failed: {}".format(node_name, method, output))
+        return parse_btcctl_output(output)
+
+    async def _call_succeeds(self, node_name, user, passw, method,
+            wallet=True, simnet=False):
+        try:
+            await self._btcctl(node_name, user, passw, method, wallet=wallet,
+                    simnet=simnet)
+        except ContainerCommandExecutionError:
+            return False
+        return True
+
+    async def _wait_for(self, node_name, probe, check, timeout=None):
+        """
+        Awaits `check` until it returns True, backing off exponentially
+        between attempts. Records and returns the time it took.
+        """
+        if timeout is None:
+            timeout = self.PROBE_TIMEOUT
+        with self.tracer.span("wait." + probe):
+            start = time.monotonic()
+            deadline = start + timeout
+            delay = self.PROBE_MIN_DELAY
+            attempts = 0
+            while True:
+                attempts += 1
+                passed = await check()
+                now = time.monotonic()
+                if passed:
+                    break
+                if now >= deadline:
+                    raise ContainerDaemonNotReadyError(
+                            "{}: {} probe did not pass after {:.1f}s ({} attempts)".format(
+                            node_name, probe, now - start, attempts))
+                await asyncio.sleep(min(delay, deadline - now))
+                delay = min(delay * 2, self.PROBE_MAX_DELAY)
+
+        latency = now - start
+        self.probe_latencies.setdefault(node_name, {})[probe] = {
+            "latency": latency,
+            "attempts": attempts
+        }
+        return latency
@@ -0,0 +1,353 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bbldpl_manager.async_container import AsyncContainerManager
+from bbldpl_manager.bbldpl_manager import BbldplManager, DeploymentError
+from bbldpl_manager.container import NetworkNotFoundException
+
+class _BackgroundStorage:
+    """
+    Wraps a storage so that its flushes, which fsync the storage file, run
+    in order on a thread of their own instead of blocking the event loop.
+    `wait` returns once every flush requested so far is done and raises the
+    error of the first one that failed.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.data = storage.data
+        self.lock = storage.lock
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._error = None
+
+    def flush(self, key=None):
+        self._pending = self._executor.submit(self._flush, key)
+
+    def wait(self):
+        if self._pending:
+            self._pending.result()
+        if self._error:
+            error, self._error = self._error, None
+            raise error
+
+    def _flush(self, key):
+        try:
+            self.storage.flush(key)
+        except Exception as e:
+            if not self._error:
+                self._error = e
+
+class AsyncBbldplManager(BbldplManager):
+    """
+    Drives the deployment with an AsyncContainerManager from a single event
+    loop instead of a pool of threads. Up to `parallelism` nodes are
+    processed concurrently. Stages, storage and traces behave as in
+    BbldplManager.
+    """
+    def deploy(self, follow_logs=False):
+        if follow_logs:
+            raise DeploymentError("Following logs is not supported by the asyncio driver")
+        if self.snapshots:
+            raise DeploymentError("Snapshots are not supported by the asyncio driver")
+        asyncio.run(self._run(self._deploy()))
+
+    def destroy(self, stop_timeout=None, force=False):
+        asyncio.run(self._run(self._destroy(stop_timeout, force)))
+
+    def plan(self):
+        asyncio.run(self._run(self._plan()))
+
+    def reconcile(self, **options):
+        raise DeploymentError("reconcile is not supported by the asyncio driver")
+
+    def bench(self, report_file, **options):
+        raise DeploymentError("bench is not supported by the asyncio driver")
+
+    def monitor(self, **options):
+        raise DeploymentError("monitor is not supported by the asyncio driver")
+
+    def logs(self, **options):
+        raise DeploymentError("logs is not supported by the asyncio driver")
+
+    def supervise(self, **options):
+        raise DeploymentError("supervise is not supported by the asyncio driver")
+
+    ########### Internal Methods ###########
+
+    def _create_container_manager(self, backend):
+        if len(self.hosts) > 1:
+            raise DeploymentError("The asyncio driver supports a single Docker host")
+        if self.client_factory:
+            raise DeploymentError("The asyncio driver talks to the Docker socket directly "
+                    "and cannot use another client")
+        self.storage = _BackgroundStorage(self.storage)
+        return AsyncContainerManager(self.storage_config, storage=self.storage,
+                tracer=self.tracer,
+                docker_url=self.hosts[0]["url"] if self.hosts else None,
+                host=self.default_host)
+
+    async def _run(self, coroutine):
+        try:
+            return await coroutine
+        finally:
+            await self.container_manager.close()
+            await asyncio.get_running_loop().run_in_executor(None,
+                    self.storage.wait)
+
+    async def _deploy(self):
+        network_name = self.node_config["network"]["name"]
+        if not await self.container_manager.network_exists():
+            print("Creating a network {}...".format(network_name))
+            await self.container_manager.create_network(network_name)
+
+        print ("Deploying node(s)...")
+        with self.tracer.span("phase.deploy"):
+            results = await self._deploy_nodes(self.node_config["nodes"])
+        deployed = {node_name: node_info
+                for node_name, node_info in self.node_config["nodes"].items()
+                if not results[node_name]}
+
+        await self._connect_nodes(deployed)
+        await self._start_mining(deployed)
+
+        self._finish(results)
+
+    async def _destroy(self, stop_timeout, force):
+        print("Destroying node(s)...")
+        outcomes = await self._gather(self.node_config["nodes"],
+                lambda node_name: self._destroy_node(node_name, stop_timeout, force))
+        results = {}
+        for node_name, outcome in outcomes.items():
+            if isinstance(outcome, Exception):
+                print("{}: Destruction failed: {!r}".format(node_name, outcome))
+                outcome = ("failed", 0, outcome)
+            results[node_name] = outcome
+
+        print("Destroying network...")
+        try:
+            await self.container_manager.destroy_network()
+        except NetworkNotFoundException as e:
+            print("{}, skipping".format(e))
+
+        self.flush_storage()
+
+        print("Summary:")
+        for node_name in sorted(results):
+            status, elapsed, error = results[node_name]
+            if error:
+                print("\t{}: {} ({!r})".format(node_name, status, error))
+            else:
+                print("\t{}: {} in {:.1f}s".format(node_name, status, elapsed))
+        failed = [node_name for node_name, result in results.items() if result[2]]
+        if failed:
+            raise DeploymentError("Failed to destroy node(s): {}".format(
+                ", ".join(sorted(failed))))
+        print("Done")
+
+    async def _plan(self):
+        if not await self.container_manager.network_exists():
+            print("network: create {}".format(self.node_config["network"]["name"]))
+
+        plans = await self._gather(self.node_config["nodes"], self._plan_node)
+        for node_name, stages in plans.items():
+            if stages:
+                print("{}: {}".format(node_name, ", ".join(stages)))
+            else:
+                print("{}: up to date".format(node_name))
+
+    async def _gather(self, node_names, function):
+        """
+        Awaits `function(node_name)` for every node, at most `parallelism`
+        at a time. Returns a mapping of node names to results, or to the
+        exception raised for that node.
+        """
+        semaphore = asyncio.Semaphore(self.parallelism)
+
+        async def bounded(node_name):
+            async with semaphore:
+                return await function(node_name)
+
+        node_names = list(node_names)
+        outcomes = await asyncio.gather(*[bounded(node_name)
+                for node_name in node_names], return_exceptions=True)
+        return dict(zip(node_names, outcomes))
+
+    async def _deploy_nodes(self, nodes):
+        new_nodes = {node_name: node_info for node_name, node_info in nodes.items()
+                if not await self.container_manager.container_exists(node_name)}
+        if new_nodes:
+            if self.node_config.get("resources") or any("resources" in node_info
+                    for node_info in new_nodes.values()):
+                raise DeploymentError("Resource limits are not supported by the "
+                        "asyncio driver")
+            self._place_nodes(new_nodes)
+            self._assign_host_ports(new_nodes, {self.default_host:
+                    await self.container_manager.get_published_ports()})
+
+        outcomes = await self._gather(nodes,
+                lambda node_name: self._deploy_node(node_name, nodes[node_name]))
+        results = {}
+        for node_name, outcome in outcomes.items():
+            if isinstance(outcome, Exception):
+                print("{}: Deployment failed: {!r}".format(node_name, outcome))
+                results[node_name] = outcome
+            else:
+                results[node_name] = None
+        return results
+
+    async def _destroy_node(self, node_name, stop_timeout, force):
+        start = time.monotonic()
+        with self.tracer.span("stage.destroy", node=node_name):
+            if not await self.container_manager.container_exists(node_name):
+                print("Node {} is not running.".format(node_name))
+                self.container_manager.forget_container(node_name)
+                return ("not running", 0, None)
+
+            print("{}: Destroying...".format(node_name))
+            removed = await self.container_manager.destroy_container(node_name,
+                    stop_timeout=stop_timeout, force=force)
+        status = "destroyed" if removed else "already gone"
+        return (status, time.monotonic() - start, None)
+
+    async def _connect_nodes(self, nodes):
+        print("Connecting nodes...")
+        connections_per_node = self._get_connections_per_node()
+        restarted = {node_name: node_info
+                for node_name, node_info in nodes.items()
+                if self._needs_connect(node_name, connections_per_node[node_name])}
+
+        async def restart(node_name):
+            node_info = restarted[node_name]
+            print("{}: Restarting bbld daemon...".format(node_name))
+            with self.tracer.span("stage.restart", node=node_name):
+                mining_address = await self.container_manager.get_first_address(
+                        node_name, node_info["user"], node_info["pass"],
+                        node_info["miningaccount"], simnet=self.simnet)
+                await self.container_manager.kill_bbld_daemon(node_name)
+                await self.container_manager.start_bbld_daemon(node_name,
+                        node_info["user"], node_info["pass"],
+                        node_info["rpcport"], node_info["port"],
+                        mining_address=mining_address,
+                        connections=connections_per_node[node_name],
+                        simnet=self.simnet)
+                await self.container_manager.wait_for_bbld_ready(node_name,
+                        node_info["user"], node_info["pass"], simnet=self.simnet,
+                        timeout=self.READY_TIMEOUT)
+
+        peers_per_node = self._get_peer_counts(nodes)
+
+        async def connect(node_name):
+            node_info = restarted[node_name]
+            with self._stage(node_name, "connect"):
+                await self.container_manager.wait_for_peers(node_name,
+                        node_info["user"], node_info["pass"], peers_per_node[node_name],
+                        simnet=self.simnet, timeout=self.READY_TIMEOUT)
+                with self.storage.lock:
+                    self.storage_config[node_name]["connections"] = connections_per_node[node_name]
+                self._reset_stages(node_name, ["mining"])
+
+        waves = self._get_restart_waves(restarted)
+        for number, wave in enumerate(waves, 1):
+            print("Restarting wave {}/{}: {}".format(number, len(waves), ", ".join(wave)))
+            self._raise_first(await self._gather(wave, restart))
+        print("Waiting for peers to connect...")
+        self._raise_first(await self._gather(restarted, connect))
+
+    async def _start_mining(self, nodes):
+        print("Starting mining...")
+
+        async def mine(node_name):
+            node_info = nodes[node_name]
+            print("{}: Starting Mining...".format(node_name))
+            with self._stage(node_name, "mining"):
+                await self.container_manager.start_mining(node_name,
+                        node_info["user"], node_info["pass"], simnet=self.simnet)
+
+        self._raise_first(await self._gather([node_name for node_name in nodes
+                if not self._stage_done(node_name, "mining")], mine))
+
+    def _raise_first(self, outcomes):
+        for outcome in outcomes.values():
+            if isinstance(outcome, Exception):
+                raise outcome
+
+    async def _deploy_node(self, node_name, node_info):
+        stages = await self._plan_node(node_name)
+        if not set(stages) & set(self.NODE_STAGES):
+            print("Node {} is already running. Will not re-deploy.".format(node_name))
+            return
+        if not "container" in stages:
+            print("{}: Resuming with stage(s) {}".format(node_name, ", ".join(stages)))
+
+        if "container" in stages:
+            with self._stage(node_name, "container"):
+                print("{}: Creating container...".format(node_name))
+                ip_mapping = self._get_ip_mapping(node_name, node_info)
+                await self.container_manager.create_container(self.image_name,
+                        node_name, self.node_config["network"]["name"], ip_mapping)
+                self._record_host_port(node_name, ip_mapping)
+
+        if "wallet" in stages:
+            with self._stage(node_name, "wallet"):
+                print("{}: Generating wallet...".format(node_name))
+                await self.container_manager.generate_wallet(node_name,
+                        node_info["user"], node_info["pass"], node_info["walletpass"],
+                        simnet=self.simnet)
+
+        if "bbld" in stages:
+            with self._stage(node_name, "bbld"):
+                print("{}: Starting bbld daemon...".format(node_name))
+                await self.container_manager.start_bbld_daemon(node_name,
+                        node_info["user"], node_info["pass"], node_info["rpcport"],
+                        node_info["port"], simnet=self.simnet)
+                latency = await self.container_manager.wait_for_bbld_ready(node_name,
+                        node_info["user"], node_info["pass"], simnet=self.simnet,
+                        timeout=self.READY_TIMEOUT)
+                print("{}: bbld daemon ready after {:.1f}s".format(node_name, latency))
+                # A fresh bbld is neither connected nor mining
+                self._reset_stages(node_name, ["connect", "mining"])
+
+        if "btcwallet" in stages:
+            with self._stage(node_name, "btcwallet"):
+                print("{}: Starting btcwallet daemon...".format(node_name))
+                await self.container_manager.start_btcwallet_daemon(node_name,
+                        node_info["user"], node_info["pass"], simnet=self.simnet)
+                latency = await self.container_manager.wait_for_btcwallet_ready(
+                        node_name, node_info["user"], node_info["pass"],
+                        simnet=self.simnet, timeout=self.READY_TIMEOUT)
+                print("{}: btcwallet daemon ready after {:.1f}s".format(node_name, latency))
+
+        if "unlock" in stages:
+            with self._stage(node_name, "unlock"):
+                print("{}: Unlocking wallet...".format(node_name))
+                await self.container_manager.unlock_wallet(node_name,
+                        node_info["user"], node_info["pass"],
+                        node_info["walletpass"], self.WALLET_TIMEOUT, simnet=self.simnet)
+
+        if "accounts" in stages:
+            with self._stage(node_name, "accounts"):
+                print("{}: Creating accounts...".format(node_name))
+                generated = await self.container_manager.provision_accounts(node_name,
+                        node_info["user"], node_info["pass"],
+                        node_info["accounts"] + ["default"],
+                        addresses_per_account=self.addresses_per_account,
+                        simnet=self.simnet, concurrency=self.parallelism)
+                for account, addresses in generated.items():
+                    print("\t\t{}: {} assigned {} address(es)".format(node_name,
+                            account, len(addresses)))
+
+    async def _plan_node(self, node_name):
+        if not await self.container_manager.container_exists(node_name):
+            return self.NODE_STAGES + self.NETWORK_STAGES
+
+        done = set(self._get_stages(node_name))
+        if "bbld" in done and not await self.container_manager.daemon_running(
+                node_name, "bbld"):
+            done -= {"bbld", "connect", "mining"}
+        if "btcwallet" in done and not await self.container_manager.daemon_running(
+                node_name, "btcwallet"):
+            done -= {"btcwallet", "unlock"}
+
+        return [stage for stage in self.NODE_STAGES + self.NETWORK_STAGES
+                if stage not in done]
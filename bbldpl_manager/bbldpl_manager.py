@@ -1,28 +1,98 @@
 import os
+import re
 import sys
 import json
 import time
 
-from bbldpl_manager.container import ContainerManager
+from bbldpl_manager.config import is_simnet, normalize_config, validate_config
+from bbldpl_manager.container import (ContainerManager, HostUnreachableError,
+        NetworkNotFoundException)
+from bbldpl_manager.index import AddressIndex, index_filename
+from bbldpl_manager.ports import (PortAllocator, PortConflictError,
+        get_listening_ports)
+from bbldpl_manager.resources import (ResourceError, docker_limits, format_cpulist,
+        get_local_numa_nodes, node_resources, pack_nodes, parse_cpulist,
+        parse_memory)
+from bbldpl_manager.storage import open_storage
+from bbldpl_manager.trace import Tracer
 from collections import defaultdict
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class BbldplManager:
     WALLET_TIMEOUT = 1800
-    PROC_MIN_WAIT = 60
+    # Maximum time a daemon is given to answer its readiness probe
+    READY_TIMEOUT = 300
+    # Stages recorded in the storage file for each node, in execution order.
+    # NODE_STAGES run per node, NETWORK_STAGES once every node is provisioned.
+    NODE_STAGES = ["container", "wallet", "bbld", "btcwallet", "unlock", "accounts"]
+    NETWORK_STAGES = ["connect", "mining"]
 
-    def __init__(self, image_name, config_file, storage_file):
+    def __init__(self, image_name, config_file, storage_file, parallelism=1,
+            backend="exec", addresses_per_account=1, storage_backend="json",
+            trace=False, snapshot_cache=None, snapshot_budget=None,
+            client_factory=None, allow_overcommit=False):
+        """
+        With `snapshot_cache`, the directory of a SnapshotCache, nodes are
+        snapshotted once their accounts exist and later deployments of the
+        same node spec start from the snapshot. `snapshot_budget` bounds the
+        disk space used by the snapshots, in bytes.
+        `client_factory` replaces the Docker clients of the ContainerManager,
+        see `ContainerManager`.
+        With `allow_overcommit`, nodes whose resources do not fit on their
+        host are deployed with a warning instead of failing the deployment.
+        """
         self.config_file = os.path.abspath(config_file)
         self.storage_file = os.path.abspath(storage_file)
         self.image_name = image_name
+        self.parallelism = max(1, parallelism)
+        self.addresses_per_account = addresses_per_account
+        self.client_factory = client_factory
+        self.allow_overcommit = allow_overcommit
 
         self.node_config = self._read_config(self.config_file)
-        self.storage_config = self._read_json(self.storage_file)
+        self.address_index = AddressIndex(index_filename(self.storage_file))
+        self.storage = open_storage(self.storage_file, storage_backend,
+                index=self.address_index)
+        self.storage_config = self.storage.data
+
+        self.simnet = is_simnet(self.node_config)
+        # Docker hosts the nodes are spread over, the first one is the default
+        self.hosts = self.node_config.get("hosts", [])
+        self.default_host = self.hosts[0]["name"] if self.hosts \
+                else ContainerManager.DEFAULT_HOST
+        if len(self.hosts) > 1:
+            # Fail before deploying anything if a host has no address the
+            # other hosts can reach it on
+            for host in self.hosts:
+                self._get_host_address(host["name"])
 
-        self.simnet = self.node_config["simnet"]
+        # Docker host, host port and resource limits picked for each node
+        # whose container is to be created
+        self.node_hosts = {}
+        self.host_ports = {}
+        self.node_limits = {}
+        self.snapshots = None
+        if snapshot_cache:
+            from bbldpl_manager.snapshot import SnapshotCache
+            self.snapshots = SnapshotCache(snapshot_cache, snapshot_budget)
+        # LogAggregator following the nodes while they are deployed
+        self.log_aggregator = None
 
-        self.container_manager = ContainerManager(self.storage_config)
+        self.tracer = Tracer(enabled=trace)
+        self.container_manager = self.tracer.instrument(
+                self._create_container_manager(backend), "container_manager")
+        if len(self.hosts) > 1:
+            # Fail before deploying anything if the Docker daemon of a host
+            # cannot be reached
+            for host in self.hosts:
+                try:
+                    self.container_manager.ping_host(host["name"])
+                except HostUnreachableError as e:
+                    raise DeploymentError("Cannot reach Docker host {}".format(e))
 
-    def deploy(self):
+    def deploy(self, follow_logs=False):
         """
         For each node:
         1. Check whether it already runs, if yes, throw an error
@@ -34,121 +104,928 @@ class BbldplManager:
         6. Unlock wallet
         7. Generate all accounts and one address for them
         8. Restart the btcd daemon with a mining address and its connections
+
+        Steps 1-7 run concurrently for up to `parallelism` nodes. A node that
+        fails is reported in the summary and does not abort the others.
+        Step 8 starts only after every node has finished steps 1-7.
+
+        Completed stages are recorded in the storage file, so a deployment
+        that was interrupted resumes each node from where it stopped.
+
+        With `follow_logs`, the output of the daemons of every node is
+        printed from the creation of its container until the deployment ends.
         """
-        print("Creating a network {}...".format(self.node_config["network"]["name"]))
-        self.container_manager.create_network(self.node_config["network"]["name"])
+        network_name = self.node_config["network"]["name"]
+        if not self.container_manager.network_exists():
+            print("Creating a network {}...".format(network_name))
+            self.container_manager.create_network(network_name)
 
-        print ("Deploying node(s)...")
-        for node_name, node_info in self.node_config["nodes"].items():
-            if self.container_manager.container_exists(node_name):
-                print("Node {} is already running. Will not re-deploy.".format(node_name))
-                continue
+        with self._following_logs(follow_logs):
+            print ("Deploying node(s)...")
+            with self.tracer.span("phase.deploy"):
+                results = self._deploy_nodes(self.node_config["nodes"])
+            deployed = {node_name: node_info
+                    for node_name, node_info in self.node_config["nodes"].items()
+                    if not results[node_name]}
 
-            ip_mapping = self._get_ip_mapping(node_info)
-            print("{}: Creating container...".format(node_name))
-            self.container_manager.create_container(self.image_name,
-                    node_name, self.node_config["network"]["name"], ip_mapping)
+            self._connect_nodes(deployed)
+            self._start_mining(deployed)
 
-            print("{}: Generating wallet...".format(node_name))
-            self.container_manager.generate_wallet(node_name,
-                    node_info["user"], node_info["pass"], node_info["walletpass"],
-                    simnet=self.simnet)
+        self._finish(results)
 
-            print("{}: Starting bbld daemon...".format(node_name))
-            self.container_manager.start_bbld_daemon(node_name, node_info["user"],
-                    node_info["pass"], node_info["rpcport"],
-                    node_info["port"], simnet=self.simnet)
+    def reconcile(self, follow_logs=False):
+        """
+        Brings the live network in line with the configuration file by
+        applying only the differences between them:
+        - containers of nodes removed from the configuration are destroyed
+        - new (or partially deployed) nodes are deployed
+        - missing accounts are created on existing nodes
+        - bbld is restarted only on nodes whose connections changed
+        `follow_logs` is the one of `deploy`.
+        """
+        network_name = self.node_config["network"]["name"]
+        if not self.container_manager.network_exists():
+            print("Creating a network {}...".format(network_name))
+            self.container_manager.create_network(network_name)
 
-            print("{}: Wait for bbld daemon to come up...".format(node_name))
-            time.sleep(self.PROC_MIN_WAIT)
+        diff = self._diff()
+        self._print_diff(diff)
 
-            print("{}: Starting btcwallet daemon...".format(node_name))
-            self.container_manager.start_btcwallet_daemon(node_name, node_info["user"],
-                    node_info["pass"], simnet=self.simnet)
-            print("{}: Wait for btcwallet daemon to come up...".format(node_name))
-            time.sleep(self.PROC_MIN_WAIT)
+        with self._following_logs(follow_logs):
+            for node_name in diff["removed"]:
+                if self.container_manager.container_exists(node_name):
+                    print("{}: Destroying...".format(node_name))
+                    self.container_manager.destroy_container(node_name)
+                else:
+                    with self.storage.lock:
+                        del self.storage_config[node_name]
+                    self.storage.flush(node_name)
 
-            print("{}: Unlocking wallet...".format(node_name))
-            self.container_manager.unlock_wallet(node_name,
-                    node_info["user"], node_info["pass"],
-                    node_info["walletpass"], self.WALLET_TIMEOUT, simnet=self.simnet)
-            print("{}: Creating accounts...".format(node_name))
-            # "default" is an already existing account name, so generate an address for it as well
-            for account in node_info["accounts"] + ["default"]:
-                if not self.container_manager.account_exists(node_name, node_info["user"],
-                            node_info["pass"], account, simnet=self.node_config["simnet"]):
-                    self.container_manager.add_account(node_name, node_info["user"],
-                            node_info["pass"], account, simnet=self.simnet)
+            results = {}
+            if diff["deploy"]:
+                print ("Deploying node(s)...")
+                results = self._deploy_nodes({node_name: self.node_config["nodes"][node_name]
+                        for node_name in diff["deploy"]})
+
+            for node_name, accounts in diff["accounts"].items():
+                node_info = self.node_config["nodes"][node_name]
+                print("{}: Creating accounts {}...".format(node_name, ", ".join(accounts)))
+                self.container_manager.provision_accounts(node_name,
+                        node_info["user"], node_info["pass"], accounts,
+                        addresses_per_account=self.addresses_per_account,
+                        simnet=self.simnet)
+
+            for node_name in diff["connections"]:
+                self._reset_stages(node_name, ["connect"])
+
+            nodes = {node_name: node_info
+                    for node_name, node_info in self.node_config["nodes"].items()
+                    if not results.get(node_name)}
+            self._connect_nodes(nodes)
+            self._start_mining(nodes)
+
+        self._finish(results)
+
+    def logs(self, lines=10, follow=False, pattern=None):
+        """
+        Prints the last `lines` lines written by bbld and btcwallet on every
+        deployed node, merged by time, then with `follow` the lines they
+        write until interrupted. Only the lines matching the regular
+        expression `pattern` are printed. See `LogAggregator`.
+        """
+        nodes = sorted(node_name for node_name in self.node_config["nodes"]
+                if node_name in self.storage_config)
+        if not nodes:
+            raise DeploymentError("No deployed node to show the logs of")
+        from bbldpl_manager.logs import LogAggregator
+        try:
+            aggregator = LogAggregator(self, lines=lines, pattern=pattern)
+        except re.error as e:
+            raise DeploymentError("Invalid pattern {}: {}".format(pattern, e))
+
+        if follow:
+            aggregator.run(nodes)
+        else:
+            aggregator.show(nodes)
+
+    def plan(self):
+        """
+        Prints the stages a `deploy` would execute for each node, without
+        executing any of them.
+        """
+        if not self.container_manager.network_exists():
+            print("network: create {}".format(self.node_config["network"]["name"]))
 
-                address = self.container_manager.generate_address(node_name, node_info["user"],
-                        node_info["pass"], account, simnet=self.simnet)
-                print("\t\t{} assigned address {}".format(account, address))
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            plans = dict(zip(self.node_config["nodes"],
+                    executor.map(self._plan_node, self.node_config["nodes"])))
 
+        for node_name, stages in plans.items():
+            if stages:
+                print("{}: {}".format(node_name, ", ".join(stages)))
+            else:
+                print("{}: up to date".format(node_name))
+
+    def bench(self, report_file, blocks=10, transactions=100, miner_counts=None,
+            interval=0.5):
+        """
+        Runs a Benchmark against the deployed nodes and writes its report to
+        `report_file` as JSON. See `Benchmark` for the workload.
+        """
+        from bbldpl_manager.bench import Benchmark, write_report
+        benchmark = Benchmark(self, blocks=blocks, transactions=transactions,
+                miner_counts=miner_counts, interval=interval)
+        if not benchmark.nodes:
+            raise DeploymentError("No deployed node to benchmark")
+
+        with self.tracer.span("phase.bench"):
+            report = benchmark.run()
+        write_report(report, report_file)
+
+        print("Summary:")
+        for run in report["runs"]:
+            blocks_report = run["blocks"]
+            transactions_report = run["transactions"]
+            propagation = blocks_report["propagation_delay"] or {}
+            print("\t{} miner(s): {:.2f} blocks/s, {:.2f} tx/s, propagation p50 {} p99 {}".format(
+                    len(run["miners"]), blocks_report["blocks_per_second"] or 0,
+                    transactions_report["transactions_per_second"] or 0,
+                    _format_seconds(propagation.get("p50")),
+                    _format_seconds(propagation.get("p99"))))
+        print("Wrote report to {}".format(report_file))
+
+    def monitor(self, interval=15, address="127.0.0.1", port=9332):
+        """
+        Polls the deployed nodes every `interval` seconds and serves their
+        metrics on http://`address`:`port`/metrics until interrupted. See
+        `Monitor`.
+        """
+        from bbldpl_manager.monitor import Monitor
+        monitor = Monitor(self, interval=interval, address=address, port=port)
+        if not monitor.nodes:
+            raise DeploymentError("No deployed node to monitor")
+        monitor.run()
+
+    def supervise(self, interval=10, max_backoff=300):
+        """
+        Restarts the bbld and btcwallet daemons of the deployed nodes when
+        they crash, checking them every `interval` seconds, until
+        interrupted. See `Supervisor`.
+        """
+        from bbldpl_manager.supervise import Supervisor
+        supervisor = Supervisor(self, interval=interval, max_backoff=max_backoff)
+        if not supervisor.nodes:
+            raise DeploymentError("No deployed node to supervise")
+        supervisor.run()
+
+    def destroy(self, stop_timeout=None, force=False):
+        """
+        Destroys the container of every node, `parallelism` nodes at a time,
+        then the network. `stop_timeout` and `force` are passed to
+        `ContainerManager.destroy_container`. Containers that are already gone
+        are reported and their storage records dropped.
+        """
+        print("Destroying node(s)...")
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = {
+                executor.submit(self._destroy_node, node_name, stop_timeout, force): node_name
+                for node_name in self.node_config["nodes"]
+            }
+            for future in as_completed(futures):
+                node_name = futures[future]
+                try:
+                    results[node_name] = future.result()
+                except Exception as e:
+                    print("{}: Destruction failed: {!r}".format(node_name, e))
+                    results[node_name] = ("failed", 0, e)
+
+        print("Destroying network...")
+        try:
+            self.container_manager.destroy_network()
+        except NetworkNotFoundException as e:
+            print("{}, skipping".format(e))
+
+        self.flush_storage()
+
+        print("Summary:")
+        for node_name in sorted(results):
+            status, elapsed, error = results[node_name]
+            if error:
+                print("\t{}: {} ({!r})".format(node_name, status, error))
+            else:
+                print("\t{}: {} in {:.1f}s".format(node_name, status, elapsed))
+        failed = [node_name for node_name, result in results.items() if result[2]]
+        if failed:
+            raise DeploymentError("Failed to destroy node(s): {}".format(
+                ", ".join(sorted(failed))))
+        print("Done")
 
+    def export_trace(self, filename, trace_format=None):
+        """
+        Writes the recorded spans to `filename` and prints the slowest
+        stages per node.
+        """
+        self.tracer.export(filename, trace_format)
+        self.tracer.print_report()
+
+    def flush_storage(self):
+        """
+        Dumps the storage on the specified storage file.
+        """
+        self.storage.flush()
+
+    ########### Internal Methods ###########
+
+    def _create_container_manager(self, backend):
+        return ContainerManager(self.storage_config, backend=backend,
+                storage=self.storage, tracer=self.tracer, hosts=self.hosts,
+                client_factory=self.client_factory)
+
+    def _deploy_nodes(self, nodes):
+        """
+        Runs `_deploy_node` for every node in `nodes` on a pool of
+        `parallelism` threads. Returns a mapping of node names to the
+        exception that aborted their deployment, or None if it succeeded.
+        Every node is placed on a Docker host, and its host port and
+        resources checked, before any container is created.
+        """
+        new_nodes = {node_name: node_info for node_name, node_info in nodes.items()
+                if not self.container_manager.container_exists(node_name)}
+        if new_nodes:
+            self._place_nodes(new_nodes, self.container_manager.get_host_loads
+                    if len(self.hosts) > 1 else None)
+            hosts = set(self.node_hosts[node_name] for node_name in new_nodes)
+            self._assign_host_ports(new_nodes, {host:
+                    self.container_manager.get_published_ports(host) for host in hosts})
+            self._assign_resources(new_nodes)
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = {
+                executor.submit(self._deploy_node, node_name, node_info): node_name
+                for node_name, node_info in nodes.items()
+            }
+            for future in as_completed(futures):
+                node_name = futures[future]
+                try:
+                    future.result()
+                    results[node_name] = None
+                except Exception as e:
+                    print("{}: Deployment failed: {!r}".format(node_name, e))
+                    results[node_name] = e
+        return results
+
+    def _destroy_node(self, node_name, stop_timeout, force):
+        """
+        Returns a `(status, seconds, error)` tuple describing what happened
+        to the container of `node_name`.
+        """
+        start = time.monotonic()
+        with self.tracer.span("stage.destroy", node=node_name):
+            if not self.container_manager.container_exists(node_name):
+                print("Node {} is not running.".format(node_name))
+                self.container_manager.forget_container(node_name)
+                return ("not running", 0, None)
+
+            print("{}: Destroying...".format(node_name))
+            removed = self.container_manager.destroy_container(node_name,
+                    stop_timeout=stop_timeout, force=force)
+        status = "destroyed" if removed else "already gone"
+        return (status, time.monotonic() - start, None)
+
+    def _connect_nodes(self, nodes):
+        """
+        Restarts bbld with its mining address and connections on every node
+        of `nodes` whose connections are not applied yet. The nodes are
+        restarted in waves (see `_get_restart_waves`), each wave once the
+        previous one answers RPC calls. The connect stage of a node completes
+        once its bbld has an outbound connection to each of its peers in
+        `nodes`.
+        """
         print("Connecting nodes...")
         connections_per_node = self._get_connections_per_node()
-        for node_name, node_info in self.node_config["nodes"].items():
-            print("{}: Restarting bbld daemon...".format(node_name))
+        restarted = {node_name: node_info
+                for node_name, node_info in nodes.items()
+                if self._needs_connect(node_name, connections_per_node[node_name])}
+
+        waves = self._get_restart_waves(restarted)
+        for number, wave in enumerate(waves, 1):
+            print("Restarting wave {}/{}: {}".format(number, len(waves), ", ".join(wave)))
+            self._run_per_node(wave, lambda node_name: self._restart_bbld(node_name,
+                    restarted[node_name], connections_per_node[node_name]))
+
+        peers_per_node = self._get_peer_counts(nodes)
+
+        def connect(node_name):
+            node_info = restarted[node_name]
+            with self._stage(node_name, "connect"):
+                self.container_manager.wait_for_peers(node_name, node_info["user"],
+                        node_info["pass"], peers_per_node[node_name], simnet=self.simnet,
+                        timeout=self.READY_TIMEOUT)
+                with self.storage.lock:
+                    self.storage_config[node_name]["connections"] = \
+                            connections_per_node[node_name]
+                self._reset_stages(node_name, ["mining"])
+
+        print("Waiting for peers to connect...")
+        self._run_per_node(restarted, connect)
+
+    def _get_peer_counts(self, nodes):
+        """
+        Returns the number of internal connections of every node with the
+        other nodes of `nodes`.
+        """
+        peers = defaultdict(int)
+        for node1, node2 in self.node_config["connections"]["internal"]:
+            if node1 in nodes and node2 in nodes:
+                peers[node1] += 1
+                peers[node2] += 1
+        return peers
+
+    def _needs_connect(self, node_name, connections):
+        if not self._stage_done(node_name, "connect"):
+            return True
+        applied = self.storage_config.get(node_name, {}).get("connections")
+        return applied is not None and sorted(applied) != sorted(connections)
+
+    def _get_restart_waves(self, nodes):
+        """
+        Splits `nodes` into waves of nodes that are not connected to each
+        other, by greedy coloring of the internal connection graph, most
+        connected nodes first. Restarting a wave never takes both ends of a
+        connection down, and the hubs the other nodes dial are up first.
+        """
+        neighbours = {node_name: set() for node_name in nodes}
+        for node1, node2 in self.node_config["connections"]["internal"]:
+            if node1 in neighbours and node2 in neighbours:
+                neighbours[node1].add(node2)
+                neighbours[node2].add(node1)
+
+        colors = {}
+        for node_name in sorted(neighbours,
+                key=lambda name: (-len(neighbours[name]), name)):
+            used = {colors[neighbour] for neighbour in neighbours[node_name]
+                    if neighbour in colors}
+            colors[node_name] = next(color for color in range(len(neighbours) + 1)
+                    if color not in used)
+
+        waves = defaultdict(list)
+        for node_name, color in colors.items():
+            waves[color].append(node_name)
+        return [sorted(waves[color]) for color in sorted(waves)]
+
+    def _restart_bbld(self, node_name, node_info, connections):
+        print("{}: Restarting bbld daemon...".format(node_name))
+        self._follow_logs(node_name)
+        with self.tracer.span("stage.restart", node=node_name):
+            mining_address = self.container_manager.get_first_address(node_name,
+                    node_info["user"], node_info["pass"],
+                    node_info["miningaccount"], simnet=self.simnet)
             self.container_manager.kill_bbld_daemon(node_name)
             self.container_manager.start_bbld_daemon(node_name,
                     node_info["user"], node_info["pass"],
                     node_info["rpcport"], node_info["port"],
-                    mining_address=self.container_manager.get_first_address(node_name,
-                            node_info["user"], node_info["pass"],
-                            node_info["miningaccount"], simnet=self.simnet),
-                    connections=connections_per_node[node_name],
+                    mining_address=mining_address, connections=connections,
                     simnet=self.simnet)
-        print("Wait for bbld nodes to restart".format(node_name))
-        time.sleep(self.PROC_MIN_WAIT * 2)
+            self.container_manager.wait_for_bbld_ready(node_name,
+                    node_info["user"], node_info["pass"], simnet=self.simnet,
+                    timeout=self.READY_TIMEOUT)
+
+    def _run_per_node(self, node_names, function):
+        """
+        Calls `function(node_name)` for every node on a pool of `parallelism`
+        threads, then raises the first error raised, if any.
+        """
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = [executor.submit(function, node_name)
+                    for node_name in node_names]
+        for future in futures:
+            future.result()
 
+    def _start_mining(self, nodes):
         print("Starting mining...")
-        for node_name, node_info in self.node_config["nodes"].items():
+        for node_name, node_info in nodes.items():
+            if self._stage_done(node_name, "mining"):
+                continue
             print("{}: Starting Mining...".format(node_name))
-            self.container_manager.start_mining(node_name,
-                    node_info["user"], node_info["pass"],
-                    simnet=self.simnet)
+            with self._stage(node_name, "mining"):
+                self.container_manager.start_mining(node_name,
+                        node_info["user"], node_info["pass"],
+                        simnet=self.simnet)
 
+    def _finish(self, results):
+        if results:
+            self._print_summary(results)
+        failed = [node_name for node_name, error in results.items() if error]
+        if failed:
+            raise DeploymentError("Failed to deploy node(s): {}".format(
+                ", ".join(sorted(failed))))
         print("Done!")
 
-    def destroy(self):
+    def _diff(self):
         """
-        Iterates through each node and destroys its corresponding container.
+        Compares the configuration with the live network. Returns a mapping
+        with the nodes to destroy (`removed`), the nodes with deployment
+        stages left (`deploy`), the accounts missing per deployed node
+        (`accounts`) and the nodes whose bbld connections differ from the
+        configured ones (`connections`).
         """
-        print("Destroying node(s)...")
-        for node_name, node_info in self.node_config["nodes"].items():
-            if not self.container_manager.container_exists(node_name):
-                print("Node {} is not running.".format(node_name))
-                continue
+        nodes = self.node_config["nodes"]
+        connections_per_node = self._get_connections_per_node()
+        diff = {
+            "removed": [node_name for node_name in self._get_stored_nodes()
+                    if node_name not in nodes],
+            "deploy": [],
+            "accounts": {},
+            "connections": []
+        }
 
-            print("{}: Destroying...".format(node_name))
-            self.container_manager.destroy_container(node_name)
+        def diff_node(node_name):
+            if set(self._plan_node(node_name)) & set(self.NODE_STAGES):
+                return node_name, True, [], False
+            node_info = nodes[node_name]
+            existing = self.container_manager.list_accounts(node_name,
+                    node_info["user"], node_info["pass"], simnet=self.simnet)
+            missing = [account for account in node_info["accounts"]
+                    if account not in existing]
+            applied = self.storage_config[node_name].get("connections")
+            changed = applied is None or \
+                    sorted(applied) != sorted(connections_per_node[node_name])
+            return node_name, False, missing, changed
 
-        print("Destroying network...")
-        self.container_manager.destroy_network()
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            for node_name, deploy, missing, changed in executor.map(diff_node, nodes):
+                if deploy:
+                    diff["deploy"].append(node_name)
+                if missing:
+                    diff["accounts"][node_name] = missing
+                if changed:
+                    diff["connections"].append(node_name)
+        return diff
 
-        self.flush_storage()
-        print("Done")
+    def _print_diff(self, diff):
+        if not any(diff.values()):
+            print("Network is up to date")
+        for node_name in diff["removed"]:
+            print("{}: remove".format(node_name))
+        for node_name in diff["deploy"]:
+            print("{}: deploy".format(node_name))
+        for node_name, accounts in diff["accounts"].items():
+            print("{}: add accounts {}".format(node_name, ", ".join(accounts)))
+        for node_name in diff["connections"]:
+            print("{}: reconnect".format(node_name))
 
-    def flush_storage(self):
+    def _get_stored_nodes(self):
+        return [key for key, value in self.storage_config.items()
+                if isinstance(value, dict) and "containerID" in value]
+
+    def _deploy_node(self, node_name, node_info):
         """
-        Dumps the storage on the specified storage file.
+        Runs the per node part of the deployment, from the creation of the
+        container up to the creation of its accounts. Executed on a worker
+        thread, so every message is prefixed with the node name.
+        Stages that have already been completed are skipped.
         """
-        with open(self.storage_file, "w+") as f:
-            f.write(json.dumps(self.container_manager.get_storage()))
+        stages = self._plan_node(node_name)
+        if not set(stages) & set(self.NODE_STAGES):
+            print("Node {} is already running. Will not re-deploy.".format(node_name))
+            self._follow_logs(node_name)
+            return
+        if not "container" in stages:
+            print("{}: Resuming with stage(s) {}".format(node_name, ", ".join(stages)))
 
-    ########### Internal Methods ###########
+        snapshot = None
+        if "container" in stages:
+            with self._stage(node_name, "container"):
+                ip_mapping = self._get_ip_mapping(node_name, node_info)
+                snapshot = self._find_snapshot(node_name, node_info)
+                if snapshot:
+                    print("{}: Creating container from snapshot {}...".format(
+                            node_name, snapshot["image"]))
+                    self.container_manager.create_container(snapshot["image"],
+                            node_name, self.node_config["network"]["name"], ip_mapping,
+                            host=self._get_node_host(node_name),
+                            resources=self.node_limits.get(node_name))
+                    self._restore_snapshot(node_name, snapshot)
+                    stages = [stage for stage in stages if not self._stage_done(
+                            node_name, stage)]
+                else:
+                    print("{}: Creating container...".format(node_name))
+                    self.container_manager.create_container(self.image_name,
+                            node_name, self.node_config["network"]["name"], ip_mapping,
+                            host=self._get_node_host(node_name),
+                            resources=self.node_limits.get(node_name))
+                self._record_host_port(node_name, ip_mapping)
+        self._follow_logs(node_name)
+
+        if "wallet" in stages:
+            with self._stage(node_name, "wallet"):
+                print("{}: Generating wallet...".format(node_name))
+                self.container_manager.generate_wallet(node_name,
+                        node_info["user"], node_info["pass"], node_info["walletpass"],
+                        simnet=self.simnet)
+
+        if "bbld" in stages:
+            with self._stage(node_name, "bbld"):
+                print("{}: Starting bbld daemon...".format(node_name))
+                self.container_manager.start_bbld_daemon(node_name, node_info["user"],
+                        node_info["pass"], node_info["rpcport"],
+                        node_info["port"], simnet=self.simnet)
+
+                print("{}: Wait for bbld daemon to come up...".format(node_name))
+                latency = self.container_manager.wait_for_bbld_ready(node_name,
+                        node_info["user"], node_info["pass"], simnet=self.simnet,
+                        timeout=self.READY_TIMEOUT)
+                print("{}: bbld daemon ready after {:.1f}s".format(node_name, latency))
+                # A fresh bbld is neither connected nor mining
+                self._reset_stages(node_name, ["connect", "mining"])
 
-    def _get_ip_mapping(self, info):
+        if "btcwallet" in stages:
+            with self._stage(node_name, "btcwallet"):
+                print("{}: Starting btcwallet daemon...".format(node_name))
+                self.container_manager.start_btcwallet_daemon(node_name, node_info["user"],
+                        node_info["pass"], simnet=self.simnet)
+                print("{}: Wait for btcwallet daemon to come up...".format(node_name))
+                latency = self.container_manager.wait_for_btcwallet_ready(node_name,
+                        node_info["user"], node_info["pass"], simnet=self.simnet,
+                        timeout=self.READY_TIMEOUT)
+                print("{}: btcwallet daemon ready after {:.1f}s".format(node_name, latency))
+
+        if "unlock" in stages:
+            with self._stage(node_name, "unlock"):
+                print("{}: Unlocking wallet...".format(node_name))
+                self.container_manager.unlock_wallet(node_name,
+                        node_info["user"], node_info["pass"],
+                        node_info["walletpass"], self.WALLET_TIMEOUT, simnet=self.simnet)
+
+        if "accounts" in stages:
+            with self._stage(node_name, "accounts"):
+                print("{}: Creating accounts...".format(node_name))
+                # "default" is an already existing account name, so generate an address for it as well
+                generated = self.container_manager.provision_accounts(node_name,
+                        node_info["user"], node_info["pass"],
+                        node_info["accounts"] + ["default"],
+                        addresses_per_account=self.addresses_per_account,
+                        simnet=self.simnet)
+                for account, addresses in generated.items():
+                    if len(addresses) == 1:
+                        print("\t\t{}: {} assigned address {}".format(node_name,
+                                account, addresses[0]))
+                    else:
+                        print("\t\t{}: {} assigned {} addresses".format(node_name,
+                                account, len(addresses)))
+
+            if self.snapshots and not snapshot:
+                self._save_snapshot(node_name, node_info)
+
+    def _plan_node(self, node_name):
+        """
+        Returns the stages, in execution order, that a deployment still has to
+        run for `node_name`. Stages that started a daemon are run again if the
+        daemon is no longer alive. Nodes deployed before stages were recorded
+        are considered complete.
+        """
+        if not self.container_manager.container_exists(node_name):
+            return self.NODE_STAGES + self.NETWORK_STAGES
+
+        done = set(self._get_stages(node_name))
+        if "bbld" in done and not self.container_manager.daemon_running(
+                node_name, "bbld"):
+            done -= {"bbld", "connect", "mining"}
+        if "btcwallet" in done and not self.container_manager.daemon_running(
+                node_name, "btcwallet"):
+            done -= {"btcwallet", "unlock"}
+
+        return [stage for stage in self.NODE_STAGES + self.NETWORK_STAGES
+                if stage not in done]
+
+    def _get_snapshot_key(self, node_name, node_info):
+        options = {}
+        if len(self.hosts) > 1:
+            # Snapshot images only exist on the host they were taken on
+            options["host"] = self._get_node_host(node_name)
+        return self.snapshots.get_key(self.image_name, node_name, node_info,
+                simnet=self.simnet, addresses_per_account=self.addresses_per_account,
+                **options)
+
+    def _find_snapshot(self, node_name, node_info):
+        """
+        Returns the snapshot cache entry matching the spec of `node_name`,
+        or None if there is none or its image has been removed.
+        """
+        if not self.snapshots:
+            return None
+        key = self._get_snapshot_key(node_name, node_info)
+        snapshot = self.snapshots.lookup(key)
+        if snapshot and not self.container_manager.image_exists(snapshot["image"],
+                host=self._get_node_host(node_name)):
+            self.snapshots.remove(key)
+            return None
+        return snapshot
+
+    def _restore_snapshot(self, node_name, snapshot):
+        """
+        Copies the wallet and accounts recorded with `snapshot` into the
+        storage record of `node_name`, whose container already holds them.
+        """
+        node_storage = self.storage_config[node_name]
+        with self.storage.lock:
+            node_storage.update(json.loads(json.dumps(snapshot["record"])))
+        for stage in ["wallet", "accounts"]:
+            self._complete_stage(node_name, stage)
+
+    def _save_snapshot(self, node_name, node_info):
+        """
+        Commits the container of `node_name` to the snapshot cache. A
+        failure only costs the snapshot, not the deployment.
+        """
+        key = self._get_snapshot_key(node_name, node_info)
+        image = self.snapshots.get_image(key)
+        print("{}: Saving snapshot {}...".format(node_name, image))
+        try:
+            with self.tracer.span("stage.snapshot", node=node_name):
+                size = self.container_manager.commit_container(node_name, image)
+                record = {field: self.storage_config[node_name][field]
+                        for field in ["accounts", "wallet"]}
+                for evicted in self.snapshots.add(key, size,
+                        json.loads(json.dumps(record)), host=self._get_node_host(node_name)):
+                    print("{}: Evicting snapshot {}".format(node_name, evicted["image"]))
+                    self.container_manager.remove_image(evicted["image"],
+                            host=evicted.get("host"))
+        except Exception as e:
+            print("{}: Could not save snapshot: {!r}".format(node_name, e))
+
+    @contextmanager
+    def _stage(self, node_name, stage):
+        """
+        Times the stage `stage` of `node_name` and records it as completed
+        if the block finishes without raising.
+        """
+        with self.tracer.span("stage." + stage, node=node_name):
+            yield
+        self._complete_stage(node_name, stage)
+
+    def _get_stages(self, node_name):
+        node_storage = self.storage_config.get(node_name, {})
+        return node_storage.get("stages", self.NODE_STAGES + self.NETWORK_STAGES)
+
+    def _stage_done(self, node_name, stage):
+        return stage in self._get_stages(node_name)
+
+    def _complete_stage(self, node_name, stage):
+        with self.storage.lock:
+            stages = self.storage_config[node_name].setdefault("stages", [])
+            if stage not in stages:
+                stages.append(stage)
+        self.storage.flush(node_name)
+
+    def _reset_stages(self, node_name, stages):
+        with self.storage.lock:
+            self.storage_config[node_name]["stages"] = [stage
+                    for stage in self._get_stages(node_name) if stage not in stages]
+        self.storage.flush(node_name)
+
+    @contextmanager
+    def _following_logs(self, enabled):
+        """
+        Sets up a LogAggregator that `_deploy_node` asks to follow each node,
+        if `enabled`, and stops it on exit.
+        """
+        if not enabled:
+            yield
+            return
+        from bbldpl_manager.logs import LogAggregator
+        self.log_aggregator = LogAggregator(self, lines=0)
+        self.log_aggregator.start()
+        try:
+            yield
+        finally:
+            self.log_aggregator.stop()
+            self.log_aggregator = None
+
+    def _follow_logs(self, node_name):
+        if self.log_aggregator:
+            self.log_aggregator.follow(node_name)
+
+    def _print_summary(self, results):
+        """
+        `results` maps node names to the exception that aborted their
+        deployment, or None if it succeeded.
+        """
+        print("Summary:")
+        for node_name in sorted(results):
+            error = results[node_name]
+            if error:
+                print("\t{}: FAILED ({!r})".format(node_name, error))
+            else:
+                print("\t{}: OK".format(node_name))
+
+    def _get_ip_mapping(self, node_name, info):
         """
         `info` corresponds to a node configuration object.
         This method returns a mapping between the container port specified on
-        the configuration (typically 18555) and a user defined port on the host.
-        The communication happens via the TCP protocol.
+        the configuration (typically 18555) and a port on the host: the one
+        picked by `_assign_host_ports`, the one recorded for the node, or the
+        user defined one. The communication happens via the TCP protocol.
         """
+        hostport = self.host_ports.get(node_name) \
+                or self.storage_config.get(node_name, {}).get("hostport") \
+                or info["hostport"]
         return {
-            info["port"]+"/tcp": info["hostport"]
+            info["port"]+"/tcp": str(hostport)
         }
 
+    def _place_nodes(self, nodes, get_loads=None):
+        """
+        Picks the Docker host of every node of `nodes`, which have no
+        container yet: the `host` of its configuration, or the host with the
+        most room left according to the `capacity` of the hosts and the
+        containers they hold, as returned by `get_loads`.
+        """
+        if not get_loads:
+            for node_name, node_info in nodes.items():
+                self.node_hosts[node_name] = node_info.get("host", self.default_host)
+            return
+
+        from bbldpl_manager.placement import PlacementError, place_nodes
+        capacities = {host["name"]: host.get("capacity", float("inf"))
+                for host in self.hosts}
+        try:
+            placement = place_nodes(list(nodes), capacities, get_loads(),
+                    pinned={node_name: node_info["host"]
+                            for node_name, node_info in nodes.items() if "host" in node_info})
+        except PlacementError as e:
+            raise DeploymentError(str(e))
+        for node_name, host in placement.items():
+            print("{}: Placed on host {}".format(node_name, host))
+        self.node_hosts.update(placement)
+
+    def _get_node_host(self, node_name):
+        return self.node_hosts.get(node_name) \
+                or self.storage_config.get(node_name, {}).get("host") \
+                or self.default_host
+
+    def _assign_host_ports(self, nodes, published):
+        """
+        Picks the host port of every node of `nodes`, which have no container
+        yet: its configured `hostport`, or the next free port of its Docker
+        host if it has none. `published` maps each host to the ports published
+        by its running containers and their holder. Every conflict is reported
+        at once, before any container is created.
+        """
+        allocators = {}
+        for host, ports in published.items():
+            local = self._is_local_host(host)
+            used = dict.fromkeys(get_listening_ports(), "a process on the host") \
+                    if local else {}
+            used.update(ports)
+            allocators[host] = PortAllocator(used, probe=local)
+
+        conflicts = []
+        for node_name, node_info in nodes.items():
+            if node_info.get("hostport"):
+                try:
+                    self.host_ports[node_name] = allocators[self._get_node_host(
+                            node_name)].reserve(node_info["hostport"], node_name)
+                except PortConflictError as e:
+                    conflicts.append(str(e))
+        for node_name, node_info in nodes.items():
+            if not node_info.get("hostport"):
+                try:
+                    self.host_ports[node_name] = allocators[self._get_node_host(
+                            node_name)].allocate(node_name)
+                except PortConflictError as e:
+                    conflicts.append(str(e))
+        if conflicts:
+            raise DeploymentError("Host port conflict(s):\n\t{}".format(
+                    "\n\t".join(conflicts)))
+        for node_name, node_info in nodes.items():
+            if not node_info.get("hostport"):
+                print("{}: Assigned host port {}".format(node_name,
+                        self.host_ports[node_name]))
+
+    def _assign_resources(self, nodes):
+        """
+        Computes the resource limits of every node of `nodes`, which have no
+        container yet, from the default and node `resources` of the
+        configuration. Nodes asking for a number of `cores` are pinned to
+        CPUs of their host by `pack_nodes`, according to the NUMA layout of
+        the host: its configured `numa` CPU lists, the one of this machine
+        for a local host, or a single NUMA node. The CPUs, memory and CPU
+        quota of each host must not be overcommitted by the new nodes and the
+        containers it already holds, unless `allow_overcommit` is set.
+        """
+        defaults = self.node_config.get("resources")
+        specs = {node_name: node_resources(defaults, node_info)
+                for node_name, node_info in nodes.items()}
+        if not any(specs.values()):
+            return
+
+        nodes_per_host = defaultdict(list)
+        for node_name in nodes:
+            nodes_per_host[self._get_node_host(node_name)].append(node_name)
+
+        problems = []
+        warnings = []
+        cpusets = {}
+        for host, node_names in sorted(nodes_per_host.items()):
+            resources = self.container_manager.get_host_resources(host)
+            numa_nodes = self._get_numa_nodes(host, resources["cpus"])
+            host_cpus = set(cpu for numa_node in numa_nodes for cpu in numa_node)
+            used = [cpu for cpuset in resources["cpusets"]
+                    for cpu in parse_cpulist(cpuset)]
+            for node_name in node_names:
+                if "cpuset" not in specs[node_name]:
+                    continue
+                cpus = parse_cpulist(specs[node_name]["cpuset"])
+                if not set(cpus) <= host_cpus:
+                    problems.append("{}: cpuset {} is not within the CPUs {} of host {}".format(
+                            node_name, specs[node_name]["cpuset"],
+                            format_cpulist(host_cpus), host))
+                shared = sorted(set(cpus) & set(used))
+                if shared:
+                    message = "{}: CPUs {} are already pinned".format(node_name,
+                            format_cpulist(shared))
+                    (warnings if self.allow_overcommit else problems).append(message)
+                used += cpus
+            try:
+                placement, packing_warnings = pack_nodes(
+                        {node_name: specs[node_name]["cores"]
+                                for node_name in node_names if "cores" in specs[node_name]},
+                        numa_nodes, used=used, overcommit=self.allow_overcommit)
+                cpusets.update(placement)
+                warnings += packing_warnings
+            except ResourceError as e:
+                problems.append(str(e))
+
+            total = {"memory": resources["memory_limits"],
+                    "cpus": resources["nano_cpus"] / 1e9}
+            for node_name in node_names:
+                spec = specs[node_name]
+                if "memory" in spec:
+                    total["memory"] += parse_memory(spec["memory"])
+                if "cpus" in spec:
+                    total["cpus"] += spec["cpus"]
+            overcommitted = []
+            if total["memory"] > resources["memory"]:
+                overcommitted.append("memory limits add up to {} MB out of {} MB".format(
+                        total["memory"] // 1024 ** 2, resources["memory"] // 1024 ** 2))
+            if total["cpus"] > resources["cpus"]:
+                overcommitted.append("CPU quotas add up to {:g} CPUs out of {}".format(
+                        total["cpus"], resources["cpus"]))
+            for message in overcommitted:
+                message = "host {}: {}".format(host, message)
+                (warnings if self.allow_overcommit else problems).append(message)
+
+        for warning in warnings:
+            print("Warning: {}".format(warning))
+        if problems:
+            raise DeploymentError("Resource overcommit(s), see --allow-overcommit:"
+                    "\n\t{}".format("\n\t".join(problems)))
+
+        for node_name, spec in specs.items():
+            self.node_limits[node_name] = docker_limits(spec, cpusets.get(node_name))
+            if node_name in cpusets:
+                print("{}: Pinned to CPUs {}".format(node_name,
+                        format_cpulist(cpusets[node_name])))
+
+    def _get_numa_nodes(self, host, cpus):
+        """
+        Returns the CPUs of each NUMA node of `host`, which has `cpus` CPUs.
+        """
+        config = {config["name"]: config for config in self.hosts}.get(host, {})
+        if config.get("numa"):
+            return [parse_cpulist(cpulist) for cpulist in config["numa"]]
+        if self._is_local_host(host):
+            numa_nodes = get_local_numa_nodes()
+            # The daemon may run in a virtual machine with other CPUs
+            if numa_nodes and sum(len(node) for node in numa_nodes) == cpus:
+                return numa_nodes
+        return [list(range(cpus))]
+
+    def _is_local_host(self, host):
+        url = {config["name"]: config for config in self.hosts}.get(host, {}).get("url")
+        return not url or url.startswith("unix://") \
+                or urlparse(url).hostname in ("localhost", "127.0.0.1")
+
+    def _get_host_address(self, host):
+        """
+        Returns the address the containers of other hosts reach `host` on:
+        its configured `address`, or the host name of its Docker URL.
+        """
+        config = {config["name"]: config for config in self.hosts}[host]
+        address = config.get("address") or urlparse(config["url"]).hostname
+        if not address:
+            raise DeploymentError("Host {} needs an address reachable from the "
+                    "other hosts".format(host))
+        return address
+
+    def _record_host_port(self, node_name, ip_mapping):
+        with self.storage.lock:
+            self.storage_config[node_name]["hostport"] = next(iter(ip_mapping.values()))
+        self.storage.flush(node_name)
+
     def _get_connections_per_node(self):
         """
         Iterates through the connections specified on the configuration file
@@ -157,10 +1034,20 @@ class BbldplManager:
         Since we have created our own network and have given nodes specific
         names, we do not need to assign IP addresses, but only use the node names.
         """
+        nodes = self.node_config["nodes"]
+
+        def address(node_name, peer):
+            # Nodes on other Docker hosts are reached on their published port
+            peer_host = self._get_node_host(peer)
+            if self._get_node_host(node_name) == peer_host:
+                return "{}:{}".format(peer, nodes[peer]["port"])
+            return "{}:{}".format(self._get_host_address(peer_host),
+                    next(iter(self._get_ip_mapping(peer, nodes[peer]).values())))
+
         connections_per_node = defaultdict(list)
         for node1, node2 in self.node_config["connections"]["internal"]:
-            connections_per_node[node1].append(node2 + ":" + self.node_config["nodes"][node2]["port"])
-            connections_per_node[node2].append(node1 + ":" + self.node_config["nodes"][node1]["port"])
+            connections_per_node[node1].append(address(node1, node2))
+            connections_per_node[node2].append(address(node2, node1))
         for node1, node2 in self.node_config["connections"]["external"]:
             connections_per_node[node1].append(node2)
         return connections_per_node
@@ -169,7 +1056,15 @@ class BbldplManager:
         if not os.path.exists(config_file):
             print("Configuration file {} does not exist".format(config_file))
             sys.exit(1)
-        return self._read_json(config_file)
+        config = self._read_json(config_file)
+        # Catch mistakes before any container is created for them
+        errors = validate_config(config)
+        if errors:
+            print("Configuration file {} is invalid:".format(config_file))
+            for error in errors:
+                print("\t{}".format(error))
+            sys.exit(1)
+        return normalize_config(config)
 
     def _read_json(self, filename):
         if not os.path.exists(filename):
@@ -177,3 +1072,10 @@ class BbldplManager:
 
         with open(filename, "r") as f:
             return json.load(f)
+
+def _format_seconds(value):
+    return "{:.3f}s".format(value) if value is not None else "n/a"
+
+#### Exception definitions
+class DeploymentError(Exception):
+    pass
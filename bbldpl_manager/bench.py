@@ -0,0 +1,331 @@
+import json
+import math
+import random
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+class Benchmark:
+    """
+    Drives a deployed network through a scripted workload and measures it.
+    For each miner set (the first `k` nodes, for every `k` of
+    `miner_counts`) it generates `blocks` blocks round-robin on the miners,
+    waits for them to reach every node, then sends `transactions`
+    transactions from the miners to addresses of the other nodes and mines
+    them. Block heights and mempool sizes are sampled on every node every
+    `interval` seconds in the background; block propagation delays are
+    derived from these samples, so their resolution is `interval`.
+    """
+    COINBASE_MATURITY = 100
+    PROPAGATION_TIMEOUT = 60
+    MAX_CONFIRMATION_BLOCKS = 10
+
+    def __init__(self, manager, blocks=10, transactions=100, miner_counts=None,
+            interval=0.5, amount=0.01, seed=None):
+        self.manager = manager
+        self.container_manager = manager.container_manager
+        self.nodes = sorted(node_name for node_name in manager.node_config["nodes"]
+                if node_name in manager.storage_config)
+        self.blocks = blocks
+        self.transactions = transactions
+        self.miner_counts = miner_counts or [len(self.nodes)]
+        self.amount = amount
+        self.rng = random.Random(seed)
+        self.sampler = Sampler(self._call, self.nodes, interval, manager.parallelism)
+
+    def run(self):
+        """
+        Runs the workload for every miner set and returns the report. Mining
+        is stopped during the benchmark and restarted afterwards on the
+        nodes that were mining.
+        """
+        if not self.nodes:
+            raise ValueError("No deployed node to benchmark")
+
+        print("Stopping mining...")
+        self._each(self.nodes, lambda node_name: self._mining(node_name, False))
+        started = time.time()
+        self.sampler.start()
+        runs = []
+        try:
+            for count in self.miner_counts:
+                miners = self.nodes[:max(1, min(count, len(self.nodes)))]
+                print("Benchmarking with {} miner(s)...".format(len(miners)))
+                runs.append(self._run(miners))
+        finally:
+            self.sampler.stop()
+            mining = [node_name for node_name in self.nodes
+                    if self.manager._stage_done(node_name, "mining")]
+            print("Restarting mining...")
+            self._each(mining, lambda node_name: self._mining(node_name, True))
+
+        return {
+            "started": started,
+            "nodes": len(self.nodes),
+            "blocks": self.blocks,
+            "transactions": self.transactions,
+            "interval": self.sampler.interval,
+            "runs": runs,
+            "samples": self.sampler.samples
+        }
+
+    ############# Internal methods ############
+
+    def _run(self, miners):
+        start = time.monotonic()
+        report = {"miners": miners}
+        report["blocks"] = self._generate_blocks(miners)
+        report["transactions"] = self._send_transactions(miners)
+        report["mempool"] = {
+            "max": max([sample["mempool"] for sample in self.sampler.samples_since(start)
+                    if sample["mempool"] is not None], default=0)
+        }
+        return report
+
+    def _generate_blocks(self, miners):
+        created = []
+        latencies = []
+        start = time.monotonic()
+        for i in range(self.blocks):
+            miner = miners[i % len(miners)]
+            before = time.monotonic()
+            self._call(miner, "generate", 1, wallet=False)
+            after = time.monotonic()
+            latencies.append(after - before)
+            created.append((self._call(miner, "getblockcount", wallet=False),
+                    after, miner))
+        elapsed = time.monotonic() - start
+
+        if created:
+            self._wait_for_height(max(height for height, _, _ in created))
+
+        delays = []
+        full_delays = []
+        missing = 0
+        for height, created_at, miner in created:
+            block_delays = []
+            for node_name in self.nodes:
+                if node_name == miner:
+                    continue
+                seen = self.sampler.first_seen(node_name, height)
+                if seen is None:
+                    missing += 1
+                else:
+                    block_delays.append(max(0, seen - created_at))
+            delays += block_delays
+            if block_delays and len(block_delays) == len(self.nodes) - 1:
+                full_delays.append(max(block_delays))
+
+        return {
+            "count": len(created),
+            "seconds": elapsed,
+            "blocks_per_second": len(created) / elapsed if elapsed else None,
+            "generate_latency": percentiles(latencies),
+            "propagation_delay": percentiles(delays),
+            "full_propagation_delay": percentiles(full_delays),
+            "unpropagated": missing
+        }
+
+    def _send_transactions(self, miners):
+        for miner in miners:
+            self._fund(miner, math.ceil(self.transactions / len(miners)))
+        targets = [(node_name, address) for node_name in self.nodes
+                for address in self._get_addresses(node_name)]
+
+        per_miner = defaultdict(list)
+        for i in range(self.transactions):
+            per_miner[miners[i % len(miners)]].append(i)
+
+        latencies = []
+        errors = []
+
+        def send(miner):
+            node_info = self.manager.node_config["nodes"][miner]
+            candidates = [target for target in targets if target[0] != miner] or targets
+            for _ in per_miner[miner]:
+                _, address = self.rng.choice(candidates)
+                before = time.monotonic()
+                try:
+                    self._call(miner, "sendfrom", node_info["miningaccount"],
+                            address, self.amount)
+                    latencies.append(time.monotonic() - before)
+                except Exception as e:
+                    errors.append(repr(e))
+
+        start = time.monotonic()
+        self._each(per_miner, send)
+        elapsed = time.monotonic() - start
+
+        confirmed_at, blocks = self._confirm(miners[0])
+        return {
+            "count": len(latencies),
+            "failed": len(errors),
+            "errors": errors[:10],
+            "seconds": elapsed,
+            "transactions_per_second": len(latencies) / elapsed if elapsed else None,
+            "send_latency": percentiles(latencies),
+            "confirmation_blocks": blocks,
+            "confirmation_seconds": confirmed_at - start - elapsed
+                    if confirmed_at is not None else None
+        }
+
+    def _fund(self, miner, count):
+        """
+        Unlocks the wallet of `miner` and, if its mining account cannot pay
+        for `count` transactions, mines until its first coinbase matures.
+        """
+        node_info = self.manager.node_config["nodes"][miner]
+        self._call(miner, "walletpassphrase", node_info["walletpass"],
+                self.manager.WALLET_TIMEOUT)
+        balance = self._call(miner, "getbalance", node_info["miningaccount"])
+        if balance is not None and float(balance) >= 2 * count * self.amount:
+            return
+        print("{}: Mining {} blocks to fund transactions...".format(miner,
+                self.COINBASE_MATURITY + 1))
+        self._call(miner, "generate", self.COINBASE_MATURITY + 1, wallet=False)
+        self._wait_for_height(self._call(miner, "getblockcount", wallet=False))
+
+    def _confirm(self, miner):
+        """
+        Mines on `miner` until the mempool of every node is empty. Returns
+        the time it happened, or None, and the number of blocks mined.
+        """
+        for blocks in range(1, self.MAX_CONFIRMATION_BLOCKS + 1):
+            self._call(miner, "generate", 1, wallet=False)
+            if self._wait(lambda: all(self._mempool_size(node_name) == 0
+                    for node_name in self.nodes), self.PROPAGATION_TIMEOUT / 10):
+                return time.monotonic(), blocks
+        return None, self.MAX_CONFIRMATION_BLOCKS
+
+    def _wait_for_height(self, height):
+        return self._wait(lambda: all(self.sampler.heights.get(node_name, -1) >= height
+                for node_name in self.nodes), self.PROPAGATION_TIMEOUT)
+
+    def _wait(self, condition, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(self.sampler.interval)
+        return condition()
+
+    def _mempool_size(self, node_name):
+        return self._call(node_name, "getmempoolinfo", wallet=False)["size"]
+
+    def _get_addresses(self, node_name):
+        accounts = self.manager.storage_config[node_name].get("accounts", {})
+        return [address for account in accounts.values()
+                for address in account.get("addresses", [])]
+
+    def _mining(self, node_name, enabled):
+        node_info = self.manager.node_config["nodes"][node_name]
+        toggle = self.container_manager.start_mining if enabled \
+                else self.container_manager.stop_mining
+        toggle(node_name, node_info["user"], node_info["pass"],
+                simnet=self.manager.simnet)
+
+    def _call(self, node_name, method, *params, wallet=True):
+        node_info = self.manager.node_config["nodes"][node_name]
+        return self.container_manager.call(node_name, node_info["user"],
+                node_info["pass"], method, *params, wallet=wallet,
+                simnet=self.manager.simnet)
+
+    def _each(self, node_names, function):
+        with ThreadPoolExecutor(max_workers=self.manager.parallelism) as executor:
+            for _ in executor.map(function, node_names):
+                pass
+
+class Sampler:
+    """
+    Polls the block height and mempool size of every node every `interval`
+    seconds on a background thread, `parallelism` nodes at a time. Keeps
+    every sample and the time each node was first seen at each height.
+    """
+    def __init__(self, call, node_names, interval, parallelism=1):
+        self.call = call
+        self.node_names = node_names
+        self.interval = interval
+        self.parallelism = max(1, parallelism)
+        self.samples = []
+        self.heights = {}
+        self._first_seen = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._origin = time.monotonic()
+
+    def start(self):
+        """
+        Samples every node once, so that each has a baseline height before
+        any block is generated, then keeps sampling on a background thread.
+        """
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            list(executor.map(self._sample, self.node_names))
+        self._thread = threading.Thread(target=self._loop, args=(started,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def first_seen(self, node_name, height):
+        with self._lock:
+            return self._first_seen[node_name].get(height)
+
+    def samples_since(self, start):
+        with self._lock:
+            return [sample for sample in self.samples
+                    if sample["time"] >= start - self._origin]
+
+    def _loop(self, started):
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            while not self._stopped.wait(max(0, self.interval - (time.monotonic() - started))):
+                started = time.monotonic()
+                for _ in executor.map(self._sample, self.node_names):
+                    pass
+
+    def _sample(self, node_name):
+        try:
+            height = self.call(node_name, "getblockcount", wallet=False)
+            mempool = self.call(node_name, "getmempoolinfo", wallet=False)["size"]
+        except Exception:
+            return
+        now = time.monotonic()
+        with self._lock:
+            previous = self.heights.get(node_name, height)
+            for seen in range(previous + 1, height + 1):
+                self._first_seen[node_name][seen] = now
+            self.heights[node_name] = height
+            self.samples.append({
+                "time": now - self._origin,
+                "node": node_name,
+                "height": height,
+                "mempool": mempool
+            })
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Returns the count, mean, extremes and nearest-rank percentiles of
+    `values`, or None if there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    summary = {
+        "count": len(ordered),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "mean": sum(ordered) / len(ordered)
+    }
+    for point in points:
+        rank = max(1, math.ceil(point / 100 * len(ordered)))
+        summary["p{}".format(point)] = ordered[rank - 1]
+    return summary
+
+def write_report(report, filename):
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,380 @@
+import json
+import re
+
+from collections import Counter
+
+from bbldpl_manager.resources import node_resources, parse_cpulist, parse_memory
+
+PORT_SCHEMA = {"type": ["string", "integer"], "format": "port"}
+# Settings of a node holding a port
+PORT_KEYS = ["port", "rpcport", "hostport"]
+NAME_SCHEMA = {"type": "string", "minLength": 1}
+CPULIST_SCHEMA = {"type": "string", "format": "cpulist"}
+# Limits of a container: CPU quota, memory, number of dedicated CPUs the
+# packer picks, or CPUs given explicitly
+RESOURCES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "cpus": {"type": "number", "exclusiveMinimum": 0},
+        "memory": {"type": ["string", "integer"], "format": "memory"},
+        "cores": {"type": "integer", "minimum": 1},
+        "cpuset": CPULIST_SCHEMA
+    }
+}
+# Address of an external peer: host:port or [IPv6]:port
+_ADDRESS = re.compile(r"^[^\s:]+:\d+$|^\[[0-9a-fA-F:.]+\]:\d+$")
+
+NODE_SCHEMA = {
+    "type": "object",
+    "required": ["user", "pass", "port", "rpcport", "walletpass", "accounts",
+            "miningaccount"],
+    "properties": {
+        "user": NAME_SCHEMA,
+        "pass": NAME_SCHEMA,
+        "port": PORT_SCHEMA,
+        "rpcport": PORT_SCHEMA,
+        "walletpass": NAME_SCHEMA,
+        "accounts": {"type": "array", "items": NAME_SCHEMA, "minItems": 1,
+                "uniqueItems": True},
+        "miningaccount": NAME_SCHEMA,
+        "hostport": PORT_SCHEMA,
+        "host": NAME_SCHEMA,
+        "resources": RESOURCES_SCHEMA
+    }
+}
+
+CONFIG_SCHEMA = {
+    "type": "object",
+    "required": ["nodes", "connections", "network", "simnet"],
+    "properties": {
+        "nodes": {"type": "object", "minProperties": 1,
+                "additionalProperties": NODE_SCHEMA},
+        "connections": {
+            "type": "object",
+            "required": ["internal", "external"],
+            "properties": {
+                "internal": {"type": "array", "items": {"type": "array",
+                        "items": NAME_SCHEMA, "minItems": 2, "maxItems": 2}},
+                "external": {"type": "array", "items": {"type": "array",
+                        "items": NAME_SCHEMA, "minItems": 2, "maxItems": 2}}
+            }
+        },
+        "network": {
+            "type": "object",
+            "required": ["name"],
+            "properties": {"name": NAME_SCHEMA}
+        },
+        "simnet": {"enum": [True, False, "true", "false"]},
+        "resources": RESOURCES_SCHEMA,
+        "hosts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["name", "url"],
+                "properties": {
+                    "name": NAME_SCHEMA,
+                    "url": NAME_SCHEMA,
+                    "address": NAME_SCHEMA,
+                    "capacity": {"type": "integer", "minimum": 0},
+                    "numa": {"type": "array", "items": CPULIST_SCHEMA, "minItems": 1}
+                }
+            }
+        }
+    }
+}
+
+TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool
+}
+
+def _check_port(value):
+    return str(value).isdigit() and 0 < int(value) < 65536
+
+def _parses(parse):
+    def check(value):
+        try:
+            parse(value)
+        except ValueError:
+            return False
+        return True
+    return check
+
+FORMATS = {
+    "port": _check_port,
+    "memory": _parses(parse_memory),
+    "cpulist": _parses(parse_cpulist)
+}
+
+def compile_schema(schema):
+    """
+    Compiles `schema`, written in a subset of JSON Schema, into a function
+    `check(value, path, errors)` that appends a message to `errors` for
+    every violation found in `value`. The schema is only walked once, so
+    checking large configurations costs a few function calls per value.
+    `path` names `value`; nested values are named by (path, key) pairs that
+    are only formatted into messages when there is an error.
+    Supported keywords: type, enum, format, minLength, minimum,
+    exclusiveMinimum, properties, required, additionalProperties, minProperties, items, minItems,
+    maxItems and uniqueItems.
+    """
+    checks = []
+
+    if "type" in schema:
+        names = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        types = tuple(TYPES[name] for name in names)
+        # bool is a subclass of int but not an integer here
+        rejects_bool = "boolean" not in names
+        expected = " or ".join(names)
+
+        def check_type(value, path, errors):
+            if not isinstance(value, types) or (rejects_bool and isinstance(value, bool)):
+                _error(errors, path, "expected {}, got {}", expected, json.dumps(value))
+                return False
+            return True
+    else:
+        check_type = None
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+        choices = ", ".join(json.dumps(choice) for choice in allowed)
+
+        def check_enum(value, path, errors):
+            if not any(value == choice and type(value) is type(choice)
+                    for choice in allowed):
+                _error(errors, path, "expected one of {}, got {}", choices,
+                        json.dumps(value))
+        checks.append(check_enum)
+
+    if "format" in schema:
+        name = schema["format"]
+        check_format_value = FORMATS[name]
+
+        def check_format(value, path, errors):
+            if not check_format_value(value):
+                _error(errors, path, "{} is not a valid {}", json.dumps(value), name)
+        checks.append(check_format)
+
+    if "minLength" in schema:
+        min_length = schema["minLength"]
+
+        def check_min_length(value, path, errors):
+            if isinstance(value, str) and len(value) < min_length:
+                _error(errors, path, "must not be empty" if min_length == 1
+                        else "needs at least {} characters", min_length)
+        checks.append(check_min_length)
+
+    if "minimum" in schema:
+        minimum = schema["minimum"]
+
+        def check_minimum(value, path, errors):
+            if isinstance(value, (int, float)) and value < minimum:
+                _error(errors, path, "must be at least {}", minimum)
+        checks.append(check_minimum)
+
+    if "exclusiveMinimum" in schema:
+        exclusive_minimum = schema["exclusiveMinimum"]
+
+        def check_exclusive_minimum(value, path, errors):
+            if isinstance(value, (int, float)) and value <= exclusive_minimum:
+                _error(errors, path, "must be more than {}", exclusive_minimum)
+        checks.append(check_exclusive_minimum)
+
+    if "required" in schema:
+        required = schema["required"]
+
+        def check_required(value, path, errors):
+            if isinstance(value, dict):
+                for key in required:
+                    if key not in value:
+                        _error(errors, path, "missing {}", key)
+        checks.append(check_required)
+
+    if "minProperties" in schema:
+        min_properties = schema["minProperties"]
+
+        def check_min_properties(value, path, errors):
+            if isinstance(value, dict) and len(value) < min_properties:
+                _error(errors, path, "needs at least {} entries", min_properties)
+        checks.append(check_min_properties)
+
+    if "properties" in schema:
+        properties = {key: compile_schema(subschema)
+                for key, subschema in schema["properties"].items()}
+
+        def check_properties(value, path, errors):
+            if isinstance(value, dict):
+                for key, check in properties.items():
+                    if key in value:
+                        check(value[key], (path, key), errors)
+        checks.append(check_properties)
+
+    if "additionalProperties" in schema:
+        known = set(schema.get("properties", {}))
+        check_additional_value = compile_schema(schema["additionalProperties"])
+
+        def check_additional(value, path, errors):
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    if key not in known:
+                        check_additional_value(item, (path, key), errors)
+        checks.append(check_additional)
+
+    if "minItems" in schema or "maxItems" in schema:
+        min_items = schema.get("minItems", 0)
+        max_items = schema.get("maxItems")
+
+        def check_length(value, path, errors):
+            if not isinstance(value, list):
+                return
+            if min_items == max_items and len(value) != min_items:
+                _error(errors, path, "expected {} items, got {}", min_items, len(value))
+            elif len(value) < min_items:
+                _error(errors, path, "needs at least {} items", min_items)
+            elif max_items is not None and len(value) > max_items:
+                _error(errors, path, "takes at most {} items", max_items)
+        checks.append(check_length)
+
+    if schema.get("uniqueItems"):
+        def check_unique(value, path, errors):
+            if isinstance(value, list):
+                counts = Counter(json.dumps(item, sort_keys=True) for item in value)
+                for item, count in counts.items():
+                    if count > 1:
+                        _error(errors, path, "{} is listed {} times", item, count)
+        checks.append(check_unique)
+
+    if "items" in schema:
+        check_item = compile_schema(schema["items"])
+
+        def check_items(value, path, errors):
+            if isinstance(value, list):
+                for i, item in enumerate(value):
+                    check_item(item, (path, i), errors)
+        checks.append(check_items)
+
+    def check(value, path, errors):
+        if check_type is not None and not check_type(value, path, errors):
+            return
+        for check_keyword in checks:
+            check_keyword(value, path, errors)
+    return check
+
+_check_config = compile_schema(CONFIG_SCHEMA)
+
+def validate_config(config):
+    """
+    Checks `config` against CONFIG_SCHEMA, then checks the references
+    between its sections:
+    - connections join distinct nodes of `nodes`, at most once each
+    - external peers are host:port addresses
+    - the mining account of every node is one of its accounts, or the
+      "default" account every deployed node has
+    - ports of a node are distinct, and host ports are not shared on a host
+    - nodes are pinned to hosts listed under `hosts`, whose names are unique
+    - nodes get either a number of `cores` or a `cpuset`, not both
+    Returns the list of problems found, empty if the configuration is valid.
+    """
+    errors = []
+    _check_config(config, "", errors)
+    if errors:
+        # The cross references assume the structure is right
+        return errors
+
+    nodes = config["nodes"]
+    for node_name, node_info in nodes.items():
+        spec = node_resources(config.get("resources"), node_info)
+        if "cores" in spec and "cpuset" in spec:
+            errors.append("nodes.{}.resources: cores and cpuset are exclusive".format(
+                    node_name))
+        if node_info["miningaccount"] not in node_info["accounts"] + ["default"]:
+            errors.append("nodes.{}.miningaccount: {} is not one of its accounts".format(
+                    node_name, node_info["miningaccount"]))
+        if str(node_info["port"]) == str(node_info["rpcport"]):
+            errors.append("nodes.{}: port and rpcport are both {}".format(
+                    node_name, node_info["port"]))
+
+    hosts = [host["name"] for host in config.get("hosts", [])]
+    for host, count in Counter(hosts).items():
+        if count > 1:
+            errors.append("hosts: {} is listed {} times".format(host, count))
+    default_host = hosts[0] if hosts else None
+    for node_name, node_info in nodes.items():
+        if "host" in node_info and node_info["host"] not in hosts:
+            errors.append("nodes.{}.host: unknown host {}".format(node_name,
+                    node_info["host"]))
+
+    host_ports = {}
+    for node_name, node_info in nodes.items():
+        if "hostport" not in node_info:
+            continue
+        key = (node_info.get("host", default_host), int(node_info["hostport"]))
+        if key in host_ports:
+            errors.append("nodes.{}.hostport: {} is also used by {}".format(
+                    node_name, key[1], host_ports[key]))
+        else:
+            host_ports[key] = node_name
+
+    seen = set()
+    for i, (node1, node2) in enumerate(config["connections"]["internal"]):
+        unknown = [node_name for node_name in (node1, node2) if node_name not in nodes]
+        for node_name in unknown:
+            _error(errors, ("connections.internal", i), "unknown node {}", node_name)
+        if unknown:
+            continue
+        if node1 == node2:
+            _error(errors, ("connections.internal", i), "{} is connected to itself",
+                    node1)
+            continue
+        edge = (node1, node2) if node1 < node2 else (node2, node1)
+        if edge in seen:
+            _error(errors, ("connections.internal", i),
+                    "{} and {} are already connected", *edge)
+            continue
+        seen.add(edge)
+
+    for i, (node_name, peer) in enumerate(config["connections"]["external"]):
+        if node_name not in nodes:
+            _error(errors, ("connections.external", i), "unknown node {}", node_name)
+        if not _ADDRESS.match(peer) or not _check_port(peer.rsplit(":", 1)[1]):
+            _error(errors, ("connections.external", i), "{} is not a host:port address",
+                    peer)
+
+    return errors
+
+def is_simnet(config):
+    """
+    Whether `config` deploys on simnet. Unlike the truthiness check it
+    replaces, a `simnet` of "false" turns simnet off.
+    """
+    return config["simnet"] in (True, "true")
+
+def normalize_config(config):
+    """
+    Converts the ports of the nodes of a valid `config`, which may be given
+    as numbers, to the strings that commands and port mappings are built
+    from. Returns `config`.
+    """
+    for node_info in config["nodes"].values():
+        for key in PORT_KEYS:
+            if key in node_info:
+                node_info[key] = str(node_info[key])
+    return config
+
+def _format_path(path):
+    """
+    Formats a path built as nested (parent, key) pairs while checking a
+    value. Paths are only formatted for values that have errors.
+    """
+    keys = []
+    while isinstance(path, tuple):
+        path, key = path
+        keys.append("[{}]".format(key) if isinstance(key, int) else "." + key)
+    return (path + "".join(reversed(keys))).lstrip(".") or "config"
+
+def _error(errors, path, message, *args):
+    errors.append("{}: {}".format(_format_path(path), message.format(*args)))
@@ -1,37 +1,315 @@
 import docker
 import json
+import re
+import shlex
+import threading
+import time
+
+from bbldpl_manager.expect import ExpectError, ExpectSession
+from bbldpl_manager.rpc import RPCClient, RPCError, RPCOutcomeUnknownError
+from bbldpl_manager.trace import Tracer
+
+BTCWALLET_RPCPORT = "8332"
+BTCWALLET_SIMNET_RPCPORT = "18554"
+# Prompts of `btcwallet --create` and the answers given to them. None is
+# replaced by the wallet passphrase. The seed is printed before the last one.
+WALLET_PROMPTS = [
+    (re.compile(rb"passphrase for your new wallet:"), None),
+    (re.compile(rb"Confirm passphrase:"), None),
+    (re.compile(rb"encryption for public data\?[^:]*:"), "no"),
+    (re.compile(rb"existing wallet seed[^:]*:"), "no"),
+    (re.compile(rb"generation seed is:\s*(?P<seed>[0-9a-fA-F]+)\s.*to continue:",
+            re.S), "OK")
+]
+WALLET_CREATED = re.compile(rb"wallet has been created")
+# Secrets printed by `btcwallet --create`, masked in the transcripts
+WALLET_SECRETS = [re.compile(rb"generation seed is:\s*(?P<secret>[0-9a-fA-F]+)")]
+# Files the output of the daemons is appended to inside the containers
+LOG_DIR = "/var/log/bbldpl"
+DAEMON_LOGS = {
+    "bbld": LOG_DIR + "/bbld.log",
+    "btcwallet": LOG_DIR + "/btcwallet.log"
+}
+
+def bbld_command(user, passw, rpcport, port, mining_address=None,
+        connections=[], simnet=False):
+    bbld_cmd = ["bbld", "-u", user, "-P" + passw,
+            "--rpclisten=0.0.0.0:" + rpcport, "--listen=0.0.0.0:" + port]
+    if simnet:
+        bbld_cmd += ["--simnet"]
+    if mining_address:
+        bbld_cmd += ["--miningaddr=" + mining_address, "--txindex"]
+    for connection in connections:
+        bbld_cmd += ["--connect=" + connection]
+    return bbld_cmd
+
+def btcwallet_command(user, passw, create=False, simnet=False):
+    btcwallet_cmd = ["btcwallet", "-u", user, "-P", passw]
+    if create:
+        btcwallet_cmd += ["--create"]
+    else:
+        # Listen on all interfaces so that the RPC backend can reach it
+        btcwallet_cmd += ["--rpclisten=0.0.0.0:" + btcwallet_rpcport(simnet)]
+    if simnet:
+        btcwallet_cmd += ["--simnet"]
+    return btcwallet_cmd
+
+def logged_command(daemon, cmd):
+    """
+    Wraps the command starting `daemon` so that its output is appended to
+    its log file. The shell execs the daemon, which keeps its process name.
+    """
+    return ["/bin/bash", "-c", "mkdir -p {} && exec {} >> {} 2>&1".format(
+            LOG_DIR, shlex.join(cmd), DAEMON_LOGS[daemon])]
+
+def command_name(cmd):
+    if isinstance(cmd, str):
+        return cmd.split()[0]
+    if cmd[:2] == ["/bin/bash", "-c"] and " exec " in cmd[2]:
+        # A daemon started by logged_command
+        return cmd[2].split(" exec ", 1)[1].split()[0]
+    return cmd[0]
+
+def btcctl_command(user, passw, method, params, wallet=True, simnet=False):
+    btcctl_cmd = ["btcctl", "-u", user, "-P", passw]
+    if wallet:
+        btcctl_cmd += ["--wallet"]
+    btcctl_cmd += [method] + [btcctl_arg(param) for param in params]
+    if simnet:
+        btcctl_cmd += ["--simnet"]
+    return btcctl_cmd
+
+def btcctl_arg(param):
+    if isinstance(param, bool):
+        return "1" if param else "0"
+    if isinstance(param, (dict, list)):
+        return json.dumps(param)
+    return str(param)
+
+def parse_btcctl_output(output):
+    """
+    btcctl prints JSON results as JSON and string results as plain text.
+    """
+    if not output:
+        return None
+    try:
+        return json.loads(output)
+    except ValueError:
+        return output
 
-from docker.utils.socket import read
+def count_outbound_peers(peer_info):
+    return len([peer for peer in peer_info or [] if not peer.get("inbound")])
+
+def published_ports(containers):
+    ports = {}
+    for container in containers:
+        for port in container.get("Ports") or []:
+            if port.get("PublicPort"):
+                ports[port["PublicPort"]] = "container {}".format(
+                        container["Names"][0].lstrip("/"))
+    return ports
+
+def btcwallet_rpcport(simnet):
+    if simnet:
+        return BTCWALLET_SIMNET_RPCPORT
+    return BTCWALLET_RPCPORT
+
+class LogStream:
+    """
+    Lines written by the daemons of a container, read from the output of
+    `tail` over their log files. Iterating yields `(daemon, line)` pairs.
+    `close` kills `tail`, which ends the iteration of a followed stream.
+    """
+    # tail prints this header before the lines of each file
+    HEADER = re.compile(r"^==> (.*) <==$")
+
+    def __init__(self, chunks, kill):
+        self._chunks = chunks
+        self._kill = kill
+        self._closed = False
+        # The shell prints its PID before it execs tail
+        self.pid = None
+
+    def __iter__(self):
+        daemons = {path: daemon for daemon, path in DAEMON_LOGS.items()}
+        daemon = None
+        pending = b""
+        for stdout, _ in self._chunks:
+            if not stdout:
+                continue
+            *lines, pending = (pending + stdout).split(b"\n")
+            for line in lines:
+                text = line.decode("utf-8", "replace").rstrip("\r")
+                if self.pid is None:
+                    self.pid = text.strip()
+                    if self._closed:
+                        # Closed before tail started
+                        self._kill_tail()
+                        return
+                    continue
+                header = self.HEADER.match(text)
+                if header:
+                    daemon = daemons.get(header.group(1))
+                elif daemon and text:
+                    yield daemon, text
+
+    def close(self):
+        self._closed = True
+        if self.pid:
+            self._kill_tail()
+
+    def _kill_tail(self):
+        if self.pid.isdigit():
+            self._kill(self.pid)
 
 class ContainerManager:
     CONTAINER_PLATFORM="linux/amd64"
-
-    def __init__(self, storage_config):
+    # Readiness probes start polling after PROBE_MIN_DELAY seconds and double
+    # the delay after each failed attempt, up to PROBE_MAX_DELAY.
+    PROBE_MIN_DELAY = 0.25
+    PROBE_MAX_DELAY = 5
+    PROBE_TIMEOUT = 300
+    # Seconds given to each prompt of the wallet creation to show up, and to
+    # the wallet to be written once all of them are answered
+    WALLET_PROMPT_TIMEOUT = 60
+    WALLET_CREATE_TIMEOUT = 300
+    # Seconds a cached container handle is trusted before it is looked up again
+    CONTAINER_CACHE_TTL = 30
+    # Transports used to talk to bbld and btcwallet: "exec" runs btcctl inside
+    # the container, "rpc" sends JSON-RPC requests to the daemons directly and
+    # falls back to btcctl when they cannot be reached.
+    BACKENDS = ["exec", "rpc"]
+    RPC_BATCH_SIZE = 500
+    RPC_CERTS = {
+        "bbld": "/root/.bbld/rpc.cert",
+        "btcwallet": "/root/.btcwallet/rpc.cert"
+    }
+    # Name of the Docker host configured by the environment, used when no
+    # hosts are given
+    DEFAULT_HOST = "local"
+    # Connections kept open to each Docker host
+    DOCKER_POOL_SIZE = 32
+
+    def __init__(self, storage_config, backend="exec", storage=None,
+            tracer=None, hosts=None, client_factory=None):
+        """
+        `storage`, if given, is the storage backend holding `storage_config`.
+        It is flushed after every change made to `storage_config`.
+        `tracer` records a span for every Docker API call and RPC request.
+        `hosts` lists the Docker hosts containers can be created on, as
+        `{"name": ..., "url": ..., "address": ...}` objects. The first one is
+        the default. Without hosts, the Docker host of the environment is used.
+        `client_factory(url)` returns the client of the Docker daemon at
+        `url`, or of the environment's daemon if `url` is None. It defaults
+        to docker-py; a SimulatedDocker can be plugged in instead.
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown backend {}".format(backend))
         self.storage_config = storage_config
-        self.client = docker.from_env()
+        self.storage = storage
+        # Held while `storage_config` is changed, so that the storage never
+        # encodes an entry halfway through a change
+        self.storage_lock = storage.lock if storage else threading.RLock()
+        self.tracer = tracer or Tracer(enabled=False)
+        self.backend = backend
+        self.hosts = {host["name"]: host for host in hosts or []}
+        self.default_host = hosts[0]["name"] if hosts else self.DEFAULT_HOST
+        self.client_factory = client_factory or self._docker_client
+        # Host name -> Docker client
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self.client = self._get_client(self.default_host)
+        self.probe_latencies = {}
+        # Output of the last wallet creation of each node, passphrases masked
+        self.wallet_transcripts = {}
+
+        # (node name, daemon) -> RPCClient, bbld RPC ports by node name, and
+        # nodes whose daemons cannot be reached from here, which use btcctl
+        self._rpc_clients = {}
+        self._rpc_lock = threading.Lock()
+        self._bbld_rpcports = {}
+        self._exec_only = set()
+
+        # Container ID -> (container handle, time it was fetched)
+        self._container_cache = {}
+        self._container_cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def container_exists(self, node_name):
         return self._get_container(node_name) != None
 
-    def create_container(self, image_name, node_name, net_name, ip_mapping):
+    def create_container(self, image_name, node_name, net_name, ip_mapping,
+            host=None, resources=None):
+        """
+        Creates and starts the container of `node_name` on the Docker host
+        `host`, or on the default one. `resources` holds the `cpuset_cpus`,
+        `mem_limit` and `nano_cpus` limits of the container, if any.
+        """
         if self._get_container(node_name):
             raise ContainerNameExistsError()
 
-        container = self.client.containers.run(image_name,
-                platform=self.CONTAINER_PLATFORM, ports=ip_mapping,
-                network=net_name, name=node_name, tty=True, detach=True)
-        container.start()
-        self.storage_config[node_name] = self._create_empty_storage_object()
-        self.storage_config[node_name]["containerID"] = container.id
-
-    def destroy_container(self, node_name):
+        host = host or self.default_host
+        with self.tracer.span("docker.containers.run", host=host):
+            container = self._get_client(host).containers.run(image_name,
+                    platform=self.CONTAINER_PLATFORM, ports=ip_mapping,
+                    network=net_name, name=node_name, tty=True, detach=True,
+                    **(resources or {}))
+            container.start()
+        node_storage = self._create_empty_storage_object()
+        node_storage["containerID"] = container.id
+        node_storage["host"] = host
+        if resources:
+            node_storage["resources"] = resources
+        with self.storage_lock:
+            self.storage_config[node_name] = node_storage
+        self._flush(node_name)
+        self._cache_container(container)
+
+    def destroy_container(self, node_name, stop_timeout=None, force=False):
+        """
+        Stops and removes the container of `node_name`. `stop_timeout` is the
+        number of seconds the daemons are given to shut down (Docker's default
+        if None). With `force` the container is killed and removed at once.
+        Returns False if the container disappeared before it could be removed.
+        """
         container = self._get_container(node_name)
         if not container:
             raise ContainerNameDoesNotExistError()
 
-        container.stop()
-        container.remove()
-        del self.storage_config[node_name]
+        removed = True
+        try:
+            if force:
+                with self.tracer.span("docker.container.remove", force=True):
+                    container.remove(force=True)
+            else:
+                with self.tracer.span("docker.container.stop"):
+                    if stop_timeout is None:
+                        container.stop()
+                    else:
+                        container.stop(timeout=stop_timeout)
+                with self.tracer.span("docker.container.remove"):
+                    container.remove()
+        except docker.errors.NotFound:
+            removed = False
+
+        self.forget_container(node_name)
+        return removed
+
+    def forget_container(self, node_name):
+        """
+        Drops the storage record of `node_name` and every cached resource of
+        its container.
+        """
+        if not node_name in self.storage_config:
+            return
+        self.invalidate_container_cache(self.storage_config[node_name]["containerID"])
+        self._close_rpc_clients(node_name)
+        with self._rpc_lock:
+            self._exec_only.discard(node_name)
+        with self.storage_lock:
+            del self.storage_config[node_name]
+        self._flush(node_name)
 
     def start_bbld_daemon(self, node_name, user, passw, rpcport, port,
             mining_address=None, connections=[], simnet=False):
@@ -39,17 +317,11 @@ class ContainerManager:
         if not container:
             raise ContainerNameDoesNotExistError()
 
-        # Construct bbld command
-        bbld_cmd = ["bbld", "-u", user, "-P" + passw,
-                "--rpclisten=0.0.0.0:" + rpcport, "--listen=0.0.0.0:" + port]
-        if simnet:
-            bbld_cmd += ["--simnet"]
-        if mining_address:
-            bbld_cmd += ["--miningaddr=" + mining_address, "--txindex"]
-        for connection in connections:
-            bbld_cmd += ["--connect=" + connection]
-
-        self._execute_cmd(container, bbld_cmd, detach=True)
+        bbld_cmd = bbld_command(user, passw, rpcport, port,
+                mining_address=mining_address, connections=connections,
+                simnet=simnet)
+        self._start_daemon(container, node_name, "bbld", bbld_cmd)
+        self._bbld_rpcports[node_name] = rpcport
 
     def kill_bbld_daemon(self, node_name):
         container = self._get_container(node_name)
@@ -59,61 +331,113 @@ class ContainerManager:
                 ["pidof", "-x", "bbld"]).decode('utf-8').strip()
         self._execute_cmd(container, '/bin/bash -c "kill ' + pid_of_bbld + '"')
 
-    def start_btcwallet_daemon(self, node_name, user, passw, simnet=False):
+        # bbld shuts down gracefully, wait until it has released its ports
+        self._wait_for(node_name, "bbld-exit",
+                lambda: not self._exec_succeeds(container, ["pidof", "-x", "bbld"]))
+
+    def wait_for_bbld_ready(self, node_name, user, passw, simnet=False,
+            timeout=None):
+        """
+        Blocks until bbld answers a `getinfo` RPC call.
+        """
         container = self._get_container(node_name)
         if not container:
             raise ContainerNameDoesNotExistError()
 
-        # Construct btcwallet command
-        btcwallet_cmd = ["btcwallet", "-u", user, "-P", passw]
-        if simnet:
-            btcwallet_cmd += ["--simnet"]
+        return self._wait_for(node_name, "bbld",
+                lambda: self._call_succeeds(container, node_name, user, passw,
+                        "getinfo", wallet=False, simnet=simnet),
+                timeout=timeout)
 
-        self._execute_cmd(container, btcwallet_cmd, detach=True)
+    def wait_for_btcwallet_ready(self, node_name, user, passw, simnet=False,
+            timeout=None):
+        """
+        Blocks until btcwallet answers a `getinfo` RPC call, which also
+        requires it to be connected to bbld.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
 
-    def generate_wallet(self, node_name, user, passw, walletpass, simnet=False):
-        # TODO: Does not properly retrieve the wallet generation seed
+        return self._wait_for(node_name, "btcwallet",
+                lambda: self._call_succeeds(container, node_name, user, passw,
+                        "getinfo", simnet=simnet),
+                timeout=timeout)
+
+    def wait_for_peers(self, node_name, user, passw, peers, simnet=False,
+            timeout=None):
+        """
+        Blocks until bbld reports at least `peers` outbound connections in
+        `getpeerinfo`.
+        """
         container = self._get_container(node_name)
         if not container:
             raise ContainerNameDoesNotExistError()
 
-        # Execute command for creation of wallet
-        cmd = ["btcwallet", "-u", user, "-P", passw, "--create"]
-        if simnet:
-            cmd += ["--simnet"]
-        answers = [walletpass, walletpass, "no", "no", "OK"]
+        def connected():
+            try:
+                peer_info = self._btcctl(container, node_name, user, passw,
+                        "getpeerinfo", wallet=False, simnet=simnet)
+            except ContainerCommandExecutionError:
+                return False
+            return count_outbound_peers(peer_info) >= peers
 
-        res = container.exec_run(cmd, tty=True, stdin=True, socket=True)
-        socket = res.output
+        return self._wait_for(node_name, "peers", connected, timeout=timeout)
 
-        # "Enter the private passphrase for your new wallet:"
-        self._socket_wait(socket)
-        socket._sock.send(bytes(walletpass, 'ascii'))
-        socket._sock.send(bytes('\n', 'ascii'))
+    def get_probe_latencies(self):
+        """
+        Returns the outcome of the last probe of each kind per node, as a
+        mapping of node name to probe name to
+        `{"latency": seconds, "attempts": count}`.
+        """
+        return self.probe_latencies
 
-        # "Confirm passphrase:"
-        self._socket_wait(socket)
-        socket._sock.send(bytes(walletpass, 'ascii'))
-        socket._sock.send(bytes('\n', 'ascii'))
+    def get_wallet_transcript(self, node_name):
+        """
+        Returns the output of the last wallet creation of a node, with the
+        answers given to it and the passphrases and seed masked.
+        """
+        return self.wallet_transcripts.get(node_name)
 
-        # "Do you want to add an additional layer of encryption
-        # for public data? (n/no/y/yes) [no]:"
-        self._socket_wait(socket)
-        socket._sock.send(b'no\n')
+    def start_btcwallet_daemon(self, node_name, user, passw, simnet=False):
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
 
-        # "Do you have an existing wallet seed you want to
-        # use? (n/no/y/yes) [no]:"
-        self._socket_wait(socket)
-        socket._sock.send(b'no\n')
+        btcwallet_cmd = btcwallet_command(user, passw, simnet=simnet)
+        self._start_daemon(container, node_name, "btcwallet", btcwallet_cmd)
 
-        # "Once you have stored the seed in a safe and secure
-        # location, enter "OK" to continue:"
-        self._socket_wait(socket)
-        socket._sock.send(b'OK\n')
-        self._socket_wait(socket)
+    def generate_wallet(self, node_name, user, passw, walletpass, simnet=False):
+        """
+        Answers the prompts of `btcwallet --create` and stores the generated
+        seed. Each prompt must show up within WALLET_PROMPT_TIMEOUT seconds.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
 
-        # Store seed in storage file
-        self.storage_config[node_name]["wallet"]["seed"] = "" # TODO
+        cmd = btcwallet_command(user, passw, create=True, simnet=simnet)
+        with self.tracer.span("docker.exec", command="btcwallet --create"):
+            res = container.exec_run(cmd, tty=True, stdin=True, socket=True)
+        session = ExpectSession(getattr(res.output, "_sock", res.output),
+                timeout=self.WALLET_PROMPT_TIMEOUT, masks=WALLET_SECRETS)
+        try:
+            seed = None
+            for prompt, answer in WALLET_PROMPTS:
+                match = session.expect(prompt)
+                seed = match.groupdict().get("seed", seed)
+                session.sendline(answer or walletpass, secret=answer is None)
+            session.expect(WALLET_CREATED, timeout=self.WALLET_CREATE_TIMEOUT)
+        except ExpectError as e:
+            raise ContaineWalletGenerationError("{}: {}\n{}".format(node_name,
+                    e, e.transcript))
+        finally:
+            self.wallet_transcripts[node_name] = session.format_transcript()
+            session.close()
+
+        with self.storage_lock:
+            self.storage_config[node_name]["wallet"]["seed"] = seed.decode("ascii")
+        self._flush(node_name)
 
     def unlock_wallet(self, node_name, user, passw, walletpass,
             timeout, simnet=False):
@@ -121,13 +445,8 @@ class ContainerManager:
         if not container:
             raise ContainerNameDoesNotExistError()
 
-        unlock_wallet_cmd = ["btcctl",
-                "-u", user, "-P", passw,
-                "--wallet", "walletpassphrase", walletpass, str(timeout)]
-        if simnet:
-            unlock_wallet_cmd += ["--simnet"]
-
-        self._execute_cmd(container, unlock_wallet_cmd)
+        self._btcctl(container, node_name, user, passw,
+                "walletpassphrase", walletpass, int(timeout), simnet=simnet)
 
     def account_exists(self, node_name, user, passw, account, simnet=False):
         container = self._get_container(node_name)
@@ -138,6 +457,16 @@ class ContainerManager:
 
         return account in accounts
 
+    def list_accounts(self, node_name, user, passw, simnet=False):
+        """
+        Returns a mapping of the wallet's account names to their balances.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        return self._get_accounts(container, node_name, user, passw, simnet)
+
     def add_account(self, node_name, user, passw, account, simnet=False):
         container = self._get_container(node_name)
         if not container:
@@ -146,13 +475,11 @@ class ContainerManager:
         if self.account_exists(node_name, user, passw, account, simnet):
             return
 
-        add_account_cmd = ["btcctl", "-u", user, "-P", passw,
-                "--wallet", "createnewaccount", account]
-        if simnet:
-            add_account_cmd += ["--simnet"]
-
-        self._execute_cmd(container, add_account_cmd)
-        self.storage_config[node_name]["accounts"][account] = {"addresses": []}
+        self._btcctl(container, node_name, user, passw,
+                "createnewaccount", account, simnet=simnet)
+        with self.storage_lock:
+            self.storage_config[node_name]["accounts"][account] = {"addresses": []}
+        self._flush(node_name)
 
     def generate_address(self, node_name, user, passw, account, simnet=False):
         container = self._get_container(node_name)
@@ -163,20 +490,53 @@ class ContainerManager:
             raise ContainerAccountDoesNotExistError(
                     "Account {} does not exist".format(account))
 
-        if not account in self.storage_config[node_name]["accounts"]:
-            self.storage_config[node_name]["accounts"][account] = {
-                "addresses": []
-            }
-
-        generate_addr_cmd = ["btcctl", "-u", user,
-                "-P", passw, "--wallet", "getnewaddress", account]
-        if simnet:
-            generate_addr_cmd += ["--simnet"]
-        address = self._execute_cmd(container,
-                generate_addr_cmd).decode('utf-8').strip()
-        self.storage_config[node_name]["accounts"][account]["addresses"].append(address)
+        address = self._btcctl(container, node_name, user, passw,
+                "getnewaddress", account, simnet=simnet)
+        with self.storage_lock:
+            self.storage_config[node_name]["accounts"].setdefault(account,
+                    {"addresses": []})["addresses"].append(address)
+        self._flush(node_name)
         return address
 
+    def provision_accounts(self, node_name, user, passw, accounts,
+            addresses_per_account=1, simnet=False):
+        """
+        Makes sure every account in `accounts` exists and generates
+        `addresses_per_account` new addresses for each of them. The existing
+        accounts are listed once and the missing accounts and the new
+        addresses are requested in batches.
+        Returns a mapping of account name to the addresses generated for it.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        existing = self._get_accounts(container, node_name, user, passw, simnet)
+        missing = [account for account in dict.fromkeys(accounts)
+                if account not in existing]
+        self._btcctl_chunked(container, node_name, user, passw,
+                [("createnewaccount", [account]) for account in missing],
+                simnet=simnet)
+
+        node_accounts = self.storage_config[node_name]["accounts"]
+        with self.storage_lock:
+            for account in accounts:
+                node_accounts.setdefault(account, {"addresses": []})
+
+        calls = [("getnewaddress", [account])
+                for account in dict.fromkeys(accounts)
+                for _ in range(addresses_per_account)]
+        addresses = self._btcctl_chunked(container, node_name, user, passw,
+                calls, simnet=simnet)
+
+        generated = {account: [] for account in accounts}
+        with self.storage_lock:
+            for (_, (account,)), address in zip(calls, addresses):
+                generated[account].append(address)
+                node_accounts[account]["addresses"].append(address)
+        self._flush(node_name)
+        return generated
+
     def get_addresses(self, node_name, user, passw, account, simnet=False):
         container = self._get_container(node_name)
         if not container:
@@ -186,109 +546,592 @@ class ContainerManager:
             raise ContainerAccountDoesNotExistError(
                     "Account {} does not exist".format(account))
 
-        get_address_cmd = ["btcctl", "-u", user, "-P", passw,
-                "--wallet", "getaddressesbyaccount", account]
-        if simnet:
-            get_address_cmd += ["--simnet"]
-
-        addresses = json.loads(self._execute_cmd(container, get_address_cmd))
-        return addresses
+        return self._btcctl(container, node_name, user, passw,
+                "getaddressesbyaccount", account, simnet=simnet)
 
     def get_first_address(self, node_name, user, passw, account, simnet=False):
         addresses = self.get_addresses(node_name, user, passw, account, simnet)
         if len(addresses):
             return addresses[0]
 
+    def call(self, node_name, user, passw, method, *params, wallet=True,
+            simnet=False):
+        """
+        Executes the RPC `method` on btcwallet (`wallet` True) or bbld of
+        `node_name` with the configured backend and returns its result.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        return self._btcctl(container, node_name, user, passw, method, *params,
+                wallet=wallet, simnet=simnet)
+
+    def restart_daemon(self, node_name, daemon):
+        """
+        Starts `daemon` again with the command it was last started with.
+        Returns False if no command was recorded for it.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        started = self.storage_config[node_name].get("daemons", {}).get(daemon)
+        if not started:
+            return False
+        self._start_daemon(container, node_name, daemon, started["command"])
+        return True
+
+    def running_daemons(self, node_name):
+        """
+        Returns the names of the daemons running inside the container, with
+        a single exec.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        script = "; ".join("pidof -x {0} > /dev/null && echo {0}".format(daemon)
+                for daemon in sorted(DAEMON_LOGS))
+        output = self._execute_cmd(container, ["/bin/bash", "-c", script + "; true"])
+        return set(output.decode("utf-8").split())
+
+    def stream_events(self, host=None):
+        """
+        Returns the stream of the events of the containers of `host` that
+        tell a container or a process started by `docker exec` stopped or
+        started, decoded. Closing the stream ends it.
+        """
+        host = host or self.default_host
+        try:
+            return self._get_client(host).events(decode=True, filters={
+                "type": "container",
+                "event": ["start", "die", "oom", "exec_die"]
+            })
+        except docker.errors.APIError as e:
+            raise ContainerCommandExecutionError(e)
+
+    def daemon_running(self, node_name, daemon):
+        """
+        Returns whether a process named `daemon` runs inside the container.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        return self._exec_succeeds(container, ["pidof", "-x", daemon])
+
+    def stream_stats(self, node_name):
+        """
+        Returns an iterator over the decoded resource usage statistics of
+        the container of `node_name`, which Docker streams about once a
+        second until the container stops.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        try:
+            return container.stats(stream=True, decode=True)
+        except docker.errors.APIError as e:
+            raise ContainerCommandExecutionError(e)
+
+    def stream_logs(self, node_name, lines=10, follow=False):
+        """
+        Returns a LogStream over the output of the daemons of `node_name`:
+        the last `lines` lines of each daemon, or all of them if `lines` is
+        None, then with `follow` every line they write until the stream is
+        closed.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        tail = ["tail", "-v", "-n", "+1" if lines is None else str(lines)]
+        if follow:
+            # Keep following the files when a restarted daemon recreates them
+            tail += ["-F"]
+        tail += [DAEMON_LOGS[daemon] for daemon in sorted(DAEMON_LOGS)]
+        try:
+            with self.tracer.span("docker.exec", command="tail"):
+                _, chunks = container.exec_run(["/bin/bash", "-c",
+                        "echo $$; exec " + shlex.join(tail)], stream=True, demux=True)
+        except docker.errors.APIError as e:
+            raise ContainerCommandExecutionError(e)
+
+        return LogStream(chunks, lambda pid: self._execute_cmd(container,
+                '/bin/bash -c "kill ' + pid + '"'))
+
+    def get_published_ports(self, host=None):
+        """
+        Returns the ports of `host` published by running containers, mapped
+        to a description of the container publishing them.
+        """
+        with self.tracer.span("docker.containers.list"):
+            containers = self._get_client(host).api.containers()
+        return published_ports(containers)
+
+    def get_host(self, node_name):
+        """
+        Returns the name of the Docker host running the container of
+        `node_name`. Records written before hosts were tracked belong to
+        the default host.
+        """
+        return self.storage_config.get(node_name, {}).get("host", self.default_host)
+
+    def get_hosts(self):
+        return list(self.hosts) or [self.default_host]
+
+    def ping_host(self, host):
+        """
+        Raises HostUnreachableError if the Docker daemon of `host` does not
+        answer.
+        """
+        try:
+            with self.tracer.span("docker.ping", host=host):
+                self._get_client(host).ping()
+        except (docker.errors.DockerException, OSError) as e:
+            raise HostUnreachableError("{}: {}".format(host, e))
+
+    def get_host_loads(self):
+        """
+        Returns the number of containers, running or not, on every host.
+        """
+        loads = {}
+        for host in self.get_hosts():
+            with self.tracer.span("docker.containers.list", host=host):
+                loads[host] = len(self._get_client(host).api.containers(all=True))
+        return loads
+
+    def get_host_resources(self, host=None):
+        """
+        Returns the number of CPUs and the memory of `host`, along with the
+        CPU sets, memory limits and CPU quotas of the containers it holds.
+        """
+        host = host or self.default_host
+        client = self._get_client(host)
+        with self.tracer.span("docker.info", host=host):
+            info = client.info()
+        with self.tracer.span("docker.containers.list", host=host):
+            containers = client.api.containers(all=True)
+
+        resources = {"cpus": info["NCPU"], "memory": info["MemTotal"],
+                "cpusets": [], "memory_limits": 0, "nano_cpus": 0}
+        for container in containers:
+            try:
+                with self.tracer.span("docker.containers.inspect", host=host):
+                    config = client.api.inspect_container(container["Id"])["HostConfig"]
+            except docker.errors.NotFound:
+                continue
+            if config.get("CpusetCpus"):
+                resources["cpusets"].append(config["CpusetCpus"])
+            resources["memory_limits"] += config.get("Memory") or 0
+            resources["nano_cpus"] += config.get("NanoCpus") or 0
+        return resources
+
+    def commit_container(self, node_name, image_name):
+        """
+        Commits the filesystem of the container of `node_name` to the image
+        `image_name` (repository:tag). Returns the number of bytes the new
+        layer adds to the image the container was created from.
+        """
+        container = self._get_container(node_name)
+        if not container:
+            raise ContainerNameDoesNotExistError()
+
+        repository, tag = image_name.rsplit(":", 1)
+        with self.tracer.span("docker.container.commit"):
+            image = container.commit(repository=repository, tag=tag)
+        return max(0, image.attrs["Size"] - container.image.attrs["Size"])
+
+    def image_exists(self, image_name, host=None):
+        try:
+            self._get_client(host).images.get(image_name)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+
+    def remove_image(self, image_name, host=None):
+        try:
+            with self.tracer.span("docker.images.remove"):
+                self._get_client(host).images.remove(image_name, force=True)
+        except docker.errors.ImageNotFound:
+            pass
+
+    def network_exists(self):
+        """
+        Returns whether the network exists on every host.
+        """
+        network_ids = self._get_network_ids()
+        for host in self.get_hosts():
+            if host not in network_ids:
+                return False
+            try:
+                with self.tracer.span("docker.networks.get", host=host):
+                    self._get_client(host).networks.get(network_ids[host])
+            except docker.errors.NotFound:
+                return False
+        return True
+
     def create_network(self, network_name):
-        network = self.client.networks.create(network_name)
-        self.storage_config["network"] = network.id
+        """
+        Creates the network on every host that lacks it. Containers on
+        different hosts reach each other through their published ports.
+        """
+        network_ids = self._get_network_ids()
+        for host in self.get_hosts():
+            if host in network_ids:
+                try:
+                    self._get_client(host).networks.get(network_ids[host])
+                    continue
+                except docker.errors.NotFound:
+                    pass
+            with self.tracer.span("docker.networks.create", host=host):
+                network = self._get_client(host).networks.create(network_name)
+            network_ids[host] = network.id
+        self._set_network_ids(network_ids)
 
     def destroy_network(self):
         if not "network" in self.storage_config:
             return
+        missing = []
         try:
-            self.client.networks.get(self.storage_config["network"]).remove()
-        except docker.errors.NotFound as e:
-            raise NetworkNotFoundException("Network {} does not exist".format(network_name))
-
-        del self.storage_config["network"]
+            for host, network_id in self._get_network_ids().items():
+                try:
+                    with self.tracer.span("docker.networks.remove", host=host):
+                        self._get_client(host).networks.get(network_id).remove()
+                except docker.errors.NotFound:
+                    missing.append(network_id)
+        finally:
+            with self.storage_lock:
+                del self.storage_config["network"]
+            self._flush("network")
+        if missing:
+            raise NetworkNotFoundException("Network {} does not exist".format(
+                    ", ".join(missing)))
 
     def start_mining(self, node_name, user, passw, simnet=False):
         container = self._get_container(node_name)
         if not container:
             raise ContainerNameDoesNotExistError()
 
-        start_mining_cmd = ["btcctl", "-u", user,
-                "-P", passw, "--wallet", "setgenerate", "1"]
-        if simnet:
-            start_mining_cmd += ["--simnet"]
-
-        self._execute_cmd(container, start_mining_cmd)
+        self._btcctl(container, node_name, user, passw,
+                "setgenerate", True, simnet=simnet)
 
     def stop_mining(self, node_name, user, passw, simnet=False):
         container = self._get_container(node_name)
         if not container:
             raise ContainerNameDoesNotExistError()
 
-        stop_mining_cmd = ["btcctl", "-u", user,
-                "-P", passw, "--wallet", "setgenerate", "0"]
-        if simnet:
-            stop_mining_cmd += ["--simnet"]
-
-        self._execute_cmd(container, stop_mining_cmd)
+        self._btcctl(container, node_name, user, passw,
+                "setgenerate", False, simnet=simnet)
 
     def get_storage(self):
         return self.storage_config
 
+    def get_cache_stats(self):
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self._container_cache)
+        }
+
+    def invalidate_container_cache(self, container_id=None):
+        """
+        Drops the cached handle of `container_id`, or every cached handle if
+        no ID is given.
+        """
+        with self._container_cache_lock:
+            if container_id is None:
+                self._container_cache.clear()
+            else:
+                self._container_cache.pop(container_id, None)
+
     ############# Internal methods ############
 
-    def _get_containers(self):
-        return self.client.containers.list(all=True)
+    def _flush(self, key):
+        if self.storage:
+            self.storage.flush(key)
+
+    def _get_client(self, host=None):
+        """
+        Returns the Docker client of `host`, created on first use. Each
+        client keeps a pool of DOCKER_POOL_SIZE connections to its host.
+        """
+        host = host or self.default_host
+        with self._clients_lock:
+            if host not in self._clients:
+                if host in self.hosts:
+                    self._clients[host] = self.client_factory(self.hosts[host]["url"])
+                elif host == self.default_host:
+                    self._clients[host] = self.client_factory(None)
+                else:
+                    raise ValueError("Unknown Docker host {}".format(host))
+            return self._clients[host]
+
+    def _docker_client(self, url):
+        if url:
+            return docker.DockerClient(base_url=url,
+                    max_pool_size=self.DOCKER_POOL_SIZE)
+        return docker.from_env(max_pool_size=self.DOCKER_POOL_SIZE)
+
+    def _get_network_ids(self):
+        """
+        Returns the ID of the network on each host. A single ID is stored
+        as is when there is only the default host.
+        """
+        network_ids = self.storage_config.get("network", {})
+        if isinstance(network_ids, str):
+            return {self.default_host: network_ids}
+        return dict(network_ids)
+
+    def _set_network_ids(self, network_ids):
+        if list(network_ids) == [self.default_host] and not self.hosts:
+            network_ids = network_ids[self.default_host]
+        with self.storage_lock:
+            self.storage_config["network"] = network_ids
+        self._flush("network")
 
     def _create_empty_storage_object(self):
         return {
             "containerID": "",
             "accounts": {},
-            "wallet": {"seed": ""}
+            "wallet": {"seed": ""},
+            "stages": []
         }
 
     def _get_container(self, node_name):
         if not node_name in self.storage_config:
             return None
         stored_container_id = self.storage_config[node_name]["containerID"]
-        for container in self._get_containers():
-            if container.id == stored_container_id:
-                return container
 
-        return None
+        with self._container_cache_lock:
+            cached = self._container_cache.get(stored_container_id)
+            if cached and time.monotonic() - cached[1] < self.CONTAINER_CACHE_TTL:
+                self.cache_hits += 1
+                return cached[0]
+            self.cache_misses += 1
+
+        try:
+            with self.tracer.span("docker.containers.get"):
+                container = self._get_client(self.get_host(node_name)).containers.get(
+                        stored_container_id)
+        except docker.errors.NotFound:
+            self.invalidate_container_cache(stored_container_id)
+            return None
+
+        self._cache_container(container)
+        return container
+
+    def _cache_container(self, container):
+        with self._container_cache_lock:
+            self._container_cache[container.id] = (container, time.monotonic())
 
     def _execute_cmd(self, container, cmd, detach=False):
         output = None
         try:
-            _, output = container.exec_run(cmd, detach=detach)
+            with self.tracer.span("docker.exec", command=command_name(cmd)):
+                _, output = container.exec_run(cmd, detach=detach)
         except docker.errors.APIError as e:
             raise ContainerCommandExecutionError(e)
 
         return output
 
-    def _socket_wait(self, socket):
+    def _start_daemon(self, container, node_name, daemon, cmd):
         """
-        Waits for the socket to load a response. Hacky.
+        Starts `daemon` with `cmd` in the background and records both with
+        the ID of the exec running it, so that the exit of the daemon can be
+        told from the `exec_die` events of the container.
         """
-        while 1:
-            now = read(socket, 4096)
-            if now == b'\r\n':
-                continue
-            break
+        api = container.client.api
+        try:
+            with self.tracer.span("docker.exec", command=daemon):
+                exec_id = api.exec_create(container.id, logged_command(daemon, cmd))["Id"]
+                api.exec_start(exec_id, detach=True)
+        except docker.errors.APIError as e:
+            raise ContainerCommandExecutionError(e)
 
-    def _get_accounts(self, container, node_name, user, passw, simnet):
-        list_accounts_cmd = ["btcctl", "-u", user, "-P", passw,
-                "--wallet", "listaccounts"]
-        if simnet:
-            list_accounts_cmd += ["--simnet"]
+        with self.storage_lock:
+            self.storage_config[node_name].setdefault("daemons", {})[daemon] = {
+                "command": cmd,
+                "exec": exec_id
+            }
+        self._flush(node_name)
+
+    def _btcctl(self, container, node_name, user, passw, method, *params,
+            wallet=True, simnet=False):
+        """
+        Executes the RPC `method` on btcwallet (`wallet` True) or bbld using
+        the configured backend and returns its decoded result.
+        """
+        return self._btcctl_batch(container, node_name, user, passw,
+                [(method, params)], wallet=wallet, simnet=simnet)[0]
 
-        accounts = self._execute_cmd(container, list_accounts_cmd)
-        return json.loads(self._execute_cmd(container, list_accounts_cmd))
+    def _btcctl_batch(self, container, node_name, user, passw, calls,
+            wallet=True, simnet=False):
+        """
+        Executes a list of `(method, params)` RPC calls and returns their
+        results in order. With the RPC backend they are sent as a single
+        batch request.
+        """
+        if self.backend == "rpc" and node_name not in self._exec_only:
+            try:
+                client = self._get_rpc_client(container, node_name, user,
+                        passw, wallet, simnet)
+                with self.tracer.span("rpc.batch", method=calls[0][0],
+                        calls=len(calls)):
+                    return client.batch(calls)
+            except RPCError as e:
+                raise ContainerCommandExecutionError(e)
+            except RPCOutcomeUnknownError as e:
+                # Running the calls again through btcctl could run them twice
+                self._close_rpc_clients(node_name)
+                raise ContainerCommandExecutionError("{}: {} failed: {}".format(
+                        node_name, calls[0][0], e))
+            except ConnectionError:
+                # The daemon is reachable but not listening, e.g. restarting
+                self._close_rpc_clients(node_name)
+            except OSError:
+                # The container cannot be reached from the host, e.g. a
+                # timeout: every later call would wait as long, use btcctl
+                with self._rpc_lock:
+                    self._exec_only.add(node_name)
+                self._close_rpc_clients(node_name)
+
+        results = []
+        for method, params in calls:
+            cmd = btcctl_command(user, passw, method, params, wallet=wallet,
+                    simnet=simnet)
+
+            try:
+                with self.tracer.span("docker.exec", command="btcctl " + method):
+                    exit_code, output = container.exec_run(cmd)
+            except docker.errors.APIError as e:
+                raise ContainerCommandExecutionError(e)
+            output = output.decode('utf-8').strip()
+            if exit_code != 0:
+                raise ContainerCommandExecutionError(
+                        "{}: {} failed: {}".format(node_name, method, output))
+            results.append(parse_btcctl_output(output))
+        return results
+
+    def _btcctl_chunked(self, container, node_name, user, passw, calls,
+            wallet=True, simnet=False):
+        """
+        Same as `_btcctl_batch`, but splits `calls` into batches of at most
+        RPC_BATCH_SIZE requests.
+        """
+        results = []
+        for i in range(0, len(calls), self.RPC_BATCH_SIZE):
+            results += self._btcctl_batch(container, node_name, user, passw,
+                    calls[i:i + self.RPC_BATCH_SIZE], wallet=wallet, simnet=simnet)
+        return results
+
+    def _get_rpc_client(self, container, node_name, user, passw, wallet, simnet):
+        daemon = "btcwallet" if wallet else "bbld"
+        with self._rpc_lock:
+            client = self._rpc_clients.get((node_name, daemon))
+        if client:
+            return client
+
+        if wallet:
+            port = btcwallet_rpcport(simnet)
+        else:
+            port = self._get_bbld_rpcport(node_name)
+            if port is None:
+                raise ConnectionError("RPC port of bbld is unknown")
+
+        address = self._get_container_ip(container)
+        exit_code, cert = container.exec_run(["cat", self.RPC_CERTS[daemon]])
+        cadata = cert.decode('utf-8') if exit_code == 0 else None
+        client = RPCClient(address, port, user, passw, cadata=cadata)
+        with self._rpc_lock:
+            return self._rpc_clients.setdefault((node_name, daemon), client)
+
+    def _get_bbld_rpcport(self, node_name):
+        """
+        Returns the RPC port bbld of `node_name` listens on: the one it was
+        started with by this process, or else the one of the command
+        recorded in the storage by the process that started it.
+        """
+        if node_name in self._bbld_rpcports:
+            return self._bbld_rpcports[node_name]
+        daemons = self.storage_config.get(node_name, {}).get("daemons", {})
+        for arg in daemons.get("bbld", {}).get("command", []):
+            if arg.startswith("--rpclisten="):
+                return arg.rsplit(":", 1)[1]
+        return None
+
+    def _close_rpc_clients(self, node_name):
+        with self._rpc_lock:
+            for key in [key for key in self._rpc_clients if key[0] == node_name]:
+                self._rpc_clients.pop(key).close()
+
+    def _get_container_ip(self, container):
+        for _ in range(2):
+            networks = container.attrs.get("NetworkSettings", {}).get("Networks", {})
+            for network in networks.values():
+                if network.get("IPAddress"):
+                    return network["IPAddress"]
+            container.reload()
+        # Not a ConnectionError: the container will not become reachable
+        raise OSError("Container {} has no IP address".format(container.id))
+
+    def _call_succeeds(self, container, node_name, user, passw, method,
+            wallet=True, simnet=False):
+        try:
+            self._btcctl(container, node_name, user, passw, method,
+                    wallet=wallet, simnet=simnet)
+        except ContainerCommandExecutionError:
+            return False
+        return True
+
+    def _exec_succeeds(self, container, cmd):
+        try:
+            with self.tracer.span("docker.exec", command=command_name(cmd)):
+                exit_code, _ = container.exec_run(cmd)
+        except docker.errors.APIError:
+            return False
+        return exit_code == 0
+
+    def _wait_for(self, node_name, probe, check, timeout=None):
+        """
+        Calls `check` until it returns True, backing off exponentially
+        between attempts. Records and returns the time it took.
+        """
+        with self.tracer.span("wait." + probe):
+            return self._poll(node_name, probe, check, timeout)
+
+    def _poll(self, node_name, probe, check, timeout):
+        if timeout is None:
+            timeout = self.PROBE_TIMEOUT
+        start = time.monotonic()
+        deadline = start + timeout
+        delay = self.PROBE_MIN_DELAY
+        attempts = 0
+        while True:
+            attempts += 1
+            passed = check()
+            now = time.monotonic()
+            if passed:
+                break
+            if now >= deadline:
+                raise ContainerDaemonNotReadyError(
+                        "{}: {} probe did not pass after {:.1f}s ({} attempts)".format(
+                        node_name, probe, now - start, attempts))
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, self.PROBE_MAX_DELAY)
+
+        latency = now - start
+        self.probe_latencies.setdefault(node_name, {})[probe] = {
+            "latency": latency,
+            "attempts": attempts
+        }
+        return latency
+
+    def _get_accounts(self, container, node_name, user, passw, simnet):
+        return self._btcctl(container, node_name, user, passw,
+                "listaccounts", simnet=simnet)
 
 #### Exception definitions
 class ContainerException(Exception):
@@ -309,6 +1152,12 @@ class ContaineWalletGenerationError(ContainerException):
 class ContainerCommandExecutionError(ContainerException):
     pass
 
+class ContainerDaemonNotReadyError(ContainerException):
+    pass
+
+class HostUnreachableError(Exception):
+    pass
+
 class NetworkException(Exception):
     pass
 
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import struct
+
+from urllib.parse import quote, urlencode, urlparse
+
+class AsyncDockerClient:
+    """
+    Minimal asyncio client for the Docker Engine API. Requests are sent over
+    a pool of keep-alive connections to the daemon's unix socket (or a
+    tcp:// endpoint), and at most `max_concurrency` of them are in flight
+    at any time.
+    """
+    DEFAULT_URL = "unix:///var/run/docker.sock"
+    MAX_CONCURRENCY = 64
+    # Methods whose requests can be sent again if the connection fails
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+    def __init__(self, base_url=None, max_concurrency=None):
+        self.base_url = urlparse(base_url or self.DEFAULT_URL)
+        self._semaphore = asyncio.Semaphore(max_concurrency or self.MAX_CONCURRENCY)
+        self._idle = []
+
+    async def request(self, method, path, params=None, body=None):
+        """
+        Sends a request and returns `(status, body)`. Raises
+        AsyncDockerAPIError (or AsyncDockerNotFound) on error statuses.
+        """
+        async with self._semaphore:
+            connection = self._pop_idle()
+            reused = connection is not None
+            if not reused:
+                connection = await self._connect()
+            try:
+                status, headers, data, keep_alive = await self._roundtrip(
+                        connection, method, path, params, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection[1].close()
+                # A POST may have been carried out before the connection
+                # broke, sending it again could create a second container
+                # or start a command twice
+                if not reused or method not in self.IDEMPOTENT_METHODS:
+                    raise
+                # The daemon closed an idle connection, retry on a new one
+                connection = await self._connect()
+                status, headers, data, keep_alive = await self._roundtrip(
+                        connection, method, path, params, body)
+
+            if keep_alive:
+                self._idle.append(connection)
+            else:
+                connection[1].close()
+
+        if status >= 400:
+            try:
+                message = json.loads(data).get("message", "")
+            except ValueError:
+                message = data.decode("utf-8", "replace")
+            if status == 404:
+                raise AsyncDockerNotFound(status, message)
+            raise AsyncDockerAPIError(status, message)
+        return status, data
+
+    async def json(self, method, path, params=None, body=None):
+        _, data = await self.request(method, path, params, body)
+        return json.loads(data) if data else None
+
+    async def hijack(self, method, path, body=None):
+        """
+        Sends a request whose response takes over the connection (such as
+        starting an attached exec instance) and returns its raw
+        `(reader, writer)` streams.
+        """
+        async with self._semaphore:
+            reader, writer = await self._connect()
+            self._write_request(writer, method, path, None, body,
+                    {"Connection": "Upgrade", "Upgrade": "tcp"})
+            await writer.drain()
+            status, _ = await self._read_head(reader)
+            if status not in (101, 200):
+                writer.close()
+                raise AsyncDockerAPIError(status, "Could not attach to {}".format(path))
+        return reader, writer
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    ############# Containers ############
+
+    async def create_container(self, image, name, platform=None, **config):
+        params = {"name": name}
+        if platform:
+            params["platform"] = platform
+        body = dict(config, Image=image)
+        return (await self.json("POST", "/containers/create", params, body))["Id"]
+
+    async def start_container(self, container_id):
+        await self.request("POST", "/containers/{}/start".format(container_id))
+
+    async def inspect_container(self, container_id):
+        return await self.json("GET", "/containers/{}/json".format(container_id))
+
+    async def list_containers(self, all=True, filters=None):
+        params = {"all": "1" if all else "0"}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        return await self.json("GET", "/containers/json", params)
+
+    async def stop_container(self, container_id, timeout=None):
+        params = {"t": timeout} if timeout is not None else None
+        await self.request("POST", "/containers/{}/stop".format(container_id), params)
+
+    async def remove_container(self, container_id, force=False):
+        await self.request("DELETE", "/containers/{}".format(container_id),
+                {"force": "1" if force else "0"})
+
+    ############# Exec ############
+
+    async def exec_run(self, container_id, cmd, detach=False):
+        """
+        Runs `cmd` inside the container. Returns `(exit_code, output)` with
+        stdout and stderr combined, or `(None, b"")` if `detach` is set.
+        """
+        if detach:
+            await self.exec_detached(container_id, cmd)
+            return None, b""
+
+        exec_id = await self._exec_create(container_id, cmd, tty=False,
+                stdin=False)
+        reader, writer = await self.hijack("POST", "/exec/{}/start".format(exec_id),
+                {"Detach": False, "Tty": False})
+        try:
+            output = await self._read_frames(reader)
+        finally:
+            writer.close()
+
+        info = await self.json("GET", "/exec/{}/json".format(exec_id))
+        return info["ExitCode"], output
+
+    async def exec_detached(self, container_id, cmd):
+        """
+        Starts `cmd` inside the container in the background and returns the
+        ID of the exec running it.
+        """
+        exec_id = await self._exec_create(container_id, cmd, tty=False,
+                stdin=False)
+        await self.request("POST", "/exec/{}/start".format(exec_id),
+                body={"Detach": True, "Tty": False})
+        return exec_id
+
+    async def exec_interactive(self, container_id, cmd):
+        """
+        Starts `cmd` with a TTY and stdin attached and returns the raw
+        `(reader, writer)` streams of its terminal.
+        """
+        exec_id = await self._exec_create(container_id, cmd, tty=True, stdin=True)
+        return await self.hijack("POST", "/exec/{}/start".format(exec_id),
+                {"Detach": False, "Tty": True})
+
+    ############# Networks ############
+
+    async def create_network(self, name):
+        return (await self.json("POST", "/networks/create", body={"Name": name}))["Id"]
+
+    async def inspect_network(self, network_id):
+        return await self.json("GET", "/networks/{}".format(network_id))
+
+    async def remove_network(self, network_id):
+        await self.request("DELETE", "/networks/{}".format(network_id))
+
+    ############# Internal methods ############
+
+    def _pop_idle(self):
+        # Skips the connections the daemon is already known to have closed
+        while self._idle:
+            connection = self._idle.pop()
+            if not connection[0].at_eof():
+                return connection
+            connection[1].close()
+        return None
+
+    async def _exec_create(self, container_id, cmd, tty, stdin):
+        body = {
+            "AttachStdin": stdin,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": tty,
+            "Cmd": cmd
+        }
+        response = await self.json("POST", "/containers/{}/exec".format(container_id),
+                body=body)
+        return response["Id"]
+
+    async def _read_frames(self, reader):
+        """
+        Reads a multiplexed stdout/stderr stream until the end: each frame
+        has an 8 byte header holding the stream type and the payload size.
+        """
+        output = b""
+        while True:
+            try:
+                header = await reader.readexactly(8)
+            except asyncio.IncompleteReadError:
+                return output
+            _, size = struct.unpack(">BxxxL", header)
+            output += await reader.readexactly(size)
+
+    async def _connect(self):
+        if self.base_url.scheme in ("unix", "http+unix"):
+            return await asyncio.open_unix_connection(self.base_url.path)
+        return await asyncio.open_connection(self.base_url.hostname,
+                self.base_url.port or 2375)
+
+    async def _roundtrip(self, connection, method, path, params, body):
+        reader, writer = connection
+        self._write_request(writer, method, path, params, body, {})
+        await writer.drain()
+
+        status, headers = await self._read_head(reader)
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if status in (204, 304) or method == "HEAD":
+            data = b""
+        elif "chunked" in headers.get("transfer-encoding", ""):
+            data = await self._read_chunked(reader)
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return status, headers, data, keep_alive
+
+    def _write_request(self, writer, method, path, params, body, headers):
+        target = quote(path)
+        if params:
+            target += "?" + urlencode(params)
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        lines = ["{} {} HTTP/1.1".format(method, target), "Host: docker",
+                "Content-Length: {}".format(len(payload))]
+        if body is not None:
+            lines.append("Content-Type: application/json")
+        lines += ["{}: {}".format(key, value) for key, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("ascii") + payload)
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Docker daemon closed the connection")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, value = line.decode("latin-1").split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        return status, headers
+
+    async def _read_chunked(self, reader):
+        data = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Skip the (normally empty) trailer
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return data
+            data += await reader.readexactly(size)
+            await reader.readexactly(2)
+
+#### Exception definitions
+class AsyncDockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__("{}: {}".format(status, message))
+        self.status = status
+        self.message = message
+
+class AsyncDockerNotFound(AsyncDockerAPIError):
+    pass
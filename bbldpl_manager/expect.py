@@ -0,0 +1,145 @@
+import asyncio
+import socket
+import time
+
+class _Session:
+    """
+    Matching and transcript bookkeeping shared by the blocking and asyncio
+    sessions. Output is buffered until a pattern matches it, whatever the
+    way the program splits it into chunks, and everything exchanged is kept
+    in `transcript` as `(direction, data)` pairs, secrets masked.
+
+    `masks` are compiled regexes matching secrets printed by the program:
+    the text of their `secret` group is masked in the formatted transcript.
+    They are applied to the whole output, so a secret split over several
+    chunks, or cut short by a timeout, is masked too.
+    """
+    TIMEOUT = 60
+    READ_SIZE = 4096
+
+    def __init__(self, timeout=None, masks=()):
+        self.timeout = timeout or self.TIMEOUT
+        self.masks = masks
+        self.buffer = b""
+        self.transcript = []
+
+    def format_transcript(self):
+        data = b"".join((b"> " if direction == "send" else b"") + data
+                for direction, data in self.transcript)
+        for mask in self.masks:
+            data = mask.sub(_mask_secret, data)
+        return data.decode("utf-8", "replace")
+
+    def _deadline(self, timeout):
+        return time.monotonic() + (timeout or self.timeout)
+
+    def _match(self, pattern):
+        """
+        Returns the match of `pattern` in the buffered output, dropping the
+        output up to its end, or None.
+        """
+        match = pattern.search(self.buffer)
+        if match:
+            self.buffer = self.buffer[match.end():]
+        return match
+
+    def _received(self, pattern, chunk):
+        if not chunk:
+            raise ExpectEOFError("Program exited while waiting for {!r}".format(
+                    pattern.pattern), self.format_transcript())
+        self.transcript.append(("recv", chunk))
+        self.buffer += chunk
+
+    def _line(self, text, secret):
+        self.transcript.append(("send", b"*****\n" if secret else
+                text.encode("utf-8") + b"\n"))
+        return text.encode("utf-8") + b"\n"
+
+    def _timed_out(self, pattern):
+        return ExpectTimeoutError("Timed out waiting for {!r}".format(
+                pattern.pattern), self.format_transcript())
+
+class ExpectSession(_Session):
+    """
+    Drives an interactive program attached to a socket, such as an exec
+    instance started with a TTY. `expect` never blocks past its deadline, so
+    a stuck program only fails its own session.
+    """
+    def __init__(self, sock, timeout=None, masks=()):
+        super().__init__(timeout, masks)
+        self.sock = sock
+
+    def expect(self, pattern, timeout=None):
+        """
+        Waits until the output matches the compiled regex `pattern` and
+        returns the match.
+        """
+        deadline = self._deadline(timeout)
+        while True:
+            match = self._match(pattern)
+            if match:
+                return match
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._timed_out(pattern)
+            self.sock.settimeout(remaining)
+            try:
+                chunk = self.sock.recv(self.READ_SIZE)
+            except socket.timeout:
+                raise self._timed_out(pattern)
+            self._received(pattern, chunk)
+
+    def sendline(self, text, secret=False):
+        self.sock.sendall(self._line(text, secret))
+
+    def close(self):
+        self.sock.close()
+
+class AsyncExpectSession(_Session):
+    """
+    asyncio counterpart of ExpectSession over a `(reader, writer)` pair.
+    """
+    def __init__(self, reader, writer, timeout=None, masks=()):
+        super().__init__(timeout, masks)
+        self.reader = reader
+        self.writer = writer
+
+    async def expect(self, pattern, timeout=None):
+        deadline = self._deadline(timeout)
+        while True:
+            match = self._match(pattern)
+            if match:
+                return match
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._timed_out(pattern)
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(self.READ_SIZE),
+                        remaining)
+            except asyncio.TimeoutError:
+                raise self._timed_out(pattern)
+            self._received(pattern, chunk)
+
+    async def sendline(self, text, secret=False):
+        self.writer.write(self._line(text, secret))
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+def _mask_secret(match):
+    start = match.start("secret") - match.start()
+    end = match.end("secret") - match.start()
+    return match.group(0)[:start] + b"*****" + match.group(0)[end:]
+
+#### Exception definitions
+class ExpectError(Exception):
+    def __init__(self, message, transcript):
+        super().__init__(message)
+        self.transcript = transcript
+
+class ExpectTimeoutError(ExpectError):
+    pass
+
+class ExpectEOFError(ExpectError):
+    pass
@@ -0,0 +1,200 @@
+import csv
+import json
+import os
+import sqlite3
+import threading
+
+EXPORT_FORMATS = ["csv", "jsonl"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS addresses (
+    address TEXT PRIMARY KEY,
+    node TEXT NOT NULL,
+    account TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS addresses_owner ON addresses (node, account, position);
+CREATE TABLE IF NOT EXISTS accounts (
+    node TEXT NOT NULL,
+    account TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last TEXT,
+    PRIMARY KEY (node, account)
+);
+"""
+
+def index_filename(storage_file):
+    return storage_file + ".index"
+
+class AddressIndex:
+    """
+    SQLite index of the addresses recorded in the storage, mapping every
+    address to the node and account owning it. It is kept next to the
+    storage file and updated by the storage backend after each flush.
+
+    Addresses are only ever appended to the accounts in the storage, so an
+    update inserts the addresses past the number already indexed for each
+    account of the flushed node. An account whose indexed last address no
+    longer matches, and the accounts and nodes gone from the storage, are
+    dropped and indexed again.
+
+    The database is only created once the storage holds accounts, or when
+    the index is queried, so that commands that never generate addresses
+    leave no index file behind.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        # Shared by the threads flushing the storage, under the lock. Opened
+        # by `_connect`.
+        self._db = None
+
+    def update(self, data, key=None):
+        """
+        Indexes the addresses of the node `key` of the storage `data`, or of
+        every node if no key is given.
+        """
+        with self._lock:
+            if self._db is None:
+                if not os.path.exists(self.filename) and \
+                        not _has_accounts(data, data if key is None else [key]):
+                    return
+                self._connect()
+            self._update(data, key)
+
+    def rebuild(self, data):
+        """
+        Drops the whole index and indexes the storage `data` again.
+        """
+        with self._lock:
+            self._connect()
+            with self._db:
+                self._db.execute("DELETE FROM addresses")
+                self._db.execute("DELETE FROM accounts")
+            self._update(data)
+
+    def owner(self, address):
+        """
+        Returns the `(node name, account)` owning `address`, or None if it
+        is not indexed.
+        """
+        with self._lock:
+            self._connect()
+            return self._db.execute(
+                    "SELECT node, account FROM addresses WHERE address = ?",
+                    (address,)).fetchone()
+
+    def addresses(self, node_name=None, account=None):
+        """
+        Yields the `(node name, account, address)` of the indexed addresses,
+        optionally of a single node and account, in the order they were
+        generated. The rows are read from the database as they are yielded.
+        """
+        query = "SELECT node, account, address FROM addresses"
+        conditions = []
+        parameters = []
+        if node_name is not None:
+            conditions.append("node = ?")
+            parameters.append(node_name)
+        if account is not None:
+            conditions.append("account = ?")
+            parameters.append(account)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY node, account, position"
+        with self._lock:
+            self._connect()
+        # A connection of its own, so that the index is not locked while
+        # the caller consumes the rows
+        db = sqlite3.connect(self.filename)
+        try:
+            yield from db.execute(query, parameters)
+        finally:
+            db.close()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    ############# Internal methods ############
+
+    def _connect(self):
+        if self._db is not None:
+            return
+        if not os.path.exists(self.filename):
+            # The journal of a deleted index would not match a new one
+            for suffix in ["-wal", "-shm"]:
+                if os.path.exists(self.filename + suffix):
+                    os.remove(self.filename + suffix)
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def _update(self, data, key=None):
+        with self._db:
+            if key is None:
+                indexed = {node for node, in self._db.execute(
+                        "SELECT DISTINCT node FROM accounts")}
+                keys = indexed | set(data)
+            else:
+                keys = [key]
+            for node_name in keys:
+                self._update_node(node_name, data.get(node_name))
+
+    def _update_node(self, node_name, node_data):
+        accounts = node_data.get("accounts", {}) if isinstance(node_data, dict) else {}
+        indexed = {account: (count, last) for account, count, last in self._db.execute(
+                "SELECT account, count, last FROM accounts WHERE node = ?", (node_name,))}
+
+        for account in set(indexed) - set(accounts):
+            self._drop_account(node_name, account)
+
+        for account, account_data in list(accounts.items()):
+            addresses = list(account_data.get("addresses", []))
+            count, last = indexed.get(account, (0, None))
+            if count > len(addresses) or (count and addresses[count - 1] != last):
+                self._drop_account(node_name, account)
+                count = 0
+            elif count == len(addresses) and account in indexed:
+                continue
+            self._db.executemany("INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?)",
+                    ((address, node_name, account, position)
+                    for position, address in enumerate(addresses[count:], count)))
+            self._db.execute("INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)",
+                    (node_name, account, len(addresses),
+                    addresses[-1] if addresses else None))
+
+    def _drop_account(self, node_name, account):
+        self._db.execute("DELETE FROM addresses WHERE node = ? AND account = ?",
+                (node_name, account))
+        self._db.execute("DELETE FROM accounts WHERE node = ? AND account = ?",
+                (node_name, account))
+
+def _has_accounts(data, keys):
+    return any(isinstance(data.get(key), dict) and data[key].get("accounts")
+            for key in keys)
+
+def export_addresses(rows, output, export_format="csv"):
+    """
+    Writes the `(node name, account, address)` rows to the file `output`
+    as CSV with a header line, or as JSON lines, one row at a time.
+    Returns the number of rows written.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format {}".format(export_format))
+    written = 0
+    if export_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(["node", "account", "address"])
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    else:
+        for node_name, account, address in rows:
+            output.write(json.dumps({"node": node_name, "account": account,
+                    "address": address}) + "\n")
+            written += 1
+    return written
@@ -0,0 +1,203 @@
+import itertools
+import re
+import sys
+import threading
+import time
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bbldpl_manager.container import DAEMON_LOGS
+
+# bbld and btcwallet start their log lines with the time they were written
+TIMESTAMP = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3})\s")
+
+class LogAggregator:
+    """
+    Merges the output of the bbld and btcwallet daemons of several nodes
+    into one stream ordered by the timestamps of their lines, each line
+    prefixed with its node and daemon. Lines without a timestamp take the
+    one of the previous line of their daemon. Only the lines matching
+    `pattern`, a regular expression, are kept.
+
+    `show` prints the last `lines` matching lines of every node. `follow`
+    streams the lines of a node from its last `lines` lines on, on a thread
+    blocked on the Docker exec stream, into a ring buffer of BUFFER_SIZE
+    lines per daemon; the oldest lines are dropped if a daemon writes faster
+    than they are printed. A printing thread merges the buffers and holds
+    each line REORDER_DELAY seconds, so that the lines of other nodes written
+    earlier but received later are printed before it.
+    """
+    BUFFER_SIZE = 1000
+    REORDER_DELAY = 0.5
+
+    def __init__(self, manager, lines=10, pattern=None, output=None):
+        self.manager = manager
+        self.container_manager = manager.container_manager
+        self.lines = lines
+        self.pattern = re.compile(pattern) if pattern else None
+        self.output = output or sys.stdout
+        # (node name, daemon) -> ring buffer of records and lines dropped
+        # since the last printed one, node name -> LogStream
+        self._buffers = {}
+        self._dropped = Counter()
+        self._streams = {}
+        self._width = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._printer = None
+
+    def show(self, node_names):
+        """
+        Prints the last lines of every node in `node_names`, `parallelism`
+        nodes read at a time.
+        """
+        self._width = max(len(node_name) for node_name in node_names)
+        with ThreadPoolExecutor(max_workers=self.manager.parallelism) as executor:
+            buffers = list(executor.map(self._read, node_names))
+        for record in sorted(record for buffer in buffers for record in buffer):
+            self._print(record)
+
+    def run(self, node_names):
+        """
+        Follows every node in `node_names` until interrupted.
+        """
+        self.start()
+        for node_name in node_names:
+            self.follow(node_name)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def start(self):
+        self._printer = threading.Thread(target=self._print_loop)
+        self._printer.daemon = True
+        self._printer.start()
+
+    def follow(self, node_name):
+        """
+        Starts streaming the output of `node_name`, unless it is already
+        followed.
+        """
+        with self._condition:
+            if self._stopped or (node_name, "bbld") in self._buffers:
+                return
+            for daemon in DAEMON_LOGS:
+                self._buffers[node_name, daemon] = deque(maxlen=self.BUFFER_SIZE)
+            self._width = max(self._width, len(node_name))
+        thread = threading.Thread(target=self._follow_loop, args=(node_name,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Prints the lines still buffered and kills the `tail` processes
+        streaming the logs.
+        """
+        with self._condition:
+            self._stopped = True
+            streams = list(self._streams.values())
+            self._condition.notify()
+        if self._printer:
+            self._printer.join()
+        with ThreadPoolExecutor(max_workers=self.manager.parallelism) as executor:
+            list(executor.map(_close, streams))
+
+    ############# Internal methods ############
+
+    def _read(self, node_name):
+        # With a pattern, every line is read to find the last matching ones
+        stream = self.container_manager.stream_logs(node_name,
+                lines=None if self.pattern else self.lines)
+        return deque(self._records(node_name, stream), maxlen=self.lines)
+
+    def _follow_loop(self, node_name):
+        try:
+            stream = self.container_manager.stream_logs(node_name,
+                    lines=self.lines, follow=True)
+        except Exception as e:
+            print("{}: Cannot stream logs: {!r}".format(node_name, e))
+            return
+        with self._condition:
+            if self._stopped:
+                stream.close()
+                return
+            self._streams[node_name] = stream
+
+        try:
+            for record in self._records(node_name, stream):
+                with self._condition:
+                    buffer = self._buffers[node_name, record[3]]
+                    if len(buffer) == buffer.maxlen:
+                        self._dropped[node_name, record[3]] += 1
+                    buffer.append(record)
+                    self._condition.notify()
+        except Exception as e:
+            if not self._stopped:
+                print("{}: Log stream failed: {!r}".format(node_name, e))
+
+    def _records(self, node_name, stream):
+        """
+        Yields `(timestamp, sequence, node name, daemon, line, received)`
+        records for the lines of `stream` matching the pattern.
+        """
+        timestamps = {}
+        for daemon, line in stream:
+            match = TIMESTAMP.match(line)
+            if match:
+                timestamps[daemon] = match.group(1)
+            if self.pattern and not self.pattern.search(line):
+                continue
+            yield (timestamps.get(daemon, ""), next(self._sequence), node_name,
+                    daemon, line, time.monotonic())
+
+    def _print_loop(self):
+        while True:
+            with self._condition:
+                record = self._next_record()
+                if record is None:
+                    return
+                dropped = self._dropped.pop((record[2], record[3]), 0)
+            if dropped:
+                self._print_line(record[2], record[3],
+                        "... {} line(s) dropped".format(dropped))
+            self._print(record)
+
+    def _next_record(self):
+        """
+        Waits for the earliest buffered line to be held REORDER_DELAY
+        seconds, then removes it from its buffer and returns it. Returns None
+        once stopped with empty buffers. Called with the condition held.
+        """
+        while True:
+            heads = [buffer[0] for buffer in self._buffers.values() if buffer]
+            if not heads:
+                if self._stopped:
+                    return None
+                self._condition.wait()
+                continue
+            record = min(heads)
+            delay = record[5] + self.REORDER_DELAY - time.monotonic()
+            if delay > 0 and not self._stopped:
+                self._condition.wait(delay)
+                continue
+            return self._buffers[record[2], record[3]].popleft()
+
+    def _print(self, record):
+        self._print_line(record[2], record[3], record[4])
+
+    def _print_line(self, node_name, daemon, line):
+        prefix = "{}/{}".format(node_name, daemon)
+        print("{:<{}} | {}".format(prefix, self._width + len("/btcwallet"), line),
+                file=self.output)
+
+def _close(stream):
+    try:
+        stream.close()
+    except Exception:
+        # The container may be gone already
+        pass
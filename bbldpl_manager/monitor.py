@@ -0,0 +1,240 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Name, type and description of the exported metrics, in export order
+METRICS = [
+    ("bbldpl_node_up", "gauge",
+            "Whether the last poll of the node succeeded"),
+    ("bbldpl_block_height", "gauge",
+            "Height of the best block known to bbld"),
+    ("bbldpl_peers", "gauge",
+            "Number of peers bbld is connected to"),
+    ("bbldpl_mempool_transactions", "gauge",
+            "Number of transactions in the mempool of bbld"),
+    ("bbldpl_wallet_balance", "gauge",
+            "Balance of the btcwallet wallet"),
+    ("bbldpl_poll_duration_seconds", "gauge",
+            "Time the last poll of the node took"),
+    ("bbldpl_container_cpu_seconds_total", "counter",
+            "CPU time consumed by the container"),
+    ("bbldpl_container_cpu_ratio", "gauge",
+            "CPU used by the container between the last two Docker stats, "
+            "in number of CPUs"),
+    ("bbldpl_container_memory_bytes", "gauge",
+            "Memory used by the container, page cache excluded"),
+    ("bbldpl_container_memory_limit_bytes", "gauge",
+            "Memory limit of the container")
+]
+
+class Monitor:
+    """
+    Exports the state of the deployed nodes in the Prometheus text format.
+    Every `interval` seconds the block height, peer count, mempool size and
+    wallet balance of every node are polled, `concurrency` nodes at a time
+    (every node, up to MAX_CONCURRENCY, by default), and the container statistics streamed by Docker are consumed by one
+    thread per node. Scrapes of `http://address:port/metrics` are answered
+    from the results of the last poll and never reach the containers.
+    """
+    # Seconds to wait before reopening a Docker stats stream that ended
+    STATS_RETRY_DELAY = 5
+    # Nodes polled at a time by default
+    MAX_CONCURRENCY = 32
+
+    def __init__(self, manager, interval=15, address="127.0.0.1", port=9332,
+            concurrency=None):
+        self.manager = manager
+        self.container_manager = manager.container_manager
+        self.nodes = sorted(node_name for node_name in manager.node_config["nodes"]
+                if node_name in manager.storage_config)
+        self.interval = interval
+        self.concurrency = concurrency or max(1, min(self.MAX_CONCURRENCY, len(self.nodes)))
+        self.address = address
+        self.port = port
+        self.values = {node_name: {} for node_name in self.nodes}
+        self.polls = 0
+        self.last_poll = None
+        self._payload = b""
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+
+    def run(self):
+        """
+        Serves the metrics until interrupted.
+        """
+        self.start()
+        print("Serving metrics of {} node(s) on http://{}:{}/metrics".format(
+                len(self.nodes), self.address, self.server_port))
+        try:
+            self._stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.address, self.port),
+                _handler(self))
+        self._server.daemon_threads = True
+        threads = [threading.Thread(target=self._server.serve_forever),
+                threading.Thread(target=self._poll_loop)]
+        threads += [threading.Thread(target=self._stats_loop, args=(node_name,))
+                for node_name in self.nodes]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def server_port(self):
+        return self._server.server_address[1] if self._server else self.port
+
+    def render(self):
+        """
+        Returns the last rendered metrics page.
+        """
+        with self._lock:
+            return self._payload
+
+    ############# Internal methods ############
+
+    def _poll_loop(self):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self._stopped.is_set():
+                started = time.monotonic()
+                results = dict(zip(self.nodes, executor.map(self._poll, self.nodes)))
+                with self._lock:
+                    for node_name, values in results.items():
+                        self.values[node_name].update(values)
+                    self.polls += 1
+                    self.last_poll = time.time()
+                    self._payload = self._render()
+                self._stopped.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def _poll(self, node_name):
+        started = time.monotonic()
+        values = dict.fromkeys(["bbldpl_block_height", "bbldpl_peers",
+                "bbldpl_mempool_transactions", "bbldpl_wallet_balance"])
+        try:
+            values["bbldpl_block_height"] = self._call(node_name,
+                    "getblockcount", wallet=False)
+            values["bbldpl_peers"] = self._call(node_name,
+                    "getconnectioncount", wallet=False)
+            values["bbldpl_mempool_transactions"] = self._call(node_name,
+                    "getmempoolinfo", wallet=False)["size"]
+            values["bbldpl_wallet_balance"] = self._call(node_name, "getbalance")
+            values["bbldpl_node_up"] = 1
+        except Exception as e:
+            with self._lock:
+                was_up = self.values[node_name].get("bbldpl_node_up") != 0
+            if was_up:
+                print("{}: Poll failed: {!r}".format(node_name, e))
+            values["bbldpl_node_up"] = 0
+        values["bbldpl_poll_duration_seconds"] = time.monotonic() - started
+        return values
+
+    def _stats_loop(self, node_name):
+        while not self._stopped.is_set():
+            try:
+                for stats in self.container_manager.stream_stats(node_name):
+                    values = container_stats(stats)
+                    with self._lock:
+                        self.values[node_name].update(values)
+                    if self._stopped.is_set():
+                        return
+            except Exception as e:
+                print("{}: Stats stream failed: {!r}".format(node_name, e))
+            with self._lock:
+                for name in ["bbldpl_container_cpu_ratio",
+                        "bbldpl_container_memory_bytes"]:
+                    self.values[node_name].pop(name, None)
+            self._stopped.wait(self.STATS_RETRY_DELAY)
+
+    def _render(self):
+        lines = []
+        for name, metric_type, description in METRICS:
+            samples = [(node_name, self.values[node_name].get(name))
+                    for node_name in self.nodes]
+            samples = [(node_name, value) for node_name, value in samples
+                    if value is not None]
+            if not samples:
+                continue
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for node_name, value in samples:
+                lines.append('{}{{node="{}"}} {}'.format(name, node_name,
+                        _format_value(value)))
+        lines.append("# HELP bbldpl_polls_total Number of polls of the nodes")
+        lines.append("# TYPE bbldpl_polls_total counter")
+        lines.append("bbldpl_polls_total {}".format(self.polls))
+        lines.append("# HELP bbldpl_last_poll_timestamp_seconds Time the last poll ended")
+        lines.append("# TYPE bbldpl_last_poll_timestamp_seconds gauge")
+        lines.append("bbldpl_last_poll_timestamp_seconds {}".format(
+                _format_value(self.last_poll)))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def _call(self, node_name, method, *params, wallet=True):
+        node_info = self.manager.node_config["nodes"][node_name]
+        return self.container_manager.call(node_name, node_info["user"],
+                node_info["pass"], method, *params, wallet=wallet,
+                simnet=self.manager.simnet)
+
+def container_stats(stats):
+    """
+    Extracts the CPU and memory metrics of a Docker stats entry. The CPU
+    ratio is computed like `docker stats` does, from the usage deltas since
+    the previous entry.
+    """
+    values = {}
+    cpu = stats.get("cpu_stats") or {}
+    precpu = stats.get("precpu_stats") or {}
+    total = cpu.get("cpu_usage", {}).get("total_usage")
+    if total is not None:
+        values["bbldpl_container_cpu_seconds_total"] = total / 1e9
+        cpu_delta = total - precpu.get("cpu_usage", {}).get("total_usage", 0)
+        system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+        cpus = cpu.get("online_cpus") \
+                or len(cpu.get("cpu_usage", {}).get("percpu_usage") or []) or 1
+        if precpu.get("system_cpu_usage") and system_delta > 0:
+            values["bbldpl_container_cpu_ratio"] = cpu_delta / system_delta * cpus
+
+    memory = stats.get("memory_stats") or {}
+    if "usage" in memory:
+        details = memory.get("stats", {})
+        # cgroup v1 reports the page cache as "cache", v2 as "inactive_file"
+        cache = details.get("cache", details.get("inactive_file", 0))
+        values["bbldpl_container_memory_bytes"] = memory["usage"] - cache
+    if "limit" in memory:
+        values["bbldpl_container_memory_limit_bytes"] = memory["limit"]
+    return values
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _handler(monitor):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            payload = monitor.render()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
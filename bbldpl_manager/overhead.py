@@ -0,0 +1,219 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+from collections import Counter
+
+from bbldpl_manager.bbldpl_manager import BbldplManager
+from bbldpl_manager.simulation import SimulatedDocker
+from bbldpl_manager.topology import TOPOLOGIES, generate_config
+
+PHASES = ["deploy", "provision", "destroy"]
+
+# Seconds between two samples of the resident memory of the process
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+def run(sizes, parallelism=16, topology="small-world", degree=4, accounts=2,
+        latency=0, exec_cost=0, failure_rate=0, seed=None):
+    """
+    Measures the orchestration overhead of the manager against a
+    SimulatedDocker. For every number of nodes in `sizes`, a network of that
+    size is deployed, `accounts` accounts are added to every node with
+    `reconcile`, and the network is destroyed. Returns the wall time, the
+    Docker API calls and the peak resident memory of the process during
+    each phase. Wallet operations use the exec backend, the simulated
+    daemons cannot be reached over the network.
+    """
+    runs = []
+    for size in sizes:
+        runs.append({
+            "nodes": size,
+            "phases": _run_size(size, parallelism, topology, degree, accounts,
+                    SimulatedDocker(latency=latency, exec_cost=exec_cost,
+                            failure_rate=failure_rate, seed=seed), seed)
+        })
+
+    return {
+        "config": {
+            "parallelism": parallelism,
+            "topology": topology,
+            "degree": degree,
+            "accounts": accounts,
+            "latency": latency,
+            "exec_cost": exec_cost,
+            "failure_rate": failure_rate,
+            "seed": seed
+        },
+        "runs": runs
+    }
+
+def print_report(report):
+    print("{:>6}  {:<10} {:>9} {:>8} {:>10} {:>9}  {}".format("nodes", "phase",
+            "seconds", "calls", "execs", "peak MB", "error"))
+    for run in report["runs"]:
+        for phase in PHASES:
+            result = run["phases"][phase]
+            print("{:>6}  {:<10} {:>9.2f} {:>8} {:>10} {:>9}  {}".format(run["nodes"],
+                    phase, result["seconds"], result["calls"],
+                    result["calls_by_name"].get("exec", 0),
+                    "{:.1f}".format(result["peak_memory"] / 1024 ** 2),
+                    result["error"] or ""))
+
+def _run_size(size, parallelism, topology, degree, accounts, daemon, seed):
+    phases = {}
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, "config.json")
+        storage_file = os.path.join(directory, "storage.json")
+        config = generate_config(size, topology, degree=min(degree, size - 1),
+                seed=seed)
+        _write_json(config_file, config)
+
+        def create_manager():
+            return BbldplManager("bbld-simulated", config_file, storage_file,
+                    parallelism=parallelism, client_factory=daemon.client)
+
+        phases["deploy"] = _measure(daemon, lambda: create_manager().deploy())
+
+        for node_info in config["nodes"].values():
+            node_info["accounts"] += ["overhead{}".format(i) for i in range(accounts)]
+        _write_json(config_file, config)
+        phases["provision"] = _measure(daemon, lambda: create_manager().reconcile())
+
+        phases["destroy"] = _measure(daemon, lambda: create_manager().destroy())
+    return phases
+
+def _measure(daemon, function):
+    calls = daemon.get_call_counts()
+    memory = _PeakMemory()
+    error = None
+    start = time.perf_counter()
+    try:
+        # The manager reports every step of every node
+        with memory, open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            function()
+    except Exception as e:
+        error = repr(e)
+    elapsed = time.perf_counter() - start
+
+    made = Counter(daemon.get_call_counts())
+    made.subtract(calls)
+    return {
+        "seconds": elapsed,
+        "calls": sum(made.values()),
+        "calls_by_name": {name: count for name, count in sorted(made.items()) if count},
+        "peak_memory": memory.peak,
+        "error": error
+    }
+
+class _PeakMemory:
+    """
+    Samples the resident memory of the process on a background thread while
+    the context is active, and keeps the peak. Where /proc is not available,
+    the peak is the one of the whole process so far.
+    """
+    STATM = "/proc/self/statm"
+
+    def __init__(self):
+        self.peak = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if os.path.exists(self.STATM):
+            self.peak = self._resident()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread:
+            self._stopped.set()
+            self._thread.join()
+            self.peak = max(self.peak, self._resident())
+        else:
+            # ru_maxrss is in kilobytes on Linux, bytes on macOS
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stopped.wait(MEMORY_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, self._resident())
+
+    def _resident(self):
+        with open(self.STATM, "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+
+def _write_json(filename, data):
+    with open(filename, "w") as f:
+        json.dump(data, f)
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bbldpl_manager.overhead",
+        description="Measures the overhead of deploy, reconcile and destroy "
+            "against a simulated Docker daemon")
+    parser.add_argument("--nodes",
+        help="Comma separated numbers of nodes to run with",
+        default="10,100,1000"
+    )
+    parser.add_argument("--parallelism",
+        help="Number of nodes processed concurrently",
+        type=int,
+        default=16
+    )
+    parser.add_argument("--topology",
+        help="Shape of the simulated networks",
+        choices=sorted(TOPOLOGIES),
+        default="small-world"
+    )
+    parser.add_argument("--degree",
+        help="Number of connections per node",
+        type=int,
+        default=4
+    )
+    parser.add_argument("--accounts",
+        help="Number of accounts added to every node in the provision phase",
+        type=int,
+        default=2
+    )
+    parser.add_argument("--latency",
+        help="Seconds each simulated Docker API call takes",
+        type=float,
+        default=0
+    )
+    parser.add_argument("--exec-cost",
+        help="Seconds each simulated exec takes on top of the latency",
+        type=float,
+        default=0
+    )
+    parser.add_argument("--failure-rate",
+        help="Probability of each simulated Docker API call to fail",
+        type=float,
+        default=0
+    )
+    parser.add_argument("--seed",
+        help="Seed of the topologies and of the injected failures",
+        type=int,
+        default=1
+    )
+    parser.add_argument("--report",
+        help="Path of the JSON report"
+    )
+    args = parser.parse_args()
+
+    report = run([int(size) for size in args.nodes.split(",")],
+            parallelism=args.parallelism, topology=args.topology,
+            degree=args.degree, accounts=args.accounts, latency=args.latency,
+            exec_cost=args.exec_cost, failure_rate=args.failure_rate,
+            seed=args.seed)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import heapq
+
+def place_nodes(node_names, capacities, loads=None, pinned=None):
+    """
+    Assigns every node of `node_names` to a Docker host. `capacities` maps
+    host names to the number of containers they can hold and `loads` to the
+    number they already run. Nodes listed in `pinned` (node name -> host
+    name) go to their host, the others to the host that is the least full
+    relative to its capacity, ties going to the host running the fewest
+    containers. Hosts of unlimited (infinite) capacity are never full, so
+    they are only ordered by their number of containers. Returns a mapping of node names to host names.
+    Raises PlacementError if the hosts cannot hold every node.
+    """
+    loads = dict.fromkeys(capacities, 0) if loads is None else dict(loads)
+    pinned = pinned or {}
+    placement = {}
+
+    for node_name in node_names:
+        host = pinned.get(node_name)
+        if host is None:
+            continue
+        if host not in capacities:
+            raise PlacementError("{}: unknown host {}".format(node_name, host))
+        placement[node_name] = host
+        loads[host] = loads.get(host, 0) + 1
+
+    heap = [_key(host, loads.get(host, 0), capacity)
+            for host, capacity in capacities.items() if capacity > 0]
+    heapq.heapify(heap)
+    for node_name in node_names:
+        if node_name in placement:
+            continue
+        while heap and loads.get(heap[0][-1], 0) >= capacities[heap[0][-1]]:
+            heapq.heappop(heap)
+        if not heap:
+            raise PlacementError("No host has room left for {}".format(node_name))
+        host = heapq.heappop(heap)[-1]
+        placement[node_name] = host
+        loads[host] = loads.get(host, 0) + 1
+        heapq.heappush(heap, _key(host, loads[host], capacities[host]))
+
+    overloaded = [host for host, load in loads.items()
+            if host in capacities and load > capacities[host]]
+    if overloaded:
+        raise PlacementError("Pinned nodes exceed the capacity of {}".format(
+                ", ".join(sorted(overloaded))))
+    return placement
+
+def _key(host, load, capacity):
+    return (load / capacity if capacity != float("inf") else 0, load, host)
+
+#### Exception definitions
+class PlacementError(Exception):
+    pass
@@ -0,0 +1,84 @@
+import os
+import socket
+
+class PortAllocator:
+    """
+    Index of the host ports that are taken, either by a listener on the host
+    or by a container publishing them, and of the ports handed out to nodes
+    by this allocator. Free ports are handed out in increasing order from
+    FIRST_PORT, so the nodes of a deployment get a contiguous range when the
+    host allows it.
+    """
+    FIRST_PORT = 18888
+    LAST_PORT = 65535
+
+    def __init__(self, used=None, first_port=None, probe=True):
+        """
+        `used` maps the ports already taken to a description of their
+        holder. With `probe`, ports are only handed out if they can be bound
+        locally, which only makes sense for ports of this machine.
+        """
+        self.used = dict(used or {})
+        self.owners = {}
+        self.probe = probe
+        self._next_port = first_port or self.FIRST_PORT
+
+    def reserve(self, port, owner):
+        """
+        Hands `port` to `owner`. Raises PortConflictError if it is taken.
+        """
+        port = int(port)
+        if port in self.used:
+            raise PortConflictError("{}: host port {} is used by {}".format(
+                    owner, port, self.used[port]))
+        if self.owners.get(port, owner) != owner:
+            raise PortConflictError("{}: host port {} is also assigned to {}".format(
+                    owner, port, self.owners[port]))
+        self.owners[port] = owner
+        return port
+
+    def allocate(self, owner):
+        """
+        Hands the next free port to `owner` and returns it.
+        """
+        for port in range(self._next_port, self.LAST_PORT + 1):
+            if port in self.used or port in self.owners \
+                    or (self.probe and not _can_bind(port)):
+                continue
+            self._next_port = port + 1
+            return self.reserve(port, owner)
+        raise PortConflictError("{}: no free host port left above {}".format(
+                owner, self.FIRST_PORT))
+
+def get_listening_ports():
+    """
+    Returns the TCP ports listened on by any process of the host, read from
+    /proc/net. Returns an empty set where /proc is not available; the
+    allocator then relies on test binds.
+    """
+    ports = set()
+    for filename in ["/proc/net/tcp", "/proc/net/tcp6"]:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, "r") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                # State 0A is LISTEN
+                if len(fields) > 3 and fields[3] == "0A":
+                    ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+    return ports
+
+def _can_bind(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+#### Exception definitions
+class PortConflictError(Exception):
+    pass
@@ -0,0 +1,147 @@
+import glob
+import os
+import re
+
+from collections import Counter
+
+# Suffixes of the memory sizes Docker accepts
+MEMORY_UNITS = {"b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+_MEMORY = re.compile(r"^(\d+)([bkmg]?)$", re.I)
+_CPULIST = re.compile(r"^\d+(-\d+)?(,\d+(-\d+)?)*$")
+NUMA_NODES = "/sys/devices/system/node/node[0-9]*"
+
+def parse_cpulist(cpulist):
+    """
+    Returns the sorted CPU numbers of a Linux CPU list such as "0-3,8".
+    Raises ValueError if it is malformed.
+    """
+    if not _CPULIST.match(cpulist):
+        raise ValueError("{} is not a CPU list".format(cpulist))
+    cpus = set()
+    for part in cpulist.split(","):
+        first, _, last = part.partition("-")
+        if int(last or first) < int(first):
+            raise ValueError("{} is not a CPU list".format(cpulist))
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else "{}-{}".format(first, last)
+            for first, last in ranges)
+
+def parse_memory(value):
+    """
+    Returns the number of bytes of a memory size given in bytes or as a
+    Docker size string such as "512m". Raises ValueError if it is malformed.
+    """
+    if isinstance(value, int):
+        return value
+    match = _MEMORY.match(str(value))
+    if not match:
+        raise ValueError("{} is not a memory size".format(value))
+    return int(match.group(1)) * MEMORY_UNITS[match.group(2).lower() or "b"]
+
+def get_local_numa_nodes():
+    """
+    Returns the CPUs of each NUMA node of this machine, or None if the
+    kernel does not expose them.
+    """
+    numa_nodes = []
+    for path in sorted(glob.glob(NUMA_NODES),
+            key=lambda path: int(os.path.basename(path)[len("node"):])):
+        try:
+            with open(os.path.join(path, "cpulist"), "r") as f:
+                cpus = parse_cpulist(f.read().strip())
+        except (OSError, ValueError):
+            return None
+        if cpus:
+            numa_nodes.append(cpus)
+    return numa_nodes or None
+
+def node_resources(defaults, node_info):
+    """
+    Returns the resource spec of a node: the `resources` of its
+    configuration on top of the default ones. A node giving its `cores` or
+    its `cpuset` replaces both default ones.
+    """
+    spec = dict(defaults or {})
+    resources = node_info.get("resources", {})
+    if "cores" in resources or "cpuset" in resources:
+        spec.pop("cores", None)
+        spec.pop("cpuset", None)
+    spec.update(resources)
+    return spec
+
+def docker_limits(spec, cpus=None):
+    """
+    Returns the arguments of `containers.run` enforcing the resource spec
+    `spec`, pinned to the CPUs `cpus` if given.
+    """
+    limits = {}
+    if cpus:
+        limits["cpuset_cpus"] = format_cpulist(cpus)
+    elif "cpuset" in spec:
+        limits["cpuset_cpus"] = format_cpulist(parse_cpulist(spec["cpuset"]))
+    if "memory" in spec:
+        limits["mem_limit"] = parse_memory(spec["memory"])
+    if "cpus" in spec:
+        limits["nano_cpus"] = int(spec["cpus"] * 1e9)
+    return limits
+
+def pack_nodes(requests, numa_nodes, used=None, overcommit=False):
+    """
+    Pins nodes to disjoint sets of CPUs of a host. `requests` maps node
+    names to the number of CPUs they need to themselves, `numa_nodes` lists
+    the CPUs of every NUMA node of the host and `used` the CPUs already
+    pinned by its containers.
+
+    Nodes are packed largest first, each on the NUMA node with the fewest
+    free CPUs that can hold it whole, so that a NUMA node is filled before
+    the next one and a node only spans NUMA nodes when none has room for it.
+    Returns a mapping of node names to CPUs and a list of warnings.
+
+    A node that does not fit in the free CPUs raises ResourceError, or with
+    `overcommit` is pinned to the least shared CPUs with a warning.
+    """
+    pinned = Counter(used or [])
+    free = [[cpu for cpu in cpus if not pinned[cpu]] for cpus in numa_nodes]
+    all_cpus = sorted(cpu for cpus in numa_nodes for cpu in cpus)
+    placement = {}
+    warnings = []
+
+    for node_name in sorted(requests, key=lambda name: (-requests[name], name)):
+        count = requests[node_name]
+        available = sum(len(cpus) for cpus in free)
+        fitting = [cpus for cpus in free if len(cpus) >= count]
+        if fitting:
+            cpus = min(fitting, key=len)
+            chosen = cpus[:count]
+        elif available >= count:
+            chosen = []
+            for cpus in sorted(free, key=len, reverse=True):
+                chosen += cpus[:count - len(chosen)]
+            warnings.append("{}: no NUMA node has {} free CPUs, spanning several".format(
+                    node_name, count))
+        elif overcommit and count <= len(all_cpus):
+            chosen = sorted(all_cpus, key=lambda cpu: (pinned[cpu], cpu))[:count]
+            warnings.append("{}: {} CPUs needed, {} free, sharing CPUs {}".format(
+                    node_name, count, available, format_cpulist(chosen)))
+        else:
+            raise ResourceError("{}: {} CPUs needed, {} free out of {}".format(
+                    node_name, count, available, len(all_cpus)))
+
+        for cpus in free:
+            cpus[:] = [cpu for cpu in cpus if cpu not in chosen]
+        pinned.update(chosen)
+        placement[node_name] = sorted(chosen)
+    return placement, warnings
+
+#### Exception definitions
+class ResourceError(Exception):
+    pass
@@ -0,0 +1,186 @@
+import base64
+import http.client
+import json
+import queue
+import ssl
+import threading
+
+class RPCClient:
+    """
+    JSON-RPC client for a bbld or btcwallet RPC server.
+
+    Keeps a pool of keep-alive HTTP(S) connections so that consecutive calls
+    do not pay for a new TCP and TLS handshake. Both daemons use a self-signed
+    certificate, so `cadata` should contain the daemon's `rpc.cert`. If it is
+    not given the certificate is not verified.
+
+    A request is only sent again if it never reached the server, or if all
+    its methods are in IDEMPOTENT_METHODS. Otherwise a failure once the
+    request is sent raises RPCOutcomeUnknownError: the server may have run
+    it, and running `getnewaddress` twice would create another address.
+    """
+    POOL_SIZE = 4
+    TIMEOUT = 60
+    # Methods that can be run again without changing the outcome: the read
+    # only ones, and the ones setting a state
+    IDEMPOTENT_METHODS = {"getaddressesbyaccount", "getbalance", "getblockcount",
+            "getconnectioncount", "getinfo", "getmempoolinfo", "getpeerinfo",
+            "listaccounts", "setgenerate", "walletpassphrase"}
+
+    def __init__(self, host, port, user, passw, tls=True, cadata=None,
+            pool_size=None, timeout=None):
+        self.host = host
+        self.port = int(port)
+        self.tls = tls
+        self.timeout = timeout or self.TIMEOUT
+        self.supports_batch = None
+
+        credentials = "{}:{}".format(user, passw).encode("utf-8")
+        self._headers = {
+            "Authorization": "Basic " + base64.b64encode(credentials).decode("ascii"),
+            "Content-Type": "application/json",
+            "Connection": "keep-alive"
+        }
+
+        self._ssl_context = None
+        if tls:
+            self._ssl_context = ssl.create_default_context(cadata=cadata)
+            # Certificates are issued for the container's hostname
+            self._ssl_context.check_hostname = False
+            if not cadata:
+                self._ssl_context.verify_mode = ssl.CERT_NONE
+
+        self._pool = queue.LifoQueue(maxsize=pool_size or self.POOL_SIZE)
+        self._id_lock = threading.Lock()
+        self._next_id = 0
+
+    def call(self, method, *params):
+        response = self._post(self._request(method, params))
+        return self._result(response)
+
+    def batch(self, calls):
+        """
+        Executes a list of `(method, params)` tuples and returns their results
+        in order. Uses a single JSON-RPC batch request when the server supports
+        it and falls back to sequential calls over the same connection pool
+        otherwise.
+        """
+        if not calls:
+            return []
+
+        if self.supports_batch is not False:
+            requests = [self._request(method, params) for method, params in calls]
+            try:
+                response = self._post(requests)
+            except (RPCError, ValueError):
+                response = None
+            if isinstance(response, list):
+                self.supports_batch = True
+                by_id = {item["id"]: item for item in response}
+                return [self._result(by_id[request["id"]]) for request in requests]
+            self.supports_batch = False
+
+        return [self.call(method, *params) for method, params in calls]
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    ############# Internal methods ############
+
+    def _request(self, method, params):
+        with self._id_lock:
+            self._next_id += 1
+            request_id = self._next_id
+        return {
+            "jsonrpc": "1.0",
+            "id": request_id,
+            "method": method,
+            "params": list(params)
+        }
+
+    def _result(self, response):
+        if response.get("error"):
+            error = response["error"]
+            raise RPCError(error.get("code"), error.get("message"))
+        return response.get("result")
+
+    def _post(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        requests = payload if isinstance(payload, list) else [payload]
+        idempotent = all(request["method"] in self.IDEMPOTENT_METHODS
+                for request in requests)
+        connection = self._acquire()
+        try:
+            try:
+                connection.request("POST", "/", body=body, headers=self._headers)
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection before the
+                # request went out, send it on a fresh one
+                connection.close()
+                connection = self._connect()
+                connection.request("POST", "/", body=body, headers=self._headers)
+            try:
+                data = self._read(connection)
+            except (http.client.HTTPException, ConnectionError) as e:
+                if not idempotent:
+                    raise RPCOutcomeUnknownError(e) from e
+                # The server may have closed the connection without reading
+                # the request, which is harmless to send again
+                connection.close()
+                connection = self._connect()
+                connection.request("POST", "/", body=body, headers=self._headers)
+                data = self._read(connection)
+            except OSError as e:
+                if not idempotent:
+                    raise RPCOutcomeUnknownError(e) from e
+                raise
+        except Exception:
+            connection.close()
+            raise
+        self._release(connection)
+
+        return json.loads(data)
+
+    def _read(self, connection):
+        response = connection.getresponse()
+        data = response.read()
+        if response.status == 401:
+            raise RPCError(401, "Authentication failed")
+        if not data:
+            raise RPCError(response.status, response.reason)
+        return data
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _connect(self):
+        if self.tls:
+            return http.client.HTTPSConnection(self.host, self.port,
+                    timeout=self.timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(self.host, self.port,
+                timeout=self.timeout)
+
+#### Exception definitions
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__("{}: {}".format(code, message))
+        self.code = code
+        self.message = message
+
+# A non idempotent request was sent but no response came back, the server
+# may or may not have run it
+class RPCOutcomeUnknownError(Exception):
+    pass
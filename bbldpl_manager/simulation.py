@@ -0,0 +1,745 @@
+import hashlib
+import itertools
+import json
+import random
+import re
+import shlex
+import socket
+import threading
+import time
+
+from collections import Counter, deque
+
+import docker
+
+from datetime import datetime
+from docker.models.containers import ExecResult
+
+from bbldpl_manager.container import DAEMON_LOGS
+
+class SimulatedDocker:
+    """
+    In-memory stand-in for a Docker daemon running Babylon node images,
+    with the subset of the docker-py client that ContainerManager uses.
+    Containers answer the `bbld`, `btcwallet`, `btcctl`, `pidof` and `kill`
+    commands of a deployment with a small model of the daemons and of the
+    wallet, so a whole deployment runs without Docker.
+
+    Every API call sleeps `latency` seconds and every exec `exec_cost` more.
+    With `failure_rate`, calls fail with an APIError with that probability,
+    optionally only the calls named in `failing` (e.g. "exec",
+    "containers.run"). `calls` counts the calls made, by name. The daemon
+    reports `cpus` CPUs and `memory` bytes of memory. `crash` kills a daemon
+    of a container, which emits its `exec_die` event.
+    """
+    BASE_IMAGE_SIZE = 500 * 1024 ** 2
+    BLOCK_REWARD = 50
+
+    def __init__(self, latency=0, exec_cost=0, failure_rate=0, failing=None,
+            seed=None, cpus=8, memory=16 * 1024 ** 3):
+        self.latency = latency
+        self.exec_cost = exec_cost
+        self.failure_rate = failure_rate
+        self.failing = set(failing) if failing else None
+        self.calls = Counter()
+        # CPUs and memory reported by `info`
+        self.cpus = cpus
+        self.memory = memory
+        self.containers = {}
+        self.networks = {}
+        self.images = {}
+        # Exec ID -> (container, command) of the execs created, and streams
+        # of events
+        self.execs = {}
+        self.subscribers = []
+        # Height of the chain shared by every bbld, and its mempool
+        self.height = 0
+        self.mempool = []
+        self._rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def client(self, url=None):
+        """
+        Returns a client of the simulated daemon. Usable as the
+        `client_factory` of a ContainerManager, in which case every Docker
+        host is served by this daemon.
+        """
+        return SimulatedClient(self)
+
+    def get_call_counts(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def crash(self, node_name, daemon):
+        """
+        Kills `daemon` in the container named `node_name`, as if it crashed.
+        Raises ValueError if it is not running.
+        """
+        with self._lock:
+            container = next(container for container in self.containers.values()
+                    if container.name == node_name)
+        if daemon not in container.processes:
+            raise ValueError("{} is not running in {}".format(daemon, node_name))
+        container._stop_process(daemon, "panic: simulated crash", 2)
+
+    ############# Internal methods ############
+
+    def _call(self, name, cost=0):
+        with self._lock:
+            self.calls[name] += 1
+            fails = self.failure_rate and (self.failing is None or name in self.failing) \
+                    and self._rng.random() < self.failure_rate
+        delay = self.latency + cost
+        if delay:
+            time.sleep(delay)
+        if fails:
+            raise docker.errors.APIError("Simulated failure of {}".format(name))
+
+    def _emit(self, container, action, **attributes):
+        attributes["name"] = container.name
+        event = {
+            "Type": "container",
+            "Action": action,
+            "Actor": {"ID": container.id, "Attributes": attributes},
+            "time": int(time.time()),
+            "timeNano": time.time_ns()
+        }
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for stream in subscribers:
+            stream._push(event)
+
+    def _new_id(self):
+        with self._lock:
+            return hashlib.sha256(str(next(self._ids)).encode("ascii")).hexdigest()
+
+    def _new_address(self):
+        alphabet = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+        with self._lock:
+            return "S" + "".join(self._rng.choice(alphabet) for _ in range(33))
+
+    def _get_image(self, name):
+        with self._lock:
+            if name not in self.images:
+                # Pulled on first use, like `docker run` does
+                self.images[name] = SimulatedImage(self, name, self.BASE_IMAGE_SIZE)
+            return self.images[name]
+
+class SimulatedClient:
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.containers = _Containers(daemon)
+        self.networks = _Networks(daemon)
+        self.images = _Images(daemon)
+        self.api = _API(daemon)
+
+    def ping(self):
+        self.daemon._call("ping")
+        return True
+
+    def info(self):
+        self.daemon._call("info")
+        return {"NCPU": self.daemon.cpus, "MemTotal": self.daemon.memory}
+
+    def events(self, decode=False, filters=None):
+        self.daemon._call("events")
+        return _EventStream(self.daemon, filters)
+
+    def close(self):
+        pass
+
+class SimulatedImage:
+    def __init__(self, daemon, name, size, state=None):
+        self.daemon = daemon
+        self.id = daemon._new_id()
+        self.tags = [name]
+        self.attrs = {"Id": self.id, "Size": size}
+        # State of the container the image was committed from
+        self.state = state
+
+class SimulatedNetwork:
+    def __init__(self, daemon, name):
+        self.daemon = daemon
+        self.id = daemon._new_id()
+        self.name = name
+        self.subnet = len(daemon.networks) % 250 + 2
+        self.hosts = itertools.count(2)
+
+    def remove(self):
+        self.daemon._call("networks.remove")
+        with self.daemon._lock:
+            if self.daemon.networks.pop(self.id, None) is None:
+                raise docker.errors.NotFound("network {} not found".format(self.id))
+
+class SimulatedContainer:
+    """
+    A container and the state of the daemons and wallet running in it.
+    """
+    def __init__(self, daemon, name, image, network, ports):
+        self.daemon = daemon
+        self.id = daemon._new_id()
+        self.name = name
+        self.image = image
+        self.ports = ports or {}
+        self.status = "created"
+        address = "172.17.0.{}".format(len(daemon.containers) % 250 + 2)
+        for candidate in daemon.networks.values():
+            if network in (candidate.id, candidate.name):
+                address = "172.18.{}.{}".format(candidate.subnet,
+                        next(candidate.hosts) % 250 + 2)
+        self.attrs = {
+            "Id": self.id,
+            "Name": "/" + name,
+            "NetworkSettings": {"Networks": {network or "bridge": {"IPAddress": address}}}
+        }
+        self.client = SimulatedClient(daemon)
+        # Process name -> (pid, arguments, ID of the exec running it)
+        self.processes = {}
+        self._pids = itertools.count(100)
+        self._exec_id = None
+        # Log file path -> lines, and PIDs of the `tail -F` following them
+        self.files = {}
+        self._tails = set()
+        self._output = threading.Condition()
+        state = image.state or {}
+        self.wallet = dict(state["wallet"]) if state.get("wallet") else None
+        self.accounts = {account: list(addresses)
+                for account, addresses in state.get("accounts", {}).items()}
+        self.balance = 0
+        self.unlocked = False
+        self.mining = False
+        self.cpu_time = 0
+
+    def start(self):
+        self.daemon._call("container.start")
+        self.status = "running"
+        self.daemon._emit(self, "start")
+
+    def stop(self, timeout=None):
+        self.daemon._call("container.stop")
+        self._check_exists()
+        self.status = "exited"
+        self.processes.clear()
+        self._stop_tails()
+        self.daemon._emit(self, "die", exitCode="0")
+
+    def remove(self, force=False):
+        self.daemon._call("container.remove")
+        with self.daemon._lock:
+            self._check_exists()
+            if self.status == "running" and not force:
+                raise docker.errors.APIError(
+                        "You cannot remove a running container {}".format(self.id))
+            del self.daemon.containers[self.id]
+        self.processes.clear()
+        self._stop_tails()
+
+    def reload(self):
+        self.daemon._call("container.inspect")
+        self._check_exists()
+
+    def commit(self, repository=None, tag=None):
+        self.daemon._call("container.commit")
+        state = {"wallet": self.wallet, "accounts": self.accounts}
+        size = self.image.attrs["Size"] + 1024 ** 2 * (1 + len(self.accounts))
+        name = "{}:{}".format(repository, tag or "latest")
+        image = SimulatedImage(self.daemon, name, size, json.loads(json.dumps(state)))
+        with self.daemon._lock:
+            self.daemon.images[name] = image
+        return image
+
+    def stats(self, stream=True, decode=False):
+        self.daemon._call("container.stats")
+        return self._stats()
+
+    def exec_run(self, cmd, detach=False, tty=False, stdin=False, socket=False,
+            stream=False, demux=False):
+        self.daemon._call("exec", self.daemon.exec_cost)
+        self._check_exists()
+        if self.status != "running":
+            raise docker.errors.APIError("Container {} is not running".format(self.id))
+        args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        self.cpu_time += 0.001
+
+        if args[:2] == ["/bin/bash", "-c"] and " exec " in args[2]:
+            # A daemon started by logged_command, or tail of the logs
+            script = shlex.split(args[2])
+            args = script[script.index("exec") + 1:]
+            if ">>" in args:
+                args = args[:args.index(">>")]
+            if args[0] == "tail":
+                return ExecResult(None, self._tail(args, demux))
+
+        if args[0] == "btcwallet" and "--create" in args:
+            if self.wallet is not None:
+                return ExecResult(1, b"The wallet already exists.\r\n")
+            return ExecResult(None, _WalletDialogue(self))
+        if args[0] in ("bbld", "btcwallet"):
+            return ExecResult(None if detach else 0, self._start(args))
+        if args[:2] == ["/bin/bash", "-c"] and "pidof" in args[2]:
+            # ContainerManager.running_daemons
+            running = [name for name in re.findall(r"pidof -x (\S+)", args[2])
+                    if name in self.processes]
+            return ExecResult(0, "".join(name + "\n" for name in running).encode("ascii"))
+        if args[0] == "pidof":
+            process = self.processes.get(args[-1])
+            if process is None:
+                return ExecResult(1, b"")
+            return ExecResult(0, "{}\n".format(process[0]).encode("ascii"))
+        if args[:2] == ["/bin/bash", "-c"] and args[2].startswith("kill "):
+            pid = int(args[2].split()[1])
+            for name, process in list(self.processes.items()):
+                if process[0] == pid:
+                    self._stop_process(name, "Gracefully shutting down", 0)
+                    return ExecResult(0, b"")
+            with self._output:
+                if pid in self._tails:
+                    self._tails.discard(pid)
+                    self._output.notify_all()
+                    return ExecResult(0, b"")
+            return ExecResult(1, "kill: ({}) - No such process\n".format(pid).encode("ascii"))
+        if args[0] == "btcctl":
+            return self._btcctl(args[1:])
+        if args[0] == "cat":
+            return ExecResult(1, "cat: {}: No such file or directory\n".format(
+                    args[1]).encode("ascii"))
+        return ExecResult(127, "{}: command not found\n".format(args[0]).encode("ascii"))
+
+    ############# Internal methods ############
+
+    def _check_exists(self):
+        if self.id not in self.daemon.containers:
+            raise docker.errors.NotFound("No such container: {}".format(self.id))
+
+    def _start(self, args):
+        name = args[0]
+        if name == "btcwallet" and self.wallet is None:
+            # btcwallet exits at once without a wallet
+            return b""
+        self.processes[name] = (next(self._pids), args, self._exec_id)
+        if name == "btcwallet":
+            self.unlocked = False
+        self._log(name, "Version 0.0.1-simulated")
+        self._log(name, "RPC server listening on {}".format(" ".join(
+                arg.split("=", 1)[1] for arg in args if arg.startswith("--rpclisten="))))
+        return b""
+
+    def _stop_process(self, name, message, exit_code):
+        process = self.processes.pop(name)
+        self._log(name, message)
+        if process[2]:
+            self.daemon._emit(self, "exec_die", execID=process[2],
+                    exitCode=str(exit_code))
+
+    def _log(self, daemon, message):
+        line = "{} [INF] {}: {}".format(
+                datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+                "BBLD" if daemon == "bbld" else "BTCW", message)
+        with self._output:
+            self.files.setdefault(DAEMON_LOGS[daemon], []).append(line)
+            self._output.notify_all()
+
+    def _tail(self, args, demux):
+        """
+        Generates the output of `tail -v -n N [-F] files...`, preceded by its
+        PID like the shell of ContainerManager.stream_logs prints it.
+        """
+        count = args[args.index("-n") + 1]
+        follow = "-F" in args
+        paths = [arg for arg in args[1:] if arg.startswith("/")]
+        pid = next(self._pids)
+        with self._output:
+            if follow:
+                self._tails.add(pid)
+            positions = {path: len(self.files.get(path, [])) for path in paths}
+            output = ["{}".format(pid)]
+            for path in paths:
+                lines = self.files.get(path)
+                if lines is None:
+                    continue
+                shown = lines if count.startswith("+") else lines[len(lines) - int(count):]
+                output += ["==> {} <==".format(path)] + shown
+        current = paths[-1] if paths else None
+
+        def chunk(lines):
+            data = "".join(line + "\n" for line in lines).encode("utf-8")
+            return (data, None) if demux else data
+
+        yield chunk(output)
+        while follow:
+            with self._output:
+                while pid in self._tails and all(len(self.files.get(path, []))
+                        == positions[path] for path in paths):
+                    self._output.wait()
+                if pid not in self._tails:
+                    return
+                output = []
+                for path in paths:
+                    lines = self.files.get(path, [])
+                    if len(lines) > positions[path]:
+                        if path != current:
+                            output += ["", "==> {} <==".format(path)]
+                            current = path
+                        output += lines[positions[path]:]
+                        positions[path] = len(lines)
+            yield chunk(output)
+
+    def _stop_tails(self):
+        with self._output:
+            self._tails.clear()
+            self._output.notify_all()
+
+    def _option(self, name, values=False):
+        process = self.processes.get("bbld")
+        if process is None:
+            return [] if values else None
+        prefix = "--{}=".format(name)
+        found = [arg[len(prefix):] for arg in process[1] if arg.startswith(prefix)]
+        return found if values else (found[0] if found else None)
+
+    def _btcctl(self, args):
+        options = []
+        while args and args[0].startswith("-"):
+            options.append(args.pop(0))
+            if options[-1] in ("-u", "-P"):
+                options.append(args.pop(0))
+        wallet = "--wallet" in options
+        args = [arg for arg in args if arg != "--simnet"]
+        method, params = args[0], args[1:]
+
+        daemon = "btcwallet" if wallet else "bbld"
+        if daemon not in self.processes or "bbld" not in self.processes:
+            return ExecResult(1, "Post \"https://127.0.0.1\": dial tcp: connection "
+                    "refused ({} is not running)\n".format(daemon).encode("ascii"))
+        try:
+            result = self._rpc(method, params, wallet)
+        except _RPCError as e:
+            return ExecResult(1, "{}\n".format(e).encode("utf-8"))
+        if result is None:
+            output = b""
+        elif isinstance(result, str):
+            output = (result + "\n").encode("utf-8")
+        else:
+            output = (json.dumps(result, indent=2) + "\n").encode("utf-8")
+        return ExecResult(0, output)
+
+    def _rpc(self, method, params, wallet):
+        daemon = self.daemon
+        if method == "getinfo":
+            return {"version": 120000, "blocks": daemon.height,
+                    "connections": len(self._option("connect", values=True))}
+        if method == "getpeerinfo":
+            return [{"addr": peer, "inbound": False}
+                    for peer in self._option("connect", values=True)]
+        if method == "getconnectioncount":
+            return len(self._option("connect", values=True))
+        if method == "getblockcount":
+            return daemon.height
+        if method == "getmempoolinfo":
+            with daemon._lock:
+                return {"size": len(daemon.mempool), "bytes": 250 * len(daemon.mempool)}
+        if method == "setgenerate":
+            self.mining = params[0] in ("1", "true")
+            return None
+        if method == "generate":
+            return self._generate(int(params[0]))
+        if not wallet:
+            raise _RPCError("-32601: Method not found")
+
+        if method == "walletpassphrase":
+            if params[0] != self.wallet["passphrase"]:
+                raise _RPCError("-14: invalid passphrase for master private key")
+            self.unlocked = True
+            return None
+        if method == "listaccounts":
+            return {account: self.balance if account == self._mining_account() else 0.0
+                    for account in self.accounts}
+        if method == "getbalance":
+            return float(self.balance)
+        if method == "createnewaccount":
+            self._require_unlocked()
+            if params[0] in self.accounts:
+                raise _RPCError("-4: account {} already exists".format(params[0]))
+            self.accounts[params[0]] = []
+            return None
+        if method == "getnewaddress":
+            account = params[0] if params else "default"
+            if account not in self.accounts:
+                raise _RPCError("-13: account {} not found".format(account))
+            address = daemon._new_address()
+            self.accounts[account].append(address)
+            return address
+        if method == "getaddressesbyaccount":
+            if params[0] not in self.accounts:
+                raise _RPCError("-13: account {} not found".format(params[0]))
+            return list(self.accounts[params[0]])
+        if method == "sendfrom":
+            self._require_unlocked()
+            amount = float(params[2])
+            if amount > self.balance:
+                raise _RPCError("-6: insufficient funds")
+            self.balance -= amount
+            with daemon._lock:
+                txid = hashlib.sha256("{}{}".format(self.id, len(daemon.mempool)).encode(
+                        "ascii")).hexdigest()
+                daemon.mempool.append(txid)
+            return txid
+        raise _RPCError("-32601: Method not found")
+
+    def _generate(self, blocks):
+        daemon = self.daemon
+        with daemon._lock:
+            daemon.height += blocks
+            daemon.mempool = []
+            hashes = [hashlib.sha256(str(daemon.height - i).encode("ascii")).hexdigest()
+                    for i in range(blocks)]
+        if self._option("miningaddr"):
+            self.balance += self.daemon.BLOCK_REWARD * blocks
+        return hashes
+
+    def _mining_account(self):
+        address = self._option("miningaddr")
+        for account, addresses in self.accounts.items():
+            if address in addresses:
+                return account
+        return None
+
+    def _require_unlocked(self):
+        if not self.unlocked:
+            raise _RPCError("-13: the wallet passphrase must be entered first")
+
+    def _stats(self):
+        previous = None
+        while self.id in self.daemon.containers:
+            current = {
+                "cpu_usage": {"total_usage": int(self.cpu_time * 1e9)},
+                "system_cpu_usage": int(time.monotonic() * 1e9),
+                "online_cpus": 1
+            }
+            yield {
+                "cpu_stats": current,
+                "precpu_stats": previous or {"cpu_usage": {}},
+                "memory_stats": {
+                    "usage": (20 + 10 * len(self.processes)) * 1024 ** 2,
+                    "limit": self.attrs.get("HostConfig", {}).get("Memory")
+                            or self.daemon.memory,
+                    "stats": {"inactive_file": 0}
+                }
+            }
+            previous = current
+            time.sleep(1)
+
+class _WalletDialogue:
+    """
+    Socket-like end of a simulated `btcwallet --create` session, playing the
+    prompts matched by WALLET_PROMPTS.
+    """
+    PROMPTS = [
+        b"Enter the private passphrase for your new wallet: ",
+        b"Confirm passphrase: ",
+        b"Do you want to add an additional layer of encryption for public data? "
+                b"(n/no/y/yes) [no]: ",
+        b"Do you have an existing wallet seed you want to use? (n/no/y/yes) [no]: "
+    ]
+
+    def __init__(self, container):
+        self.container = container
+        self.seed = hashlib.sha256(container.id.encode("ascii")).hexdigest()
+        self.answers = []
+        self.output = self.PROMPTS[0]
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        if not self.output:
+            if self.closed or len(self.answers) > len(self.PROMPTS):
+                return b""
+            raise socket.timeout()
+        chunk, self.output = self.output[:size], self.output[size:]
+        return chunk
+
+    def sendall(self, data):
+        self.answers.append(data.rstrip(b"\r\n").decode("utf-8"))
+        step = len(self.answers)
+        if step < len(self.PROMPTS):
+            self.output += self.PROMPTS[step]
+        elif step == len(self.PROMPTS):
+            self.output += ("Your wallet generation seed is:\r\n{}\r\nIMPORTANT: Keep "
+                    "the seed in a safe place as you\r\nwill NOT be able to restore "
+                    "your wallet without it.\r\nOnce you have stored the seed in a "
+                    "safe and secure location, enter \"OK\" to continue: ".format(
+                    self.seed)).encode("ascii")
+        elif self.answers[-1] == "OK":
+            self.container.wallet = {"passphrase": self.answers[0], "seed": self.seed}
+            self.container.accounts = {"default": [], "imported": []}
+            self.output += b"Creating the wallet...\r\nThe wallet has been created " \
+                    b"successfully.\r\n"
+
+    def close(self):
+        self.closed = True
+
+class _Containers:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def run(self, image, name=None, ports=None, network=None, detach=False,
+            **options):
+        self.daemon._call("containers.run")
+        with self.daemon._lock:
+            if any(container.name == name for container in self.daemon.containers.values()):
+                raise docker.errors.APIError("Conflict. The container name /{} is "
+                        "already in use".format(name))
+            container = SimulatedContainer(self.daemon, name,
+                    self.daemon._get_image(image), network, ports)
+            container.attrs["HostConfig"] = {
+                "CpusetCpus": options.get("cpuset_cpus", ""),
+                "Memory": options.get("mem_limit", 0),
+                "NanoCpus": options.get("nano_cpus", 0)
+            }
+            self.daemon.containers[container.id] = container
+        container.status = "running"
+        return container
+
+    def get(self, container_id):
+        self.daemon._call("containers.get")
+        with self.daemon._lock:
+            for container in self.daemon.containers.values():
+                if container_id in (container.id, container.name) \
+                        or container.id.startswith(container_id):
+                    return container
+        raise docker.errors.NotFound("No such container: {}".format(container_id))
+
+    def list(self, all=False):
+        self.daemon._call("containers.list")
+        with self.daemon._lock:
+            return [container for container in self.daemon.containers.values()
+                    if all or container.status == "running"]
+
+class _Networks:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def create(self, name, **options):
+        self.daemon._call("networks.create")
+        network = SimulatedNetwork(self.daemon, name)
+        with self.daemon._lock:
+            self.daemon.networks[network.id] = network
+        return network
+
+    def get(self, network_id):
+        self.daemon._call("networks.get")
+        with self.daemon._lock:
+            if network_id in self.daemon.networks:
+                return self.daemon.networks[network_id]
+            for network in self.daemon.networks.values():
+                if network.name == network_id:
+                    return network
+        raise docker.errors.NotFound("network {} not found".format(network_id))
+
+class _Images:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def get(self, name):
+        self.daemon._call("images.get")
+        with self.daemon._lock:
+            if name in self.daemon.images:
+                return self.daemon.images[name]
+        raise docker.errors.ImageNotFound("No such image: {}".format(name))
+
+    def remove(self, name, force=False):
+        self.daemon._call("images.remove")
+        with self.daemon._lock:
+            if self.daemon.images.pop(name, None) is None:
+                raise docker.errors.ImageNotFound("No such image: {}".format(name))
+
+class _API:
+    """
+    Low level API calls, returning the JSON objects of the Engine API.
+    """
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def containers(self, all=False):
+        self.daemon._call("containers.list")
+        with self.daemon._lock:
+            containers = [container for container in self.daemon.containers.values()
+                    if all or container.status == "running"]
+        return [{
+            "Id": container.id,
+            "Names": ["/" + container.name],
+            "Ports": [{"PrivatePort": int(private.split("/")[0]),
+                    "PublicPort": int(public), "Type": "tcp"}
+                    for private, public in container.ports.items()]
+        } for container in containers]
+
+    def exec_create(self, container_id, cmd, **options):
+        exec_id = self.daemon._new_id()
+        with self.daemon._lock:
+            self.daemon.execs[exec_id] = (self.daemon.containers.get(container_id), cmd)
+        return {"Id": exec_id}
+
+    def exec_start(self, exec_id, detach=False, **options):
+        # Counted as a single "exec" call with exec_create, like exec_run
+        with self.daemon._lock:
+            container, cmd = self.daemon.execs.pop(exec_id)
+        if container is None:
+            raise docker.errors.NotFound("No such exec instance: {}".format(exec_id))
+        container._exec_id = exec_id
+        try:
+            return container.exec_run(cmd, detach=detach).output
+        finally:
+            container._exec_id = None
+
+    def inspect_container(self, container_id):
+        self.daemon._call("containers.inspect")
+        with self.daemon._lock:
+            container = self.daemon.containers.get(container_id)
+        if container is None:
+            raise docker.errors.NotFound("No such container: {}".format(container_id))
+        return container.attrs
+
+class _EventStream:
+    """
+    Stream of the events of a SimulatedDocker, filtered by action.
+    """
+    def __init__(self, daemon, filters):
+        self.daemon = daemon
+        self.actions = set((filters or {}).get("event", []))
+        self._events = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        with daemon._lock:
+            daemon.subscribers.append(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._condition:
+            while not self._events and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise StopIteration
+            return self._events.popleft()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        with self.daemon._lock:
+            if self in self.daemon.subscribers:
+                self.daemon.subscribers.remove(self)
+
+    def _push(self, event):
+        if self.actions and event["Action"] not in self.actions:
+            return
+        with self._condition:
+            self._events.append(event)
+            self._condition.notify_all()
+
+class _RPCError(Exception):
+    pass
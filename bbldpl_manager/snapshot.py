@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from bbldpl_manager.storage import _atomic_write
+
+class SnapshotCache:
+    """
+    Content-addressed cache of provisioned nodes. A snapshot is a Docker
+    image committed from a node's container once its wallet and accounts
+    exist, together with the storage record describing them. Snapshots are
+    keyed by a hash of everything that shaped the container, so a later
+    deployment of the same node spec can start from it.
+
+    The index lives in `index.json` under `directory`. Once the snapshots
+    take more than `budget` bytes, the least recently used ones are evicted.
+    """
+    REPOSITORY = "bbldpl-snapshot"
+    INDEX_FILE = "index.json"
+    DEFAULT_BUDGET = 10 * 1024 ** 3
+
+    def __init__(self, directory, budget=None):
+        self.directory = os.path.abspath(directory)
+        self.budget = budget if budget is not None else self.DEFAULT_BUDGET
+        self.index_file = os.path.join(self.directory, self.INDEX_FILE)
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                self.entries = json.load(f)
+
+    def get_key(self, image_name, node_name, node_info, **options):
+        """
+        Returns the key of a node spec. The node name is part of it so that
+        nodes with identical settings still get wallets of their own. Host
+        ports only affect the port bindings, not the container, and are left
+        out.
+        """
+        spec = {
+            "image": image_name,
+            "node": node_name,
+            "info": {key: value for key, value in node_info.items()
+                    if key != "hostport"},
+            "options": options
+        }
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_image(self, key):
+        return "{}:{}".format(self.REPOSITORY, key[:32])
+
+    def lookup(self, key):
+        """
+        Returns the entry of `key`, marking it as recently used, or None.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry["last_used"] = time.time()
+            self._save()
+            return entry
+
+    def add(self, key, size, record, host=None):
+        """
+        Registers the snapshot image of `key`, taking `size` bytes on the
+        Docker host `host`, with the storage `record` of the node it was
+        taken from. Returns the entries of the snapshots evicted to stay
+        within the budget.
+        """
+        with self._lock:
+            self.entries[key] = {
+                "image": self.get_image(key),
+                "host": host,
+                "size": size,
+                "last_used": time.time(),
+                "record": record
+            }
+            evicted = []
+            total = sum(entry["size"] for entry in self.entries.values())
+            for old_key in sorted(self.entries,
+                    key=lambda k: self.entries[k]["last_used"]):
+                if total <= self.budget or old_key == key:
+                    break
+                total -= self.entries[old_key]["size"]
+                evicted.append(self.entries.pop(old_key))
+            self._save()
+            return evicted
+
+    def remove(self, key):
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        _atomic_write(self.index_file, json.dumps(self.entries))
@@ -0,0 +1,180 @@
+import json
+import os
+import tempfile
+import threading
+
+class JSONStorage:
+    """
+    Keeps the whole storage in a single JSON object. Every flush rewrites the
+    file atomically: the data is written and synced to a temporary file which
+    then replaces the storage file, so a crash never leaves a truncated file.
+    The encoded value of each top level entry is cached, so a flush only
+    encodes the entry that changed.
+
+    Code changing `data` while other threads may flush holds `lock`.
+    """
+    def __init__(self, filename, index=None):
+        self.filename = filename
+        self.index = index
+        self.data = {}
+        self.lock = threading.RLock()
+        # Serializes the writes, so that the newest content is written last
+        self._lock = threading.Lock()
+        self._encoded = {}
+
+    def load(self):
+        if os.path.exists(self.filename):
+            with open(self.filename, "r") as f:
+                self.data = json.load(f)
+        self._encode_all()
+        return self.data
+
+    def flush(self, key=None):
+        """
+        Persists the storage. `key` names the top level entry that changed,
+        every entry is encoded again if it is None.
+        """
+        with self._lock:
+            with self.lock:
+                if key is None:
+                    self._encode_all()
+                elif key in self.data:
+                    self._encoded[key] = json.dumps(self.data[key])
+                else:
+                    self._encoded.pop(key, None)
+                content = "{" + ", ".join(json.dumps(key) + ": " + value
+                        for key, value in self._encoded.items()) + "}"
+            _atomic_write(self.filename, content)
+        if self.index:
+            with self.lock:
+                self.index.update(self.data, key)
+
+    def _encode_all(self):
+        self._encoded = {key: json.dumps(value)
+                for key, value in self.data.items()}
+
+class LogStorage:
+    """
+    Append-only storage. Each flush appends the current value of the changed
+    top level entry (a node, or the network) as a JSON line, so its cost does
+    not grow with the number of nodes. Loading replays the log, ignoring a
+    trailing line left incomplete by a crash. The log is compacted into one
+    line per entry once it holds COMPACT_RATIO times more lines than entries.
+
+    Code changing `data` while other threads may flush holds `lock`.
+    """
+    COMPACT_RATIO = 8
+    COMPACT_MIN_LINES = 64
+
+    def __init__(self, filename, index=None):
+        self.filename = filename
+        self.index = index
+        self.data = {}
+        self.lock = threading.RLock()
+        # Serializes the writes, so that the records keep their order
+        self._lock = threading.Lock()
+        self._lines = 0
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return self.data
+
+        torn = False
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn = True
+                    continue
+                self._lines += 1
+                if record.get("deleted"):
+                    self.data.pop(record["key"], None)
+                else:
+                    self.data[record["key"]] = record["value"]
+
+        # Drop the incomplete line so that new records start on a fresh line
+        if torn:
+            self._compact()
+        return self.data
+
+    def flush(self, key=None):
+        """
+        Appends the entry `key` to the log, or rewrites the compacted log if
+        no key is given.
+        """
+        if key is None:
+            self._compact()
+            if self.index:
+                with self.lock:
+                    self.index.update(self.data)
+            return
+
+        with self._lock:
+            with self.lock:
+                if key in self.data:
+                    line = json.dumps({"key": key, "value": self.data[key]})
+                else:
+                    line = json.dumps({"key": key, "deleted": True})
+            with open(self.filename, "a") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._lines += 1
+            compact = self._lines > max(self.COMPACT_MIN_LINES,
+                    self.COMPACT_RATIO * len(self.data))
+        if compact:
+            self._compact()
+        if self.index:
+            with self.lock:
+                self.index.update(self.data, key)
+
+    def _compact(self):
+        with self._lock:
+            with self.lock:
+                content = "".join(json.dumps({"key": key, "value": value}) + "\n"
+                        for key, value in self.data.items())
+            _atomic_write(self.filename, content)
+            self._lines = len(self.data)
+
+BACKENDS = {
+    "json": JSONStorage,
+    "log": LogStorage
+}
+
+def open_storage(filename, backend="json", index=None):
+    """
+    Creates the storage backend named `backend` for `filename` and loads it.
+    `index`, an AddressIndex, is brought up to date with the loaded storage
+    and then updated on every flush.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown storage backend {}".format(backend))
+    storage = BACKENDS[backend](filename, index=index)
+    storage.load()
+    if index:
+        # The storage may have been flushed without the index, e.g. by a
+        # process that crashed in between
+        index.update(storage.data)
+    return storage
+
+def _atomic_write(filename, content):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory,
+            prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+    # Make the rename itself durable
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
@@ -0,0 +1,311 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Daemons of a node, in the order they are restarted
+DAEMONS = ["bbld", "btcwallet"]
+
+class Supervisor:
+    """
+    Keeps bbld and btcwallet running on the deployed nodes. The daemons of
+    every node are checked every `interval` seconds, `parallelism` nodes at
+    a time, with one `pidof` exec per node. The Docker events of each host
+    trigger an immediate check of a node when a daemon started by the
+    manager exits (`exec_die`) or its container starts.
+
+    A dead daemon is started again with the command it was last started
+    with, so bbld keeps its mining address and connections; the wallet is
+    unlocked after btcwallet and mining resumed after bbld. A daemon
+    dying within STABLE_PERIOD seconds of its restart, or failing to
+    restart, waits MIN_BACKOFF seconds before the next attempt, twice as
+    long on every further failure up to `max_backoff`. Daemons of stopped
+    containers are left alone until the container starts again.
+
+    The restarts and the downtime of every daemon are recorded under
+    `supervisor` in the storage file, and added to by later runs.
+    """
+    STABLE_PERIOD = 60
+    MIN_BACKOFF = 5
+    # Seconds to wait before resubscribing to the events of a host
+    EVENTS_RETRY_DELAY = 5
+
+    def __init__(self, manager, interval=10, max_backoff=300):
+        self.manager = manager
+        self.container_manager = manager.container_manager
+        self.nodes = sorted(node_name for node_name in manager.node_config["nodes"]
+                if node_name in manager.storage_config)
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.states = {}
+        for node_name in self.nodes:
+            recorded = manager.storage_config[node_name].get("supervisor", {})
+            for daemon in DAEMONS:
+                self.states[node_name, daemon] = {
+                    "restarts": recorded.get(daemon, {}).get("restarts", 0),
+                    "downtime": recorded.get(daemon, {}).get("downtime", 0),
+                    "down_since": None,
+                    "restarted_at": None,
+                    "failures": 0,
+                    "retry_at": 0
+                }
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        # Nodes to check at once, and nodes being restarted
+        self._pending = set()
+        self._restarting = set()
+        self._streams = []
+        self._stopped = threading.Event()
+        self._restarter = None
+
+    def run(self):
+        """
+        Supervises the nodes until interrupted, then prints the restarts and
+        downtime of every daemon.
+        """
+        print("Supervising {} node(s)".format(len(self.nodes)))
+        self.start()
+        try:
+            self._stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        self.print_summary()
+
+    def start(self):
+        self._restarter = ThreadPoolExecutor(max_workers=self.manager.parallelism)
+        threads = [threading.Thread(target=self._check_loop)]
+        threads += [threading.Thread(target=self._events_loop, args=(host,))
+                for host in self.container_manager.get_hosts()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped.set()
+            streams = list(self._streams)
+            self._condition.notify()
+        for stream in streams:
+            stream.close()
+        if self._restarter:
+            self._restarter.shutdown(wait=True)
+
+    def print_summary(self):
+        print("Summary:")
+        now = time.monotonic()
+        with self._lock:
+            for (node_name, daemon), state in sorted(self.states.items()):
+                downtime = state["downtime"]
+                if state["down_since"] is not None:
+                    downtime += now - state["down_since"]
+                if state["restarts"] or downtime:
+                    print("\t{}/{}: {} restart(s), down {:.1f}s{}".format(node_name,
+                            daemon, state["restarts"], downtime,
+                            " (still down)" if state["down_since"] is not None else ""))
+        print("Done")
+
+    ############# Internal methods ############
+
+    def _check_loop(self):
+        with ThreadPoolExecutor(max_workers=self.manager.parallelism) as executor:
+            next_round = time.monotonic()
+            while True:
+                with self._condition:
+                    while not self._stopped.is_set() and not self._pending \
+                            and time.monotonic() < next_round:
+                        self._condition.wait(next_round - time.monotonic())
+                    if self._stopped.is_set():
+                        return
+                    if time.monotonic() >= next_round:
+                        nodes = self.nodes
+                        next_round = time.monotonic() + self.interval
+                    else:
+                        nodes = sorted(self._pending)
+                    self._pending.clear()
+                list(executor.map(self._check, nodes))
+
+    def _check(self, node_name):
+        try:
+            running = self.container_manager.running_daemons(node_name)
+        except Exception as e:
+            # The container is stopped or gone, there is nothing to restart
+            for daemon in DAEMONS:
+                self._mark_down(node_name, daemon, "cannot be checked: {!r}".format(e))
+            return
+
+        dead = []
+        for daemon in DAEMONS:
+            if daemon in running:
+                self._mark_up(node_name, daemon)
+            else:
+                self._mark_down(node_name, daemon, "is not running")
+                dead.append(daemon)
+
+        now = time.monotonic()
+        with self._lock:
+            due = [daemon for daemon in dead
+                    if now >= self.states[node_name, daemon]["retry_at"]]
+            if not due or node_name in self._restarting or self._stopped.is_set():
+                return
+            self._restarting.add(node_name)
+            self._restarter.submit(self._restart_node, node_name, due)
+
+    def _mark_down(self, node_name, daemon, reason):
+        now = time.monotonic()
+        with self._lock:
+            state = self.states[node_name, daemon]
+            if state["down_since"] is not None:
+                return
+            state["down_since"] = now
+            # A daemon dying soon after its restart is crash looping
+            if state["restarted_at"] is not None \
+                    and now - state["restarted_at"] < self.STABLE_PERIOD:
+                state["failures"] += 1
+            else:
+                state["failures"] = 0
+            state["retry_at"] = now + self._backoff(state["failures"])
+        print("{}: {} {}".format(node_name, daemon, reason))
+
+    def _mark_up(self, node_name, daemon):
+        with self._lock:
+            state = self.states[node_name, daemon]
+            if state["down_since"] is None:
+                return
+            downtime = time.monotonic() - state["down_since"]
+            state["downtime"] += downtime
+            state["down_since"] = None
+        print("{}: {} is running again after {:.1f}s".format(node_name, daemon, downtime))
+        self._record(node_name)
+
+    def _restart_node(self, node_name, daemons):
+        resume_mining = False
+        try:
+            for daemon in DAEMONS:
+                if daemon not in daemons:
+                    continue
+                try:
+                    self._restart(node_name, daemon)
+                except Exception as e:
+                    now = time.monotonic()
+                    with self._lock:
+                        state = self.states[node_name, daemon]
+                        state["failures"] += 1
+                        delay = self._backoff(state["failures"])
+                        state["retry_at"] = now + delay
+                    print("{}: Restarting {} failed: {!r}, next attempt in {:.0f}s".format(
+                            node_name, daemon, e, delay))
+                    continue
+
+                now = time.monotonic()
+                with self._lock:
+                    state = self.states[node_name, daemon]
+                    downtime = now - state["down_since"] \
+                            if state["down_since"] is not None else 0
+                    state["restarts"] += 1
+                    state["downtime"] += downtime
+                    state["down_since"] = None
+                    state["restarted_at"] = now
+                    restarts = state["restarts"]
+                print("{}: {} restarted after {:.1f}s down ({} restart(s))".format(
+                        node_name, daemon, downtime, restarts))
+                self._record(node_name)
+                resume_mining |= daemon == "bbld"
+
+            # Mining goes through btcwallet, which may have been down too
+            if resume_mining and self.manager._stage_done(node_name, "mining"):
+                node_info = self.manager.node_config["nodes"][node_name]
+                try:
+                    self.container_manager.start_mining(node_name, node_info["user"],
+                            node_info["pass"], simnet=self.manager.simnet)
+                except Exception as e:
+                    print("{}: Resuming mining failed: {!r}".format(node_name, e))
+        finally:
+            with self._lock:
+                self._restarting.discard(node_name)
+
+    def _restart(self, node_name, daemon):
+        node_info = self.manager.node_config["nodes"][node_name]
+        user, passw, simnet = node_info["user"], node_info["pass"], self.manager.simnet
+        print("{}: Restarting {}...".format(node_name, daemon))
+        if daemon == "bbld":
+            if not self.container_manager.restart_daemon(node_name, "bbld"):
+                self._start_bbld(node_name, node_info)
+            self.container_manager.wait_for_bbld_ready(node_name, user, passw,
+                    simnet=simnet, timeout=self.manager.READY_TIMEOUT)
+        else:
+            if not self.container_manager.restart_daemon(node_name, "btcwallet"):
+                self.container_manager.start_btcwallet_daemon(node_name, user,
+                        passw, simnet=simnet)
+            self.container_manager.wait_for_btcwallet_ready(node_name, user, passw,
+                    simnet=simnet, timeout=self.manager.READY_TIMEOUT)
+            self.container_manager.unlock_wallet(node_name, user, passw,
+                    node_info["walletpass"], self.manager.WALLET_TIMEOUT, simnet=simnet)
+
+    def _start_bbld(self, node_name, node_info):
+        """
+        Starts bbld the way the deployment last did, for nodes deployed
+        before the commands of the daemons were recorded.
+        """
+        user, passw, simnet = node_info["user"], node_info["pass"], self.manager.simnet
+        mining_address = None
+        connections = []
+        if self.manager._stage_done(node_name, "connect"):
+            mining_address = self.container_manager.get_first_address(node_name,
+                    user, passw, node_info["miningaccount"], simnet=simnet)
+            connections = self.manager.storage_config[node_name].get("connections", [])
+        self.container_manager.start_bbld_daemon(node_name, user, passw,
+                node_info["rpcport"], node_info["port"], mining_address=mining_address,
+                connections=connections, simnet=simnet)
+
+    def _events_loop(self, host):
+        while not self._stopped.is_set():
+            try:
+                stream = self.container_manager.stream_events(host)
+                with self._condition:
+                    if self._stopped.is_set():
+                        stream.close()
+                        return
+                    self._streams.append(stream)
+                for event in stream:
+                    self._handle_event(event)
+            except Exception as e:
+                if not self._stopped.is_set():
+                    print("{}: Event stream failed: {!r}".format(host, e))
+            self._stopped.wait(self.EVENTS_RETRY_DELAY)
+
+    def _handle_event(self, event):
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        node_name = attributes.get("name")
+        if node_name not in self.manager.storage_config or node_name not in self.nodes:
+            return
+        action = event.get("Action")
+        if action == "exec_die":
+            daemons = self.manager.storage_config[node_name].get("daemons", {})
+            if not any(started.get("exec") == attributes.get("execID")
+                    for started in daemons.values()):
+                # Not a daemon, e.g. a btcctl call
+                return
+        elif action == "oom":
+            print("{}: Container ran out of memory".format(node_name))
+        elif action == "die":
+            print("{}: Container stopped".format(node_name))
+        with self._condition:
+            self._pending.add(node_name)
+            self._condition.notify()
+
+    def _record(self, node_name):
+        with self._lock:
+            stats = {daemon: {
+                "restarts": self.states[node_name, daemon]["restarts"],
+                "downtime": round(self.states[node_name, daemon]["downtime"], 3)
+            } for daemon in DAEMONS}
+        with self.manager.storage.lock:
+            self.manager.storage_config[node_name]["supervisor"] = stats
+        self.manager.storage.flush(node_name)
+
+    def _backoff(self, failures):
+        if not failures:
+            return 0
+        return min(self.MIN_BACKOFF * 2 ** (failures - 1), self.max_backoff)
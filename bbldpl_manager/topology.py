@@ -0,0 +1,215 @@
+import random
+import secrets
+
+from collections import defaultdict
+from itertools import combinations
+
+# bbld accepts 125 peers by default. Every internal connection is dialed by
+# both of its ends, so it takes two peer slots on each node.
+MAX_PEERS = 125
+MAX_DEGREE = MAX_PEERS // 2
+
+NODE_TEMPLATE = {
+    "user": "bbl1",
+    "pass": "bbl2",
+    "port": "18555",
+    "rpcport": "18556",
+    "accounts": ["account1"],
+    "miningaccount": "account1"
+}
+
+def ring(n, degree, rng):
+    if n < 3:
+        return set(combinations(range(n), 2))
+    return {_edge(i, (i + 1) % n) for i in range(n)}
+
+def full_mesh(n, degree, rng):
+    return set(combinations(range(n), 2))
+
+def random_regular(n, degree, rng):
+    """
+    Pairs `degree` stubs per node at random. Pairs that would make a loop
+    or a duplicate edge are put back and paired again, and the whole
+    pairing restarts when no valid pair is left.
+    """
+    if n * degree % 2 or degree >= n:
+        raise TopologyError("No {}-regular graph has {} nodes".format(degree, n))
+    while True:
+        edges = _pair_stubs(n, degree, rng)
+        if edges is not None:
+            return edges
+
+def small_world(n, degree, rng, rewire=0.1):
+    """
+    Watts-Strogatz graph: a ring where each node is linked to its `degree`
+    nearest neighbours, with every edge rewired to a random node with
+    probability `rewire`.
+    """
+    half = max(1, degree // 2)
+    if 2 * half >= n:
+        return full_mesh(n, degree, rng)
+    edges = {_edge(i, (i + j) % n) for i in range(n) for j in range(1, half + 1)}
+    for i in range(n):
+        for j in range(1, half + 1):
+            edge = _edge(i, (i + j) % n)
+            if rng.random() >= rewire:
+                continue
+            target = rng.randrange(n)
+            if target != i and _edge(i, target) not in edges:
+                edges.discard(edge)
+                edges.add(_edge(i, target))
+    return edges
+
+def scale_free(n, degree, rng):
+    """
+    Barabasi-Albert graph: nodes are added one at a time, each linked to
+    `degree / 2` existing nodes chosen with a probability proportional to
+    their degree. Hubs stop accepting connections at MAX_DEGREE.
+    """
+    m = max(1, degree // 2)
+    if m >= n:
+        return full_mesh(n, degree, rng)
+    edges = {_edge(0, i) for i in range(1, m + 1)}
+    degrees = defaultdict(int, {0: m})
+    for i in range(1, m + 1):
+        degrees[i] = 1
+    # Every node appears once per edge it has
+    repeated = [0] * m + list(range(1, m + 1))
+    for node in range(m + 1, n):
+        targets = set()
+        while len(targets) < m:
+            target = rng.choice(repeated)
+            if degrees[target] < MAX_DEGREE:
+                targets.add(target)
+        for target in targets:
+            edges.add(_edge(node, target))
+            degrees[target] += 1
+            repeated += [node, target]
+        degrees[node] = m
+    return edges
+
+TOPOLOGIES = {
+    "ring": ring,
+    "full-mesh": full_mesh,
+    "random-regular": random_regular,
+    "small-world": small_world,
+    "scale-free": scale_free
+}
+
+def generate_config(nodes, topology, degree=4, seed=None, base_hostport=18888,
+        network_name="babylon-network", attempts=10):
+    """
+    Returns a configuration with `nodes` nodes connected according to
+    `topology`. Every node gets its own host port, counting up from
+    `base_hostport`, and a random wallet passphrase. Random topologies are
+    generated again, up to `attempts` times, until they are connected.
+    """
+    if topology not in TOPOLOGIES:
+        raise TopologyError("Unknown topology {}".format(topology))
+    if nodes < 1:
+        raise TopologyError("A network needs at least one node")
+    if base_hostport + nodes > 65536:
+        raise TopologyError("Not enough host ports above {} for {} nodes".format(
+                base_hostport, nodes))
+
+    rng = random.Random(seed)
+    width = len(str(nodes - 1))
+    names = ["node{:0{}d}".format(i, width) for i in range(nodes)]
+    for attempt in range(attempts):
+        edges = TOPOLOGIES[topology](nodes, degree, rng)
+        internal = [[names[i], names[j]] for i, j in sorted(edges)]
+        try:
+            validate_topology(names, internal)
+            break
+        except TopologyError:
+            if attempt == attempts - 1:
+                raise
+
+    node_specs = {}
+    for i, node_name in enumerate(names):
+        node_specs[node_name] = dict(NODE_TEMPLATE,
+                accounts=list(NODE_TEMPLATE["accounts"]),
+                walletpass=secrets.token_hex(16),
+                hostport=str(base_hostport + i))
+    return {
+        "nodes": node_specs,
+        "connections": {
+            "internal": internal,
+            "external": []
+        },
+        "network": {
+            "name": network_name
+        },
+        "simnet": "true"
+    }
+
+def validate_topology(node_names, internal, min_degree=1, max_degree=MAX_DEGREE):
+    """
+    Checks that the `internal` connections only join known, distinct nodes,
+    that every node has between `min_degree` and `max_degree` of them and
+    that the network is connected. Returns the degree of every node. Runs
+    in linear time in the number of nodes and connections.
+    """
+    degrees = {node_name: 0 for node_name in node_names}
+    parents = {node_name: node_name for node_name in node_names}
+
+    def find(node_name):
+        while parents[node_name] != node_name:
+            parents[node_name] = parents[parents[node_name]]
+            node_name = parents[node_name]
+        return node_name
+
+    seen = set()
+    for node1, node2 in internal:
+        for node_name in (node1, node2):
+            if node_name not in degrees:
+                raise TopologyError("Connection to unknown node {}".format(node_name))
+        if node1 == node2:
+            raise TopologyError("Node {} is connected to itself".format(node1))
+        edge = _edge(node1, node2)
+        if edge in seen:
+            raise TopologyError("Nodes {} and {} are connected twice".format(*edge))
+        seen.add(edge)
+        degrees[node1] += 1
+        degrees[node2] += 1
+        parents[find(node1)] = find(node2)
+
+    for node_name, degree in degrees.items():
+        if len(degrees) > 1 and degree < min_degree:
+            raise TopologyError("Node {} has {} connection(s), at least {} required".format(
+                    node_name, degree, min_degree))
+        if degree > max_degree:
+            raise TopologyError("Node {} has {} connections, at most {} allowed".format(
+                    node_name, degree, max_degree))
+
+    components = len({find(node_name) for node_name in degrees})
+    if components > 1:
+        raise TopologyError("The network is split into {} parts".format(components))
+    return degrees
+
+def _edge(node1, node2):
+    return (node1, node2) if node1 < node2 else (node2, node1)
+
+def _pair_stubs(n, degree, rng):
+    edges = set()
+    stubs = list(range(n)) * degree
+    while stubs:
+        leftover = defaultdict(int)
+        rng.shuffle(stubs)
+        pairs = iter(stubs)
+        for node1, node2 in zip(pairs, pairs):
+            edge = _edge(node1, node2)
+            if node1 != node2 and edge not in edges:
+                edges.add(edge)
+            else:
+                leftover[node1] += 1
+                leftover[node2] += 1
+        if leftover and not any(node1 != node2 and _edge(node1, node2) not in edges
+                for node1, node2 in combinations(leftover, 2)):
+            return None
+        stubs = [node for node, count in leftover.items() for _ in range(count)]
+    return edges
+
+#### Exception definitions
+class TopologyError(Exception):
+    pass
@@ -0,0 +1,164 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+
+class Tracer:
+    """
+    Records timed spans. A span opened while another one is open on the same
+    thread (or asyncio task) is its child and inherits its attributes
+    (typically the node name), so Docker API calls made by a ContainerManager
+    method are attributed to the node and stage that triggered them.
+    A disabled tracer records nothing and costs a method call per span.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = []
+        self._origin = time.perf_counter()
+        # Tuple of the spans open in the current thread or task
+        self._open_spans = contextvars.ContextVar("open_spans", default=())
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, attributes)
+
+    def instrument(self, obj, prefix):
+        """
+        Wraps every public method of `obj` in a span named `prefix.method`.
+        Methods taking a `node_name` argument tag their span with it.
+        """
+        if not self.enabled:
+            return obj
+
+        for name, method in inspect.getmembers(obj, inspect.ismethod):
+            if name.startswith("_"):
+                continue
+            parameters = list(inspect.signature(method).parameters)
+            node_index = parameters.index("node_name") \
+                    if "node_name" in parameters else None
+            setattr(obj, name, self._wrap(method, prefix + "." + name, node_index))
+        return obj
+
+    def export(self, filename, trace_format=None):
+        """
+        Writes the recorded spans to `filename`, either as a Chrome trace
+        (viewable in chrome://tracing or Perfetto) or as JSON lines. The
+        format defaults to JSON lines for `.jsonl` files and Chrome otherwise.
+        """
+        if trace_format is None:
+            trace_format = "jsonl" if filename.endswith(".jsonl") else "chrome"
+
+        spans = sorted(self.spans, key=lambda span: span["start"])
+        with open(filename, "w") as f:
+            if trace_format == "jsonl":
+                for span in spans:
+                    f.write(json.dumps(span) + "\n")
+                return
+
+            pid = os.getpid()
+            events = [{
+                "name": span["name"],
+                "cat": span["name"].split(".")[0],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": pid,
+                "tid": span["thread"],
+                "args": span["attributes"]
+            } for span in spans]
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def print_report(self, limit=3):
+        """
+        Prints the `limit` slowest deployment stages of every node, followed
+        by the total time spent per span name.
+        """
+        stages_per_node = defaultdict(list)
+        totals = defaultdict(lambda: [0, 0.0])
+        for span in self.spans:
+            totals[span["name"]][0] += 1
+            totals[span["name"]][1] += span["duration"]
+            if span["name"].startswith("stage.") and "node" in span["attributes"]:
+                stages_per_node[span["attributes"]["node"]].append(span)
+
+        print("Slowest stages per node:")
+        for node_name in sorted(stages_per_node):
+            slowest = sorted(stages_per_node[node_name],
+                    key=lambda span: span["duration"], reverse=True)[:limit]
+            print("\t{}: {}".format(node_name, ", ".join(
+                    "{} {:.2f}s".format(span["name"][len("stage."):], span["duration"])
+                    for span in slowest)))
+
+        print("Time per operation:")
+        print("\t{:<40} {:>8} {:>10}".format("operation", "calls", "total (s)"))
+        for name, (calls, total) in sorted(totals.items(),
+                key=lambda item: item[1][1], reverse=True):
+            print("\t{:<40} {:>8} {:>10.2f}".format(name, calls, total))
+
+    ############# Internal methods ############
+
+    def _wrap(self, method, span_name, node_index):
+        def attributes(args, kwargs):
+            if "node_name" in kwargs:
+                return {"node": kwargs["node_name"]}
+            if node_index is not None and len(args) > node_index:
+                return {"node": args[node_index]}
+            return {}
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def traced_async(*args, **kwargs):
+                with _Span(self, span_name, attributes(args, kwargs)):
+                    return await method(*args, **kwargs)
+            return traced_async
+
+        @functools.wraps(method)
+        def traced(*args, **kwargs):
+            with _Span(self, span_name, attributes(args, kwargs)):
+                return method(*args, **kwargs)
+        return traced
+
+class _Span:
+    __slots__ = ["tracer", "name", "attributes", "start", "token"]
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        open_spans = self.tracer._open_spans.get()
+        if open_spans:
+            self.attributes = dict(open_spans[-1].attributes, **self.attributes)
+        self.token = self.tracer._open_spans.set(open_spans + (self,))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        self.tracer._open_spans.reset(self.token)
+        if exc_type is not None:
+            self.attributes["error"] = repr(exc_value)
+        self.tracer.spans.append({
+            "name": self.name,
+            "start": self.start - self.tracer._origin,
+            "duration": end - self.start,
+            "thread": threading.get_ident(),
+            "attributes": self.attributes
+        })
+        return False
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
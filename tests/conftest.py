@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from bbldpl_manager.bbldpl_manager import BbldplManager
+from bbldpl_manager.simulation import SimulatedDocker
+from bbldpl_manager.topology import generate_config
+
+class Deployment:
+    """
+    A configuration and a storage file in a temporary directory, deployed
+    against a SimulatedDocker. `manager()` returns a new manager, as each
+    command of the CLI would create.
+    """
+    def __init__(self, directory, docker, config):
+        self.config_file = str(directory / "config.json")
+        self.storage_file = str(directory / "storage.json")
+        self.docker = docker
+        self.write_config(config)
+
+    def write_config(self, config):
+        self.config = config
+        with open(self.config_file, "w") as f:
+            json.dump(config, f)
+
+    def manager(self, **options):
+        return BbldplManager("bbld-simulated", self.config_file, self.storage_file,
+                client_factory=self.docker.client, **options)
+
+    def storage(self):
+        with open(self.storage_file, "r") as f:
+            return json.load(f)
+
+    def containers(self):
+        return {container.name: container
+                for container in self.docker.containers.values()}
+
+@pytest.fixture
+def docker():
+    return SimulatedDocker(seed=1)
+
+@pytest.fixture
+def deployment(tmp_path, docker):
+    return Deployment(tmp_path, docker, generate_config(4, "ring", degree=2, seed=1))
@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+import threading
+
+import pytest
+
+from bbldpl_manager.async_container import AsyncContainerManager
+from bbldpl_manager.async_manager import AsyncBbldplManager, _BackgroundStorage
+from bbldpl_manager.bbldpl_manager import DeploymentError
+from bbldpl_manager.container import bbld_command, btcwallet_command
+from bbldpl_manager.docker_async import AsyncDockerClient
+
+class FakeEngine:
+    """
+    The calls of AsyncDockerClient used to create a container and start its
+    daemons, recording the commands of the execs started.
+    """
+    def __init__(self):
+        self.execs = {}
+        self._ids = itertools.count(1)
+
+    async def create_container(self, image_name, name, **options):
+        return "container-{}".format(next(self._ids))
+
+    async def start_container(self, container_id):
+        pass
+
+    async def inspect_container(self, container_id):
+        return {"Id": container_id}
+
+    async def exec_detached(self, container_id, cmd):
+        exec_id = "exec-{}".format(next(self._ids))
+        self.execs[exec_id] = cmd
+        return exec_id
+
+def test_daemons_are_recorded():
+    storage_config = {}
+    manager = AsyncContainerManager(storage_config, host="docker1")
+    manager.client = engine = FakeEngine()
+
+    async def deploy():
+        await manager.create_container("image", "node0", "network", {})
+        await manager.start_bbld_daemon("node0", "user", "pass", "18556", "18555",
+                simnet=True)
+        await manager.start_btcwallet_daemon("node0", "user", "pass", simnet=True)
+    asyncio.run(deploy())
+
+    node = storage_config["node0"]
+    assert node["host"] == "docker1"
+    assert node["daemons"]["bbld"]["command"] == bbld_command("user", "pass",
+            "18556", "18555", simnet=True)
+    assert node["daemons"]["btcwallet"]["command"] == btcwallet_command("user",
+            "pass", simnet=True)
+    for daemon in ["bbld", "btcwallet"]:
+        exec_id = node["daemons"][daemon]["exec"]
+        assert "/var/log/bbldpl/{}.log".format(daemon) in engine.execs[exec_id][-1]
+
+def test_snapshots_are_not_supported(deployment, tmp_path):
+    manager = AsyncBbldplManager("image", deployment.config_file,
+            deployment.storage_file, snapshot_cache=str(tmp_path / "snapshots"))
+    with pytest.raises(DeploymentError, match="Snapshots"):
+        manager.deploy()
+
+class RecordingStorage:
+    """
+    A storage recording the thread every flush runs on.
+    """
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.RLock()
+        self.flushes = []
+
+    def flush(self, key=None):
+        self.flushes.append((key, threading.get_ident()))
+
+def test_storage_is_flushed_off_the_event_loop():
+    storage = _BackgroundStorage(RecordingStorage())
+    manager = AsyncContainerManager(storage.data, storage=storage)
+    manager.client = FakeEngine()
+
+    asyncio.run(manager.create_container("image", "node0", "network", {}))
+    storage.wait()
+
+    assert storage.data["node0"]["containerID"]
+    assert [key for key, _ in storage.storage.flushes] == ["node0"]
+    assert storage.storage.flushes[0][1] != threading.get_ident()
+
+def test_storage_flush_errors_are_raised_on_wait():
+    class FailingStorage(RecordingStorage):
+        def flush(self, key=None):
+            raise OSError("disk full")
+
+    storage = _BackgroundStorage(FailingStorage())
+    storage.flush("node0")
+    with pytest.raises(OSError, match="disk full"):
+        storage.wait()
+
+def test_provisioning_is_bounded():
+    storage_config = {"node0": {"accounts": {}}}
+    manager = AsyncContainerManager(storage_config)
+    running = []
+    peak = []
+
+    async def btcctl(node_name, user, passw, method, *params, simnet=False):
+        if method == "listaccounts":
+            return {}
+        running.append(method)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        return "{}-{}".format(method, params[0])
+    manager._btcctl = btcctl
+
+    generated = asyncio.run(manager.provision_accounts("node0", "user", "pass",
+            ["a", "b", "c"], addresses_per_account=4, concurrency=3))
+
+    assert max(peak) == 3
+    assert {account: len(addresses) for account, addresses in generated.items()} \
+            == {"a": 4, "b": 4, "c": 4}
+    assert len(storage_config["node0"]["accounts"]["a"]["addresses"]) == 4
+
+def serve_one_request_per_connection(requests):
+    """
+    Starts a server answering the first request of a connection with a
+    keep-alive response, and closing the connection without answering the
+    next one. The request lines received are appended to `requests`.
+    """
+    async def handle(reader, writer):
+        answered = False
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            requests.append(line.decode().split()[0])
+            if answered:
+                break
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+            await writer.drain()
+            answered = True
+        writer.close()
+    return asyncio.start_server(handle, "127.0.0.1", 0)
+
+@pytest.mark.parametrize("method, retried", [("GET", True), ("POST", False)])
+def test_requests_retried_on_a_closed_connection(method, retried):
+    requests = []
+
+    async def run():
+        server = await serve_one_request_per_connection(requests)
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncDockerClient("tcp://127.0.0.1:{}".format(port))
+        try:
+            await client.request("GET", "/info")
+            return await client.request(method, "/containers/create")
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    if retried:
+        assert asyncio.run(run()) == (200, b"{}")
+        assert requests == ["GET", "GET", "GET"]
+    else:
+        with pytest.raises((ConnectionError, asyncio.IncompleteReadError)):
+            asyncio.run(run())
+        assert requests == ["GET", "POST"]
@@ -0,0 +1,40 @@
+import threading
+
+from bbldpl_manager.bench import Benchmark, Sampler
+
+def test_sampler_starts_with_a_baseline_height():
+    heights = {"node0": 3, "node1": 3}
+    sampled = threading.Event()
+
+    def call(node_name, method, wallet=True):
+        if method == "getmempoolinfo":
+            return {"size": 0}
+        if node_name == "node1":
+            # The background samples of node1 never complete
+            if sampled.is_set():
+                raise OSError("timeout")
+            sampled.set()
+        return heights[node_name]
+
+    sampler = Sampler(call, ["node0", "node1"], interval=0.01)
+    sampler.start()
+    try:
+        assert sampler.heights == {"node0": 3, "node1": 3}
+        heights["node0"] = 5
+        while sampler.first_seen("node0", 5) is None:
+            pass
+        assert sampler.first_seen("node0", 4) is not None
+    finally:
+        sampler.stop()
+
+def test_bench(deployment):
+    manager = deployment.manager(parallelism=4)
+    manager.deploy()
+
+    report = Benchmark(manager, blocks=5, transactions=5, interval=0.01, seed=1).run()
+
+    blocks = report["runs"][0]["blocks"]
+    assert blocks["count"] == 5
+    assert blocks["unpropagated"] == 0
+    assert blocks["full_propagation_delay"]["count"] == 5
+    assert all(container.mining for container in deployment.containers().values())
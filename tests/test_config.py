@@ -0,0 +1,105 @@
+import copy
+
+import pytest
+
+from bbldpl_manager.config import is_simnet, validate_config
+from bbldpl_manager.topology import (MAX_DEGREE, TOPOLOGIES, TopologyError,
+        generate_config, validate_topology)
+
+@pytest.fixture
+def config():
+    return generate_config(4, "ring", degree=2, seed=1)
+
+def test_generated_config_is_valid(config):
+    assert validate_config(config) == []
+
+def test_schema_errors(config):
+    del config["nodes"]["node0"]["user"]
+    config["nodes"]["node1"]["port"] = "70000"
+    config["nodes"]["node2"]["accounts"] = []
+    config["simnet"] = "maybe"
+
+    errors = validate_config(config)
+    assert "nodes.node0: missing user" in errors
+    assert 'nodes.node1.port: "70000" is not a valid port' in errors
+    assert "nodes.node2.accounts: needs at least 1 items" in errors
+    assert len(errors) == 4
+
+def test_cross_reference_errors(config):
+    nodes = config["nodes"]
+    nodes["node1"]["miningaccount"] = "missing"
+    nodes["node2"]["hostport"] = nodes["node3"]["hostport"]
+    nodes["node3"]["resources"] = {"cores": 1, "cpuset": "0-1"}
+    nodes["node0"]["rpcport"] = nodes["node0"]["port"]
+    config["connections"]["internal"].append(["node0", "unknown"])
+    config["connections"]["external"].append(["node1", "no-port"])
+
+    errors = validate_config(config)
+    assert "nodes.node1.miningaccount: missing is not one of its accounts" in errors
+    assert "nodes.node3.hostport: {} is also used by node2".format(
+            nodes["node3"]["hostport"]) in errors
+    assert "nodes.node3.resources: cores and cpuset are exclusive" in errors
+    assert "nodes.node0: port and rpcport are both 18555" in errors
+    assert "connections.internal[4]: unknown node unknown" in errors
+    assert "connections.external[0]: no-port is not a host:port address" in errors
+
+def test_default_mining_account(config):
+    config["nodes"]["node0"]["miningaccount"] = "default"
+    assert validate_config(config) == []
+
+@pytest.mark.parametrize("simnet, expected", [(True, True), ("true", True),
+        (False, False), ("false", False)])
+def test_is_simnet(config, simnet, expected):
+    config["simnet"] = simnet
+    assert is_simnet(config) == expected
+
+def test_explicit_connections_are_not_capped(config):
+    nodes = {"node{}".format(i): copy.deepcopy(config["nodes"]["node0"])
+            for i in range(MAX_DEGREE + 2)}
+    for i, node_info in enumerate(nodes.values()):
+        node_info["hostport"] = str(20000 + i)
+    config["nodes"] = nodes
+    config["connections"]["internal"] = [["node0", node_name]
+            for node_name in sorted(nodes) if node_name != "node0"]
+
+    assert validate_config(config) == []
+
+@pytest.mark.parametrize("topology", sorted(TOPOLOGIES))
+def test_generated_topologies(topology):
+    config = generate_config(30, topology, degree=4, seed=7)
+
+    assert validate_config(config) == []
+    internal = config["connections"]["internal"]
+    degrees = validate_topology(sorted(config["nodes"]), internal)
+    assert len(degrees) == 30
+    assert max(degrees.values()) <= MAX_DEGREE
+    assert len({port["hostport"] for port in config["nodes"].values()}) == 30
+
+def test_generated_topologies_are_reproducible():
+    first = generate_config(20, "small-world", seed=3)
+    second = generate_config(20, "small-world", seed=3)
+    assert first["connections"] == second["connections"]
+
+def test_ring_and_full_mesh():
+    ring = generate_config(5, "ring", degree=2)["connections"]["internal"]
+    assert len(ring) == 5
+    mesh = generate_config(5, "full-mesh")["connections"]["internal"]
+    assert len(mesh) == 10
+
+def test_validate_topology_errors():
+    with pytest.raises(TopologyError, match="split into 2 parts"):
+        validate_topology(["a", "b", "c", "d"], [["a", "b"], ["c", "d"]])
+    with pytest.raises(TopologyError, match="connected to itself"):
+        validate_topology(["a", "b"], [["a", "a"]])
+    with pytest.raises(TopologyError, match="connected twice"):
+        validate_topology(["a", "b"], [["a", "b"], ["b", "a"]])
+    with pytest.raises(TopologyError, match="unknown node"):
+        validate_topology(["a"], [["a", "b"]])
+
+def test_generate_config_errors():
+    with pytest.raises(TopologyError):
+        generate_config(3, "unknown")
+    with pytest.raises(TopologyError):
+        generate_config(0, "ring")
+    with pytest.raises(TopologyError):
+        generate_config(10, "ring", base_hostport=65530)
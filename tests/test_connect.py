@@ -0,0 +1,33 @@
+import itertools
+
+from bbldpl_manager.topology import generate_config
+
+def test_restart_waves_never_hold_both_ends(deployment):
+    config = generate_config(30, "small-world", degree=4, seed=7)
+    deployment.write_config(config)
+    manager = deployment.manager()
+
+    waves = manager._get_restart_waves(config["nodes"])
+    assert sorted(itertools.chain(*waves)) == sorted(config["nodes"])
+    wave_of = {node_name: i for i, wave in enumerate(waves) for node_name in wave}
+    for node1, node2 in config["connections"]["internal"]:
+        assert wave_of[node1] != wave_of[node2]
+
+def test_hub_restarts_first(deployment):
+    config = deployment.config
+    config["connections"]["internal"] = [["node0", node_name]
+            for node_name in sorted(config["nodes"]) if node_name != "node0"]
+    deployment.write_config(config)
+
+    waves = deployment.manager()._get_restart_waves(config["nodes"])
+    assert waves == [["node0"], ["node1", "node2", "node3"]]
+
+def test_deploy_records_applied_connections(deployment, capsys):
+    deployment.manager(parallelism=4).deploy()
+
+    storage = deployment.storage()
+    assert "Restarting wave 1/2" in capsys.readouterr().out
+    for node_name in deployment.config["nodes"]:
+        assert "connect" in storage[node_name]["stages"]
+        # Both neighbours in the ring
+        assert len(storage[node_name]["connections"]) == 2
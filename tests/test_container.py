@@ -0,0 +1,155 @@
+from collections import Counter
+
+import pytest
+
+from bbldpl_manager.container import (ContainerCommandExecutionError,
+        ContainerDaemonNotReadyError, ContainerManager)
+from bbldpl_manager.rpc import RPCClient, RPCOutcomeUnknownError
+
+@pytest.fixture
+def rpc_attempts(monkeypatch):
+    attempts = Counter()
+    errors = []
+
+    def batch(client, calls):
+        attempts[client.host] += 1
+        raise errors[0]
+    monkeypatch.setattr(RPCClient, "batch", batch)
+    return attempts, errors
+
+def test_unreachable_nodes_use_exec(deployment, rpc_attempts):
+    attempts, errors = rpc_attempts
+    errors.append(TimeoutError("timed out"))
+
+    deployment.manager(parallelism=4, backend="rpc").deploy()
+
+    # One attempt per node, every later call goes through btcctl at once
+    assert sorted(attempts.values()) == [1] * len(deployment.config["nodes"])
+
+def test_refused_connections_are_retried(deployment, rpc_attempts):
+    attempts, errors = rpc_attempts
+    errors.append(ConnectionRefusedError("refused"))
+
+    deployment.manager(parallelism=4, backend="rpc").deploy()
+
+    assert all(count > 1 for count in attempts.values())
+
+def test_wallet_transcript_masks_secrets(deployment):
+    manager = deployment.manager()
+    manager.deploy()
+
+    for node_name, node_storage in deployment.storage().items():
+        if node_name == "network":
+            continue
+        transcript = manager.container_manager.get_wallet_transcript(node_name)
+        assert "generation seed is:" in transcript
+        assert node_storage["wallet"]["seed"] not in transcript
+        assert deployment.config["nodes"][node_name]["walletpass"] not in transcript
+
+def test_bbld_rpc_port_read_from_storage(deployment, monkeypatch):
+    deployment.manager(parallelism=4).deploy()
+    ports = []
+
+    def batch(client, calls):
+        ports.append(client.port)
+        return [{}] * len(calls)
+    monkeypatch.setattr(RPCClient, "batch", batch)
+
+    # A fresh process, which did not start the daemons
+    container_manager = deployment.manager(backend="rpc").container_manager
+    node_info = deployment.config["nodes"]["node0"]
+    container_manager.wait_for_bbld_ready("node0", node_info["user"], node_info["pass"],
+            simnet=True)
+
+    assert ports == [int(node_info["rpcport"])]
+
+def test_unknown_outcome_is_not_replayed(deployment, rpc_attempts):
+    attempts, errors = rpc_attempts
+    deployment.manager(parallelism=4).deploy()
+    errors.append(RPCOutcomeUnknownError("Remote end closed connection"))
+    execs = deployment.docker.get_call_counts()["exec"]
+
+    container_manager = deployment.manager(backend="rpc").container_manager
+    node_info = deployment.config["nodes"]["node0"]
+    with pytest.raises(ContainerCommandExecutionError, match="failed: Remote end closed"):
+        container_manager.generate_address("node0", node_info["user"], node_info["pass"],
+                "default", simnet=True)
+    # Only the exec reading the RPC certificate, no btcctl
+    assert deployment.docker.get_call_counts()["exec"] == execs + 1
+
+def test_probe_backs_off_until_ready(docker):
+    container_manager = ContainerManager({}, client_factory=docker.client)
+    container_manager.PROBE_MIN_DELAY = 0.01
+    results = iter([False, False, True])
+
+    container_manager._wait_for("node0", "bbld", lambda: next(results), timeout=5)
+    assert container_manager.get_probe_latencies()["node0"]["bbld"]["attempts"] == 3
+
+    with pytest.raises(ContainerDaemonNotReadyError, match="bbld probe did not pass"):
+        container_manager._wait_for("node0", "bbld", lambda: False, timeout=0.05)
+
+def test_deploy_waits_on_probes(deployment):
+    manager = deployment.manager(parallelism=4)
+    manager.deploy()
+
+    latencies = manager.container_manager.get_probe_latencies()
+    for node_name in deployment.config["nodes"]:
+        assert {"bbld", "btcwallet"} <= set(latencies[node_name])
+        # The simulated daemons answer at once, no sleep is needed
+        assert latencies[node_name]["bbld"]["attempts"] == 1
+
+def test_container_handles_are_cached(deployment):
+    deployment.manager(parallelism=4).deploy()
+    container_manager = deployment.manager().container_manager
+    calls = deployment.docker.get_call_counts()
+
+    container = container_manager._get_container("node0")
+    assert container_manager._get_container("node0") is container
+    assert deployment.docker.get_call_counts().get("containers.get", 0) == \
+            calls.get("containers.get", 0) + 1
+    assert deployment.docker.get_call_counts().get("containers.list", 0) == \
+            calls.get("containers.list", 0)
+
+    container_manager.invalidate_container_cache(container.id)
+    container_manager._get_container("node0")
+    assert container_manager.cache_misses == 2
+
+    container_manager.CONTAINER_CACHE_TTL = 0
+    container_manager._get_container("node0")
+    assert container_manager.cache_misses == 3
+    assert container_manager.cache_hits == 1
+
+def test_removed_container_is_not_found(deployment):
+    deployment.manager(parallelism=4).deploy()
+    container_manager = deployment.manager().container_manager
+    container = container_manager._get_container("node0")
+    container.remove(force=True)
+    container_manager.invalidate_container_cache()
+
+    assert container_manager._get_container("node0") is None
+
+def test_accounts_are_provisioned_in_batches(deployment):
+    deployment.manager(parallelism=4).deploy()
+    container_manager = deployment.manager().container_manager
+    container_manager.RPC_BATCH_SIZE = 4
+    batches = []
+    btcctl_batch = container_manager._btcctl_batch
+
+    def record(container, node_name, user, passw, calls, **options):
+        batches.append([method for method, _ in calls])
+        return btcctl_batch(container, node_name, user, passw, calls, **options)
+    container_manager._btcctl_batch = record
+
+    node_info = deployment.config["nodes"]["node0"]
+    existing = node_info["accounts"][0]
+    generated = container_manager.provision_accounts("node0", node_info["user"],
+            node_info["pass"], [existing, "new0", "new1", "new0"],
+            addresses_per_account=3, simnet=True)
+
+    assert batches == [["listaccounts"], ["createnewaccount"] * 2,
+            ["getnewaddress"] * 4, ["getnewaddress"] * 4, ["getnewaddress"]]
+    assert {account: len(addresses) for account, addresses in generated.items()} == \
+            {existing: 3, "new0": 3, "new1": 3}
+    accounts = deployment.storage()["node0"]["accounts"]
+    assert accounts["new0"]["addresses"] == generated["new0"]
+    assert accounts[existing]["addresses"][-3:] == generated[existing]
@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+from bbldpl_manager.bbldpl_manager import BbldplManager, DeploymentError
+from bbldpl_manager.config import validate_config
+from bbldpl_manager.topology import generate_config
+
+def test_deploy(deployment):
+    deployment.manager(parallelism=4).deploy()
+
+    storage = deployment.storage()
+    containers = deployment.containers()
+    assert sorted(containers) == sorted(deployment.config["nodes"])
+    for node_name, node_info in deployment.config["nodes"].items():
+        assert storage[node_name]["stages"] == BbldplManager.NODE_STAGES \
+                + BbldplManager.NETWORK_STAGES
+        # The wallet also has its default account
+        assert set(node_info["accounts"]) <= set(storage[node_name]["accounts"])
+        for account in storage[node_name]["accounts"].values():
+            assert len(account["addresses"]) == 1
+        assert storage[node_name]["containerID"] == containers[node_name].id
+        assert sorted(containers[node_name].processes) == ["bbld", "btcwallet"]
+        assert containers[node_name].unlocked
+        assert containers[node_name].mining
+    assert "network" in storage
+
+def test_deploy_twice_is_a_no_op(deployment):
+    deployment.manager(parallelism=4).deploy()
+    calls = deployment.docker.get_call_counts()
+
+    deployment.manager(parallelism=4).deploy()
+    again = deployment.docker.get_call_counts()
+    assert again.get("containers.run") == calls.get("containers.run")
+    assert again.get("exec", 0) - calls.get("exec", 0) < len(deployment.config["nodes"]) * 3
+
+def test_deploy_resumes_after_failure(deployment):
+    # Every exec fails once the containers are created
+    deployment.docker.failure_rate = 1
+    deployment.docker.failing = {"exec"}
+    with pytest.raises(DeploymentError):
+        deployment.manager(parallelism=4).deploy()
+    storage = deployment.storage()
+    for node_name in deployment.config["nodes"]:
+        assert storage[node_name]["stages"] == ["container"]
+
+    deployment.docker.failure_rate = 0
+    runs = deployment.docker.get_call_counts()["containers.run"]
+    deployment.manager(parallelism=4).deploy()
+
+    # The containers of the first run are reused
+    assert deployment.docker.get_call_counts()["containers.run"] == runs
+    storage = deployment.storage()
+    for node_name in deployment.config["nodes"]:
+        assert storage[node_name]["stages"][-1] == "mining"
+        assert deployment.containers()[node_name].unlocked
+
+def test_reconcile(deployment):
+    deployment.manager(parallelism=4).deploy()
+
+    config = deployment.config
+    removed = sorted(config["nodes"])[-1]
+    del config["nodes"][removed]
+    config["connections"]["internal"] = [connection
+            for connection in config["connections"]["internal"]
+            if removed not in connection]
+    kept = sorted(config["nodes"])[0]
+    config["nodes"][kept]["accounts"].append("extra")
+    deployment.write_config(config)
+    deployment.manager(parallelism=4).reconcile()
+
+    storage = deployment.storage()
+    assert removed not in storage
+    assert removed not in deployment.containers()
+    assert len(storage[kept]["accounts"]["extra"]["addresses"]) == 1
+
+def test_destroy(deployment):
+    deployment.manager(parallelism=4).deploy()
+    deployment.manager(parallelism=4).destroy()
+
+    assert deployment.containers() == {}
+    assert deployment.docker.networks == {}
+    storage = deployment.storage()
+    assert not any(node_name in storage for node_name in deployment.config["nodes"])
+
+@pytest.mark.parametrize("convert", [str, int])
+def test_valid_config_deploys(deployment, convert):
+    config = deployment.config
+    for node_info in config["nodes"].values():
+        for key in ["port", "rpcport", "hostport"]:
+            node_info[key] = convert(node_info[key])
+    config["nodes"]["node0"]["resources"] = {"memory": 512 * 1024 ** 2}
+    assert validate_config(config) == []
+    deployment.write_config(config)
+
+    deployment.manager(parallelism=4).deploy()
+
+    storage = deployment.storage()
+    for node_name, node_info in config["nodes"].items():
+        assert storage[node_name]["stages"][-1] == "mining"
+        assert storage[node_name]["hostport"] == str(node_info["hostport"])
+
+HOSTS = [
+    {"name": "worker0", "url": "tcp://192.168.1.10:2375"},
+    {"name": "worker1", "url": "tcp://192.168.1.11:2375"}
+]
+
+def test_hosts_are_pinged(deployment):
+    deployment.write_config(dict(deployment.config, hosts=HOSTS))
+    deployment.manager()
+
+    assert deployment.docker.calls["ping"] == len(HOSTS)
+
+def test_unreachable_host_fails_before_deploying(deployment):
+    deployment.write_config(dict(deployment.config, hosts=HOSTS))
+    deployment.docker.failure_rate = 1
+    deployment.docker.failing = {"ping"}
+
+    with pytest.raises(DeploymentError, match="Cannot reach Docker host worker0"):
+        deployment.manager()
+    assert deployment.docker.containers == {}
+
+def test_storage_is_a_json_object_by_default(deployment):
+    # Whatever the size of the network
+    deployment.write_config(generate_config(60, "ring", degree=2, seed=1))
+    deployment.manager(parallelism=16).deploy()
+
+    with open(deployment.storage_file, "r") as f:
+        assert sorted(json.load(f)) == sorted(list(deployment.config["nodes"]) + ["network"])
@@ -0,0 +1,37 @@
+import re
+import socket
+
+import pytest
+
+from bbldpl_manager.expect import ExpectSession, ExpectTimeoutError
+
+SECRETS = [re.compile(rb"seed is: (?P<secret>[0-9a-f]+)")]
+
+@pytest.fixture
+def sockets():
+    program, session_sock = socket.socketpair()
+    yield program, session_sock
+    program.close()
+
+def test_secret_split_over_chunks_is_masked(sockets):
+    program, session_sock = sockets
+    session = ExpectSession(session_sock, timeout=5, masks=SECRETS)
+    program.sendall(b"Passphrase: ")
+    session.expect(re.compile(rb"Passphrase: "))
+    session.sendline("hunter2", secret=True)
+    program.sendall(b"seed is: 0123")
+    session.expect(re.compile(rb"seed is: 0123"))
+    program.sendall(b"abcd\r\nDone")
+    session.expect(re.compile(rb"Done"))
+
+    assert session.format_transcript() == \
+            "Passphrase: > *****\nseed is: *****\r\nDone"
+
+def test_timeout_transcript_masks_partial_secret(sockets):
+    program, session_sock = sockets
+    session = ExpectSession(session_sock, timeout=0.1, masks=SECRETS)
+    program.sendall(b"seed is: 0123ab")
+
+    with pytest.raises(ExpectTimeoutError) as excinfo:
+        session.expect(re.compile(rb"to continue:"))
+    assert excinfo.value.transcript == "seed is: *****"
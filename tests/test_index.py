@@ -0,0 +1,128 @@
+import io
+import json
+import os
+
+import pytest
+
+from bbldpl_manager.index import AddressIndex, export_addresses
+
+def storage_data():
+    return {
+        "network": "abc",
+        "node0": {"accounts": {
+            "default": {"addresses": ["a0", "a1"]},
+            "mining": {"addresses": ["m0"]}
+        }},
+        "node1": {"accounts": {"default": {"addresses": ["b0"]}}}
+    }
+
+@pytest.fixture
+def index(tmp_path):
+    index = AddressIndex(str(tmp_path / "storage.json.index"))
+    yield index
+    index.close()
+
+def test_owner(index):
+    index.update(storage_data())
+
+    assert index.owner("a1") == ("node0", "default")
+    assert index.owner("m0") == ("node0", "mining")
+    assert index.owner("b0") == ("node1", "default")
+    assert index.owner("unknown") is None
+
+def test_addresses_in_generation_order(index):
+    data = storage_data()
+    index.update(data)
+    data["node0"]["accounts"]["default"]["addresses"].append("a2")
+    index.update(data, "node0")
+
+    assert list(index.addresses()) == [
+        ("node0", "default", "a0"),
+        ("node0", "default", "a1"),
+        ("node0", "default", "a2"),
+        ("node0", "mining", "m0"),
+        ("node1", "default", "b0")
+    ]
+    assert [row[2] for row in index.addresses(node_name="node0", account="default")] == \
+            ["a0", "a1", "a2"]
+    assert [row[2] for row in index.addresses(account="default")] == \
+            ["a0", "a1", "a2", "b0"]
+
+def test_removed_nodes_and_accounts(index):
+    data = storage_data()
+    index.update(data)
+    del data["node1"]
+    index.update(data, "node1")
+    del data["node0"]["accounts"]["mining"]
+    index.update(data)
+
+    assert index.owner("b0") is None
+    assert index.owner("m0") is None
+    assert [row[2] for row in index.addresses()] == ["a0", "a1"]
+
+def test_recreated_account_is_indexed_again(index):
+    data = storage_data()
+    index.update(data)
+    # The node was deployed again with as many addresses as before
+    data["node1"]["accounts"]["default"]["addresses"] = ["c0"]
+    index.update(data, "node1")
+
+    assert index.owner("b0") is None
+    assert index.owner("c0") == ("node1", "default")
+
+def test_rebuild(index):
+    index.update(storage_data())
+    index.rebuild({"node2": {"accounts": {"x": {"addresses": ["x0"]}}}})
+
+    assert list(index.addresses()) == [("node2", "x", "x0")]
+
+def test_export(index):
+    index.update(storage_data())
+
+    output = io.StringIO()
+    assert export_addresses(index.addresses(node_name="node1"), output) == 1
+    assert output.getvalue().splitlines() == ["node,account,address", "node1,default,b0"]
+
+    output = io.StringIO()
+    assert export_addresses(index.addresses(account="mining"), output, "jsonl") == 1
+    assert json.loads(output.getvalue()) == \
+            {"node": "node0", "account": "mining", "address": "m0"}
+
+def test_deployment_is_indexed(deployment):
+    deployment.manager(parallelism=4).deploy()
+    storage = deployment.storage()
+
+    index = AddressIndex(deployment.storage_file + ".index")
+    try:
+        for node_name in deployment.config["nodes"]:
+            for account, account_data in storage[node_name]["accounts"].items():
+                for address in account_data["addresses"]:
+                    assert index.owner(address) == (node_name, account)
+    finally:
+        index.close()
+
+def test_created_with_the_first_account(tmp_path):
+    filename = str(tmp_path / "storage.json.index")
+    index = AddressIndex(filename)
+    try:
+        index.update({"network": "abc", "node0": {"accounts": {}}})
+        assert not os.path.exists(filename)
+
+        index.update({"node0": {"accounts": {"default": {"addresses": []}}}}, "node0")
+        assert os.path.exists(filename)
+    finally:
+        index.close()
+
+def test_queried_without_accounts(tmp_path):
+    filename = str(tmp_path / "storage.json.index")
+    index = AddressIndex(filename)
+    try:
+        assert index.owner("a0") is None
+        assert list(index.addresses()) == []
+    finally:
+        index.close()
+
+def test_destroy_leaves_no_index(deployment):
+    deployment.manager().destroy()
+
+    assert not os.path.exists(deployment.storage_file + ".index")
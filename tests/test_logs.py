@@ -0,0 +1,109 @@
+import io
+import threading
+
+from bbldpl_manager.logs import LogAggregator
+
+class FakeStream:
+    def __init__(self, lines, release=None):
+        self.lines = lines
+        self.release = release
+        self.closed = False
+
+    def __iter__(self):
+        for i, line in enumerate(self.lines):
+            if i == 1 and self.release:
+                self.release.wait()
+            yield line
+
+    def close(self):
+        self.closed = True
+
+class FakeManager:
+    parallelism = 2
+
+    def __init__(self, streams):
+        self.container_manager = self
+        self.streams = streams
+
+    def stream_logs(self, node_name, lines=None, follow=False):
+        return self.streams[node_name]
+
+def printed(output):
+    return [line.split(" | ")[1] for line in output.getvalue().splitlines()]
+
+def test_show_merges_nodes_by_time():
+    manager = FakeManager({
+        "node0": FakeStream([
+            ("bbld", "2026-01-01 10:00:00.000 [INF] a"),
+            ("bbld", "continued"),
+            ("bbld", "2026-01-01 10:00:02.000 [INF] c")
+        ]),
+        "node1": FakeStream([
+            ("btcwallet", "2026-01-01 10:00:01.000 [INF] b"),
+            ("bbld", "2026-01-01 10:00:03.000 [INF] d")
+        ])
+    })
+    output = io.StringIO()
+    LogAggregator(manager, output=output).show(["node0", "node1"])
+
+    assert printed(output) == [
+        "2026-01-01 10:00:00.000 [INF] a",
+        "continued",
+        "2026-01-01 10:00:01.000 [INF] b",
+        "2026-01-01 10:00:02.000 [INF] c",
+        "2026-01-01 10:00:03.000 [INF] d"
+    ]
+    assert output.getvalue().startswith("node0/bbld ")
+
+def test_show_keeps_last_matching_lines():
+    manager = FakeManager({"node0": FakeStream([
+        ("bbld", "2026-01-01 10:00:0{}.000 [INF] {}".format(i, word))
+        for i, word in enumerate(["peer", "block", "peer", "peer"])
+    ])})
+    output = io.StringIO()
+    LogAggregator(manager, lines=2, pattern="peer", output=output).show(["node0"])
+
+    assert printed(output) == [
+        "2026-01-01 10:00:02.000 [INF] peer",
+        "2026-01-01 10:00:03.000 [INF] peer"
+    ]
+
+def test_follow_reorders_late_lines():
+    release = threading.Event()
+    # node0 writes its second line after node1's line but delivers it late
+    streams = {
+        "node0": FakeStream([
+            ("bbld", "2026-01-01 10:00:00.000 [INF] a"),
+            ("bbld", "2026-01-01 10:00:01.000 [INF] b")
+        ], release),
+        "node1": FakeStream([("bbld", "2026-01-01 10:00:02.000 [INF] c")])
+    }
+    output = io.StringIO()
+    aggregator = LogAggregator(FakeManager(streams), output=output)
+    aggregator.REORDER_DELAY = 0.3
+    aggregator.start()
+    aggregator.follow("node0")
+    aggregator.follow("node1")
+    threading.Timer(0.05, release.set).start()
+    threading.Event().wait(0.6)
+    aggregator.stop()
+
+    assert printed(output) == [
+        "2026-01-01 10:00:00.000 [INF] a",
+        "2026-01-01 10:00:01.000 [INF] b",
+        "2026-01-01 10:00:02.000 [INF] c"
+    ]
+    assert all(stream.closed for stream in streams.values())
+
+def test_deployment_logs(deployment):
+    manager = deployment.manager(parallelism=4)
+    manager.deploy()
+    output = io.StringIO()
+    LogAggregator(manager, lines=3, output=output).show(sorted(deployment.config["nodes"]))
+
+    lines = output.getvalue().splitlines()
+    prefixes = {line.split(" | ")[0].strip() for line in lines}
+    assert {"node{}/{}".format(i, daemon) for i in range(4)
+            for daemon in ["bbld", "btcwallet"]} <= prefixes
+    timestamps = [line.split(" | ")[1][:23] for line in lines]
+    assert timestamps == sorted(timestamps)
@@ -0,0 +1,51 @@
+import threading
+import time
+import urllib.request
+
+from bbldpl_manager.monitor import Monitor
+
+def test_nodes_are_polled_concurrently(deployment):
+    manager = deployment.manager()
+    manager.deploy()
+    monitor = Monitor(manager, interval=60, port=0)
+    assert monitor.concurrency == len(deployment.config["nodes"])
+
+    active = []
+    peak = [0]
+    lock = threading.Lock()
+    poll = monitor._poll
+
+    def slow_poll(node_name):
+        with lock:
+            active.append(node_name)
+            peak[0] = max(peak[0], len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(node_name)
+        return poll(node_name)
+    monitor._poll = slow_poll
+
+    monitor.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not monitor.polls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(
+                monitor.server_port)) as response:
+            page = response.read().decode("utf-8")
+    finally:
+        monitor.stop()
+
+    assert peak[0] == len(deployment.config["nodes"])
+    for node_name in deployment.config["nodes"]:
+        assert 'bbldpl_node_up{{node="{}"}} 1'.format(node_name) in page
+    assert "# TYPE bbldpl_block_height gauge" in page
+
+def test_concurrency_is_capped(deployment, monkeypatch):
+    monkeypatch.setattr(Monitor, "MAX_CONCURRENCY", 2)
+    manager = deployment.manager()
+    assert Monitor(manager).concurrency == 1
+
+    manager.deploy()
+    assert Monitor(manager).concurrency == 2
+    assert Monitor(manager, concurrency=3).concurrency == 3
@@ -0,0 +1,38 @@
+from collections import Counter
+
+import pytest
+
+from bbldpl_manager.placement import PlacementError, place_nodes
+
+NODES = ["node{}".format(i) for i in range(6)]
+
+def test_spreads_over_hosts_without_capacity():
+    inf = float("inf")
+    placement = place_nodes(NODES, {"a": inf, "b": inf}, loads={"a": 1, "b": 0})
+
+    assert Counter(placement.values()) == {"a": 3, "b": 3}
+
+def test_fills_hosts_relative_to_capacity():
+    placement = place_nodes(NODES, {"a": 2, "b": 4})
+
+    assert Counter(placement.values()) == {"a": 2, "b": 4}
+
+def test_pinned_nodes():
+    placement = place_nodes(NODES[:3], {"a": 2, "b": 2}, pinned={"node0": "b"})
+
+    assert placement["node0"] == "b"
+    assert Counter(placement.values()) == {"a": 2, "b": 1}
+    with pytest.raises(PlacementError, match="unknown host c"):
+        place_nodes(NODES[:1], {"a": 1}, pinned={"node0": "c"})
+    with pytest.raises(PlacementError, match="No host has room left"):
+        place_nodes(NODES, {"a": 2, "b": 2})
+
+def test_deploy_spreads_over_hosts(deployment):
+    hosts = [{"name": "worker0", "url": "tcp://192.168.1.10:2375"},
+            {"name": "worker1", "url": "tcp://192.168.1.11:2375"}]
+    deployment.write_config(dict(deployment.config, hosts=hosts))
+    deployment.manager(parallelism=4).deploy()
+
+    storage = deployment.storage()
+    assert Counter(storage[node_name]["host"]
+            for node_name in deployment.config["nodes"]) == {"worker0": 2, "worker1": 2}
@@ -0,0 +1,40 @@
+import socket
+
+import pytest
+
+from bbldpl_manager.ports import PortAllocator, PortConflictError
+
+def test_allocate_in_order_skipping_used_ports():
+    allocator = PortAllocator(used={18889: "container x"}, probe=False)
+    assert allocator.reserve("18891", "node2") == 18891
+
+    assert [allocator.allocate("node{}".format(i)) for i in range(3)] == \
+            [18888, 18890, 18892]
+
+def test_reserve_conflicts():
+    allocator = PortAllocator(used={20000: "container x"}, probe=False)
+    with pytest.raises(PortConflictError, match="used by container x"):
+        allocator.reserve(20000, "node0")
+
+    allocator.reserve(20001, "node0")
+    # Reserving its own port again is fine
+    assert allocator.reserve(20001, "node0") == 20001
+    with pytest.raises(PortConflictError, match="also assigned to node0"):
+        allocator.reserve(20001, "node1")
+
+def test_allocate_exhausted():
+    allocator = PortAllocator(first_port=PortAllocator.LAST_PORT, probe=False)
+    allocator.allocate("node0")
+    with pytest.raises(PortConflictError, match="no free host port"):
+        allocator.allocate("node1")
+
+def test_allocate_probes_bound_ports():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("", 0))
+    listener.listen()
+    try:
+        port = listener.getsockname()[1]
+        allocator = PortAllocator(first_port=port)
+        assert allocator.allocate("node0") != port
+    finally:
+        listener.close()
@@ -0,0 +1,57 @@
+import pytest
+
+from bbldpl_manager.resources import (ResourceError, docker_limits, format_cpulist,
+        node_resources, pack_nodes, parse_cpulist, parse_memory)
+
+def test_cpulists():
+    assert parse_cpulist("0-3,8,10-11") == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpulist([11, 0, 1, 2, 3, 8, 10]) == "0-3,8,10-11"
+    for cpulist in ["", "3-1", "a", "1,"]:
+        with pytest.raises(ValueError):
+            parse_cpulist(cpulist)
+
+def test_memory():
+    assert parse_memory("512m") == 512 * 1024 ** 2
+    assert parse_memory("2G") == 2 * 1024 ** 3
+    assert parse_memory(1000) == 1000
+    with pytest.raises(ValueError):
+        parse_memory("1.5g")
+
+def test_node_pinning_replaces_defaults():
+    defaults = {"cores": 2, "memory": "1g"}
+    assert node_resources(defaults, {"resources": {"cpuset": "4-5"}}) == \
+            {"cpuset": "4-5", "memory": "1g"}
+    assert node_resources(defaults, {}) == defaults
+
+def test_docker_limits():
+    assert docker_limits({"cpus": 1.5, "memory": "1g", "cores": 2}, [3, 2]) == {
+        "cpuset_cpus": "2-3",
+        "mem_limit": 1024 ** 3,
+        "nano_cpus": 1500000000
+    }
+    assert docker_limits({"cpuset": "1,0"}) == {"cpuset_cpus": "0-1"}
+
+def test_pack_nodes_fills_numa_nodes():
+    numa_nodes = [[0, 1, 2, 3], [4, 5, 6, 7]]
+    placement, warnings = pack_nodes({"a": 3, "b": 2, "c": 2, "d": 1}, numa_nodes)
+
+    assert warnings == []
+    # Largest first, each on the fullest NUMA node it fits in
+    assert placement == {"a": [0, 1, 2], "b": [4, 5], "c": [6, 7], "d": [3]}
+
+def test_pack_nodes_spans_numa_nodes_when_needed():
+    placement, warnings = pack_nodes({"a": 3}, [[0, 1], [2, 3]], used=[3])
+
+    assert placement == {"a": [0, 1, 2]}
+    assert warnings == ["a: no NUMA node has 3 free CPUs, spanning several"]
+
+def test_pack_nodes_overcommit():
+    numa_nodes = [[0, 1, 2, 3]]
+    with pytest.raises(ResourceError, match="3 CPUs needed, 2 free out of 4"):
+        pack_nodes({"a": 3}, numa_nodes, used=[0, 1])
+
+    placement, warnings = pack_nodes({"a": 3}, numa_nodes, used=[0, 1], overcommit=True)
+    assert placement == {"a": [0, 2, 3]}
+    assert len(warnings) == 1
+    with pytest.raises(ResourceError):
+        pack_nodes({"a": 5}, numa_nodes, overcommit=True)
@@ -0,0 +1,69 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from bbldpl_manager.rpc import RPCClient, RPCOutcomeUnknownError
+
+class DroppingServer:
+    """
+    Reads each request and closes the connection without answering, except
+    for the requests listed in `answers`, counted in `requests`.
+    """
+    def __init__(self, answers=0):
+        self.answers = answers
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return
+            with connection:
+                data = b""
+                while b"\r\n\r\n" not in data:
+                    data += connection.recv(4096)
+                headers, body = data.split(b"\r\n\r\n", 1)
+                length = int([line.split(b":")[1] for line in headers.split(b"\r\n")
+                        if line.lower().startswith(b"content-length")][0])
+                while len(body) < length:
+                    body += connection.recv(4096)
+                self.requests += 1
+                if self.answers:
+                    self.answers -= 1
+                    request = json.loads(body)
+                    response = json.dumps({"id": request["id"], "result": 1,
+                            "error": None}).encode("ascii")
+                    connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: " +
+                            str(len(response)).encode("ascii") + b"\r\n\r\n" + response)
+
+    def close(self):
+        self.sock.close()
+
+@pytest.fixture
+def server():
+    server = DroppingServer()
+    yield server
+    server.close()
+
+def test_non_idempotent_request_is_not_sent_again(server):
+    client = RPCClient("127.0.0.1", server.port, "user", "pass", tls=False)
+
+    with pytest.raises(RPCOutcomeUnknownError):
+        client.call("getnewaddress", "default")
+    assert server.requests == 1
+
+def test_idempotent_request_is_sent_again(server):
+    server.answers = 0
+    client = RPCClient("127.0.0.1", server.port, "user", "pass", tls=False)
+
+    with pytest.raises(ConnectionError):
+        client.call("getblockcount")
+    assert server.requests == 2
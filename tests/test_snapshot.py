@@ -0,0 +1,56 @@
+import itertools
+
+import pytest
+
+from bbldpl_manager import snapshot
+from bbldpl_manager.snapshot import SnapshotCache
+
+@pytest.fixture
+def clock(monkeypatch):
+    ticks = itertools.count()
+    monkeypatch.setattr(snapshot.time, "time", lambda: next(ticks))
+
+def test_least_recently_used_is_evicted(tmp_path, clock):
+    cache = SnapshotCache(str(tmp_path), budget=10)
+    assert cache.add("a", 4, {}) == []
+    assert cache.add("b", 4, {}) == []
+    cache.lookup("a")
+
+    evicted = cache.add("c", 4, {})
+    assert [entry["image"] for entry in evicted] == [cache.get_image("b")]
+    assert sorted(cache.entries) == ["a", "c"]
+    # The index survives the process
+    assert sorted(SnapshotCache(str(tmp_path)).entries) == ["a", "c"]
+
+def test_snapshot_larger_than_budget_is_kept(tmp_path, clock):
+    cache = SnapshotCache(str(tmp_path), budget=10)
+    cache.add("a", 4, {})
+
+    evicted = cache.add("b", 20, {})
+    assert [entry["image"] for entry in evicted] == [cache.get_image("a")]
+    assert list(cache.entries) == ["b"]
+
+def test_key_ignores_host_port(tmp_path):
+    cache = SnapshotCache(str(tmp_path))
+    node_info = {"user": "u", "hostport": "20000"}
+
+    assert cache.get_key("image", "node0", node_info) == \
+            cache.get_key("image", "node0", dict(node_info, hostport="20001"))
+    assert cache.get_key("image", "node0", node_info) != \
+            cache.get_key("image", "node1", node_info)
+
+def test_redeploy_starts_from_snapshots(deployment, tmp_path):
+    directory = str(tmp_path / "snapshots")
+    manager = deployment.manager(parallelism=4, snapshot_cache=directory)
+    manager.deploy()
+    first = deployment.storage()
+    deployment.manager(parallelism=4).destroy()
+
+    deployment.manager(parallelism=4, snapshot_cache=directory).deploy()
+
+    storage = deployment.storage()
+    for node_name in deployment.config["nodes"]:
+        assert storage[node_name]["wallet"] == first[node_name]["wallet"]
+        assert storage[node_name]["accounts"] == first[node_name]["accounts"]
+        assert deployment.containers()[node_name].mining
+    assert len(SnapshotCache(directory).entries) == len(deployment.config["nodes"])
@@ -0,0 +1,102 @@
+import json
+import threading
+
+import pytest
+
+from bbldpl_manager.storage import LogStorage, open_storage
+
+def test_json_storage_round_trip(tmp_path):
+    filename = str(tmp_path / "storage.json")
+    storage = open_storage(filename)
+    storage.data["node0"] = {"stages": ["container"]}
+    storage.flush("node0")
+
+    assert open_storage(filename).data == {"node0": {"stages": ["container"]}}
+
+def test_json_storage_flushes_changed_entry(tmp_path):
+    filename = str(tmp_path / "storage.json")
+    storage = open_storage(filename, "json")
+    storage.data["node0"] = {"stages": ["container"]}
+    storage.data["node1"] = {"stages": ["container"]}
+    storage.flush()
+    storage.data["node0"]["stages"].append("wallet")
+    del storage.data["node1"]
+    storage.flush("node0")
+    storage.flush("node1")
+
+    assert open_storage(filename, "json").data == {
+        "node0": {"stages": ["container", "wallet"]}
+    }
+
+@pytest.mark.parametrize("backend", ["json", "log"])
+def test_concurrent_flushes(tmp_path, backend):
+    filename = str(tmp_path / "storage")
+    storage = open_storage(filename, backend)
+
+    def update(node_name):
+        for count in range(50):
+            with storage.lock:
+                storage.data.setdefault(node_name, {"counts": []})["counts"].append(count)
+            storage.flush(node_name)
+
+    threads = [threading.Thread(target=update, args=("node{}".format(i),))
+            for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert open_storage(filename, backend).data == {
+        "node{}".format(i): {"counts": list(range(50))} for i in range(8)
+    }
+
+def test_log_storage_replay(tmp_path):
+    filename = str(tmp_path / "storage.log")
+    storage = open_storage(filename, "log")
+    storage.data["node0"] = {"stages": ["container"]}
+    storage.flush("node0")
+    storage.data["node1"] = {"stages": ["container"]}
+    storage.flush("node1")
+    storage.data["node0"]["stages"].append("wallet")
+    storage.flush("node0")
+    del storage.data["node1"]
+    storage.flush("node1")
+
+    with open(filename, "r") as f:
+        assert len(f.readlines()) == 4
+    assert open_storage(filename, "log").data == {
+        "node0": {"stages": ["container", "wallet"]}
+    }
+
+def test_log_storage_ignores_torn_line(tmp_path):
+    filename = str(tmp_path / "storage.log")
+    storage = open_storage(filename, "log")
+    storage.data["node0"] = {"stages": ["container"]}
+    storage.flush("node0")
+    # A crash in the middle of an append
+    with open(filename, "a") as f:
+        f.write('{"key": "node0", "value": {"sta')
+
+    replayed = open_storage(filename, "log")
+    assert replayed.data == {"node0": {"stages": ["container"]}}
+    replayed.data["node0"]["stages"].append("wallet")
+    replayed.flush("node0")
+
+    assert open_storage(filename, "log").data == {
+        "node0": {"stages": ["container", "wallet"]}
+    }
+
+def test_log_storage_compaction(tmp_path):
+    filename = str(tmp_path / "storage.log")
+    storage = open_storage(filename, "log")
+    storage.data["node0"] = {"count": 0}
+    for count in range(LogStorage.COMPACT_MIN_LINES + 1):
+        storage.data["node0"]["count"] = count
+        storage.flush("node0")
+
+    with open(filename, "r") as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) < LogStorage.COMPACT_MIN_LINES
+    assert open_storage(filename, "log").data == {
+        "node0": {"count": LogStorage.COMPACT_MIN_LINES}
+    }
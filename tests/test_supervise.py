@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from bbldpl_manager.supervise import Supervisor
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+@pytest.fixture
+def supervised(deployment):
+    manager = deployment.manager(parallelism=4)
+    manager.deploy()
+    supervisor = Supervisor(manager, interval=0.05)
+    supervisor.start()
+    yield manager, supervisor
+    supervisor.stop()
+
+def test_backoff_doubles_up_to_max():
+    supervisor = Supervisor.__new__(Supervisor)
+    supervisor.max_backoff = 30
+
+    assert [supervisor._backoff(failures) for failures in range(6)] == \
+            [0, 5, 10, 20, 30, 30]
+
+def test_crashed_daemon_is_restarted(deployment, supervised):
+    manager, supervisor = supervised
+    container = deployment.containers()["node0"]
+    deployment.docker.crash("node0", "bbld")
+
+    assert wait_until(lambda: "bbld" in container.processes and container.mining)
+    assert wait_until(lambda: manager.storage_config["node0"].get("supervisor"))
+    supervisor.stop()
+    assert deployment.storage()["node0"]["supervisor"]["bbld"]["restarts"] == 1
+    assert supervisor.states["node1", "bbld"]["restarts"] == 0
+
+def test_crash_loop_backs_off(deployment, supervised):
+    manager, supervisor = supervised
+    supervisor.STABLE_PERIOD = 60
+    supervisor.MIN_BACKOFF = 0.5
+    container = deployment.containers()["node0"]
+
+    deployment.docker.crash("node0", "btcwallet")
+    assert wait_until(lambda: supervisor.states["node0", "btcwallet"]["restarts"] == 1)
+    # Dying again right after its restart delays the next one
+    deployment.docker.crash("node0", "btcwallet")
+    crashed_at = time.monotonic()
+    assert wait_until(lambda: "btcwallet" in container.processes)
+
+    assert time.monotonic() - crashed_at >= 0.5
+    assert wait_until(lambda: supervisor.states["node0", "btcwallet"]["restarts"] == 2)
+    assert supervisor.states["node0", "btcwallet"]["failures"] == 1
+    assert container.unlocked
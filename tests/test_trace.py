@@ -0,0 +1,47 @@
+import json
+
+from bbldpl_manager.bbldpl_manager import BbldplManager
+from bbldpl_manager.trace import Tracer
+
+def test_child_spans_inherit_attributes():
+    tracer = Tracer()
+    with tracer.span("stage.wallet", node="node0"):
+        with tracer.span("docker.exec", command="btcwallet"):
+            pass
+
+    child, parent = tracer.spans
+    assert child["name"] == "docker.exec"
+    assert child["attributes"] == {"node": "node0", "command": "btcwallet"}
+    assert parent["attributes"] == {"node": "node0"}
+    assert parent["duration"] >= child["duration"]
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer(enabled=False)
+    with tracer.span("stage.wallet", node="node0"):
+        pass
+
+    assert tracer.spans == []
+
+def test_deploy_trace_export(deployment, tmp_path):
+    manager = deployment.manager(parallelism=4, trace=True)
+    manager.deploy()
+    chrome_file = str(tmp_path / "trace.json")
+    jsonl_file = str(tmp_path / "trace.jsonl")
+    manager.export_trace(chrome_file)
+    manager.export_trace(jsonl_file)
+
+    with open(chrome_file, "r") as f:
+        events = json.load(f)["traceEvents"]
+    assert all(event["ph"] == "X" for event in events)
+    with open(jsonl_file, "r") as f:
+        spans = [json.loads(line) for line in f]
+    assert len(spans) == len(events)
+    assert [span["start"] for span in spans] == sorted(span["start"] for span in spans)
+
+    stages = {(span["attributes"].get("node"), span["name"]) for span in spans}
+    for node_name in deployment.config["nodes"]:
+        for stage in BbldplManager.NODE_STAGES + BbldplManager.NETWORK_STAGES:
+            assert (node_name, "stage." + stage) in stages
+    # Docker calls are attributed to the node whose stage made them
+    assert any(span["name"] == "docker.exec" and span["attributes"].get("node") == "node0"
+            for span in spans)